@@ -27,19 +27,21 @@ from datetime import datetime
 from xml.dom.minidom import parse, parseString, Node, Element
 import locale
 import argparse
+import multiprocessing
 import serial, serial.tools.list_ports
 from PyQt6 import QtCore, QtGui, QtWidgets, uic
 from PyQt6.QtCore import Qt, QCoreApplication, QObject, QThread, \
                          pyqtSignal, pyqtSlot, QModelIndex, \
                          QItemSelectionModel, QFileInfo, QTranslator, \
                          QLocale, QSettings, QFile, QIODevice, QEvent, \
-                         QTimer
+                         QTimer, QStandardPaths
 from PyQt6.QtGui import QKeySequence, QStandardItemModel, QStandardItem, QValidator, QPalette, QFontDatabase, QAction, QShortcut
-from PyQt6.QtWidgets import QDialog, QAbstractItemView, QMessageBox
+from PyQt6.QtWidgets import QDialog, QAbstractItemView, QMessageBox, QInputDialog
 from cn5X_config import *
 from msgbox import *
 from speedOverrides import *
 from grblCom import grblCom
+from grblComTransport import isNetworkPort, isSimulatorPort, isReplayPort
 from grblDecode import grblDecode
 from gcodeQLineEdit import gcodeQLineEdit
 from cnQPushButton import cnQPushButton
@@ -60,6 +62,10 @@ from grblG28_30_1 import dlgG28_30_1
 from cn5X_jog import dlgJog
 from cn5X_beep import cn5XBeeper
 from cn5X_toolChange import dlgToolChange
+from cn5X_cycle import *
+from cn5X_gcodeFeeder import gcodeFeeder
+from cn5X_gcodeEstimator import gcodeEstimator, gcodeEstimate, formatDuration
+from cn5X_gcodeTravel import gcodeTravelCheck
 ###import cn5X_rc
 
 
@@ -161,7 +167,7 @@ class winMain(QtWidgets.QMainWindow):
     parser.add_argument("-c", "--connect", action="store_true", help=self.tr("Connect the serial port"))
     parser.add_argument("-f", "--file", help=self.tr("Load the GCode file"))
     parser.add_argument("-l", "--lang", help=self.tr("Define the interface language"))
-    parser.add_argument("-p", "--port", help=self.tr("select the serial port"))
+    parser.add_argument("-p", "--port", help=self.tr("select the serial port, network address (tcp://host:port), built-in simulator (sim://grbl or sim://mega5x) or recorded session (replay:///path/file.cn5xrec)"))
     parser.add_argument("-s", "--fullScreen", action="store_true", help=self.tr("Set appliation full screen mode"))
     parser.add_argument("-u", "--noUrgentStop", action="store_true", help=self.tr("Unlock urgent stop"))
     self.__args = parser.parse_args()
@@ -250,6 +256,9 @@ class winMain(QtWidgets.QMainWindow):
     self.timerDblClic = QTimer()
 
     self.__grblCom = grblCom()
+    self.__grblCom.setAdaptivePolling(self.__settings.value("adaptivePolling", True, type=bool))
+    if self.__settings.value("recordSessions", False, type=bool):
+      self.__grblCom.setRecordDir(self.sessionsDir())
     self.__grblCom.sig_log.connect(self.on_sig_log)
     self.__grblCom.sig_connect.connect(self.on_sig_connect)
     self.__grblCom.sig_init.connect(self.on_sig_init)
@@ -260,6 +269,7 @@ class winMain(QtWidgets.QMainWindow):
     self.__grblCom.sig_config.connect(self.on_sig_config)
     self.__grblCom.sig_data.connect(self.on_sig_data)
     self.__grblCom.sig_emit.connect(self.on_sig_emit)
+    self.__grblCom.sig_lineSent.connect(self.on_sig_lineSent)
     self.__grblCom.sig_recu.connect(self.on_sig_recu)
     self.__grblCom.sig_debug.connect(self.on_sig_debug)
     self.__grblCom.sig_activity.connect(self.on_sig_activity)
@@ -282,6 +292,11 @@ class winMain(QtWidgets.QMainWindow):
 
     self.__gcodeFile = gcodeFile(self.ui, self.ui.gcodeTable, self.__dlgToolChange)
     self.__gcodeFile.sig_log.connect(self.on_sig_log)
+    self.__gcodeFile.sig_program.connect(self.on_gcodeFile_program)
+    self.__gcodeFile.setProgramChecks(self.programChecks)
+    self.__estimate         = None # Estimation de la duree du programme (gcodeEstimate)
+    self.__estimateProgram  = None # Programme et reglages de Grbl de cette estimation
+    self.__estimateSettings = None
 
     self.__jog = grblJog(self.__grblCom)
     self.ui.dsbJogSpeed.setValue(DEFAULT_JOG_SPEED)
@@ -292,8 +307,12 @@ class winMain(QtWidgets.QMainWindow):
     self.__probeResult       = None
     
     self.__connectionStatus = False
-    self.__cycleRun         = False
-    self.__cyclePause       = False
+    self.__cycle            = cn5XCycle(self.__grblCom)
+    self.__cycle.sig_state.connect(self.on_cycle_state)
+    self.__cycle.sig_log.connect(self.on_sig_log)
+    self.__feeder           = gcodeFeeder(self.__gcodeFile, self.__cycle, self.__grblCom)
+    self.__feeder.sig_log.connect(self.on_sig_log)
+    self.__feeder.sig_gcodeState.connect(self.on_sig_data)
     self.__grblConfigLoaded = False
     self.__nbAxis           = DEFAULT_NB_AXIS
     self.__axisNames        = DEFAULT_AXIS_NAMES
@@ -357,12 +376,14 @@ class winMain(QtWidgets.QMainWindow):
     
     self.ui.btnUrgence.pressed.connect(self.on_arretUrgence)             # Evenements du bouton d'arret d'urgence
     self.ui.cmbPort.currentIndexChanged.connect(self.on_cmbPort_changed) # un clic sur un element de la liste appellera la methode 'on_cmbPort_changed'
+    self.ui.cmbPort.editTextChanged.connect(self.on_cmbPort_changed)     # saisie directe d'un port ou d'une adresse reseau tcp://hote:port
 
     self.ui.mnuBar.hovered.connect(self.on_mnuBar)     # Connexions des routines du menu application
     self.ui.mnuAppOuvrir.triggered.connect(self.on_mnuAppOuvrir)
     self.ui.mnuAppEnregistrer.triggered.connect(self.on_mnuAppEnregistrer)
     self.ui.mnuAppEnregistrerSous.triggered.connect(self.on_mnuAppEnregistrerSous)
     self.ui.mnuAppFermerGCode.triggered.connect(self.on_mnuAppFermerGCode)
+    self.ui.mnuUndoArcFit.triggered.connect(self.on_mnuUndoArcFit)
 
     self.ui.mnuPreferences.aboutToShow.connect(self.on_mnuPreferences)
     self.ui.mnuConfirm_Go_to_G28.triggered.connect(self.on_mnuConfirm_Go_to_G28)
@@ -371,6 +392,11 @@ class winMain(QtWidgets.QMainWindow):
     self.ui.mnuConfirm_define_G30.triggered.connect(self.on_mnuConfirm_define_G30)
     self.ui.mnuPrefToolChange.triggered.connect(self.on_mnuPrefToolChange)
     self.ui.mnuIgnoreFirstToolChange.triggered.connect(self.on_mnuIgnoreFirstToolChange)
+    self.ui.mnuCharCountingStreaming.triggered.connect(self.on_mnuCharCountingStreaming)
+    self.ui.mnuAdaptivePolling.triggered.connect(self.on_mnuAdaptivePolling)
+    self.ui.mnuRecordSessions.triggered.connect(self.on_mnuRecordSessions)
+    self.ui.mnuMergeCollinear.triggered.connect(self.on_mnuMergeCollinear)
+    self.ui.mnuArcFit.triggered.connect(self.on_mnuArcFit)
 
     self.ui.mnuAppQuitter.triggered.connect(self.on_mnuAppQuitter)
 
@@ -438,6 +464,22 @@ class winMain(QtWidgets.QMainWindow):
     self.ui.btnPausePooling.clicked.connect(self.on_btnPausePooling)
 
     self.ui.btnClearDebug.clicked.connect(self.clearDebug)
+    self.ui.btnDiagReset.clicked.connect(self.on_btnDiagReset)
+    self.ui.btnDiagExport.clicked.connect(self.on_btnDiagExport)
+
+    # Rafraichissement de l'onglet Diagnostics quand il est affiche
+    self.timerDiag = QTimer()
+    self.timerDiag.setInterval(1000)
+    self.timerDiag.timeout.connect(self.refreshDiag)
+    self.ui.qtabConsole.currentChanged.connect(self.on_qtabConsole_changed)
+
+    # Suivi de la ligne en cours pendant un cycle : regroupement des mises a jour
+    # de la liste GCode et de la progressBox (cf. on_sig_lineSent())
+    self.__lastLineSent = -1
+    self.timerProgress = QTimer()
+    self.timerProgress.setSingleShot(True)
+    self.timerProgress.setInterval(PROGRESS_REFRESH_DELAY)
+    self.timerProgress.timeout.connect(self.refreshProgress)
 
     self.ui.btnM64P0.clicked.connect(lambda: self.on_btnM64(0))
     self.ui.btnM64P1.clicked.connect(lambda: self.on_btnM64(1))
@@ -665,7 +707,18 @@ class winMain(QtWidgets.QMainWindow):
             self.ui.cmbPort.setCurrentIndex(len(self.ui.cmbPort)-1)
         elif lastPort == p.device:
           self.ui.cmbPort.setCurrentIndex(len(self.ui.cmbPort)-1)
-    else:
+    # Adresse reseau (tcp://hote:port), simulateur (sim://) ou rejeu (replay://) demande en option ou utilise la derniere fois
+    isUrlPort = lambda port: isNetworkPort(port) or isSimulatorPort(port) or isReplayPort(port)
+    networkPort = None
+    if self.__args.port is not None:
+      if isUrlPort(self.__args.port):
+        networkPort = self.__args.port
+    elif isUrlPort(lastPort):
+      networkPort = lastPort
+    if networkPort is not None:
+      self.ui.cmbPort.addItem(networkPort)
+      self.ui.cmbPort.setCurrentIndex(len(self.ui.cmbPort)-1)
+    elif len(ports) == 0:
       m = msgBox(
                   title  = self.tr("Warning !"),
                   text   = self.tr("No communication port available!"),
@@ -676,7 +729,7 @@ class winMain(QtWidgets.QMainWindow):
                 )
       m.afficheMsg()
     # S'il n'y a qu'un seul port serie et que l'on a rien precise comme option port, on le selectionne
-    if self.__args.port == None:
+    if self.__args.port == None and networkPort is None:
       if len(ports) == 1:
         self.ui.cmbPort.setCurrentIndex(1)
     # Definit l'activation des controles en fonction de la selection du port serie ou non
@@ -797,6 +850,7 @@ class winMain(QtWidgets.QMainWindow):
     if self.__gcodeFile.isFileLoaded():
       self.ui.mnuAppEnregistrerSous.setEnabled(True)
       self.ui.mnuAppFermerGCode.setEnabled(True)
+      self.ui.mnuUndoArcFit.setEnabled(self.__gcodeFile.canUndoArcFit() and not self.__cycle.isActive())
       if self.__gcodeFile.gcodeChanged():
         self.ui.mnuAppEnregistrer.setEnabled(True)
       else:
@@ -805,6 +859,7 @@ class winMain(QtWidgets.QMainWindow):
       self.ui.mnuAppEnregistrer.setEnabled(False)
       self.ui.mnuAppEnregistrerSous.setEnabled(False)
       self.ui.mnuAppFermerGCode.setEnabled(False)
+      self.ui.mnuUndoArcFit.setEnabled(False)
     if self.__connectionStatus:
       self.ui.mnu_MPos.setEnabled(True)
       self.ui.mnu_WPos.setEnabled(True)
@@ -874,6 +929,12 @@ class winMain(QtWidgets.QMainWindow):
     self.setEnableDisableGroupes()
 
 
+  @pyqtSlot()
+  def on_mnuUndoArcFit(self):
+    if not self.__cycle.isActive():
+      self.__gcodeFile.undoArcFit()
+
+
   @pyqtSlot()
   def on_mnuPreferences(self):
     self.ui.mnuConfirm_Go_to_G28.setChecked(not self.__settings.value("dontConfirmG28", False, type=bool))
@@ -882,6 +943,11 @@ class winMain(QtWidgets.QMainWindow):
     self.ui.mnuConfirm_define_G30.setChecked(not self.__settings.value("dontConfirmG30.1", False, type=bool))
     self.ui.mnuPrefToolChange.setChecked(self.__settings.value("useToolChange", True, type=bool))
     self.ui.mnuIgnoreFirstToolChange.setChecked(self.__settings.value("ignoreFirstToolChange", False, type=bool))
+    self.ui.mnuCharCountingStreaming.setChecked(self.__settings.value("charCountingStreaming", False, type=bool))
+    self.ui.mnuAdaptivePolling.setChecked(self.__settings.value("adaptivePolling", True, type=bool))
+    self.ui.mnuRecordSessions.setChecked(self.__settings.value("recordSessions", False, type=bool))
+    self.ui.mnuMergeCollinear.setChecked(self.__settings.value("mergeCollinear", False, type=bool))
+    self.ui.mnuArcFit.setChecked(self.__settings.value("arcFit", False, type=bool))
 
 
   @pyqtSlot()
@@ -914,6 +980,66 @@ class winMain(QtWidgets.QMainWindow):
     self.__settings.setValue("ignoreFirstToolChange", self.ui.mnuIgnoreFirstToolChange.isChecked())
 
 
+  @pyqtSlot()
+  def on_mnuCharCountingStreaming(self):
+    self.__settings.setValue("charCountingStreaming", self.ui.mnuCharCountingStreaming.isChecked())
+    if self.__connectionStatus:
+      self.log(logSeverity.info.value, self.tr("The new streaming mode will be used at the next connection."))
+
+
+  @pyqtSlot()
+  def on_mnuAdaptivePolling(self):
+    self.__settings.setValue("adaptivePolling", self.ui.mnuAdaptivePolling.isChecked())
+    self.__grblCom.setAdaptivePolling(self.ui.mnuAdaptivePolling.isChecked())
+
+
+  def sessionsDir(self):
+    ''' Repertoire des enregistrements de sessions Grbl (enregistreur de vol) '''
+    return os.path.join(QStandardPaths.writableLocation(QStandardPaths.StandardLocation.AppDataLocation), "sessions")
+
+
+  @pyqtSlot()
+  def on_mnuRecordSessions(self):
+    self.__settings.setValue("recordSessions", self.ui.mnuRecordSessions.isChecked())
+    if self.ui.mnuRecordSessions.isChecked():
+      self.__grblCom.setRecordDir(self.sessionsDir())
+      self.log(logSeverity.info.value, self.tr("Grbl sessions will be recorded in {} from the next connection.").format(self.sessionsDir()))
+    else:
+      self.__grblCom.setRecordDir(None)
+
+
+  @pyqtSlot()
+  def on_mnuMergeCollinear(self):
+    if self.ui.mnuMergeCollinear.isChecked():
+      tolerance, ok = QInputDialog.getDouble(self,
+        self.tr("Merge collinear moves"),
+        self.tr("Maximum deviation from the merged moves (mm or degrees):"),
+        self.__settings.value("mergeTolerance", GCODE_MERGE_TOLERANCE, type=float),
+        0.0001, 1.0, 4)
+      if not ok:
+        self.ui.mnuMergeCollinear.setChecked(False)
+        return
+      self.__settings.setValue("mergeTolerance", tolerance)
+      self.log(logSeverity.info.value, self.tr("Collinear moves will be merged from the next file loading."))
+    self.__settings.setValue("mergeCollinear", self.ui.mnuMergeCollinear.isChecked())
+
+
+  @pyqtSlot()
+  def on_mnuArcFit(self):
+    if self.ui.mnuArcFit.isChecked():
+      tolerance, ok = QInputDialog.getDouble(self,
+        self.tr("Fit arcs"),
+        self.tr("Maximum deviation between the replaced moves and the arc (mm):"),
+        self.__settings.value("arcFitTolerance", GCODE_ARC_FIT_TOLERANCE, type=float),
+        0.0001, 1.0, 4)
+      if not ok:
+        self.ui.mnuArcFit.setChecked(False)
+        return
+      self.__settings.setValue("arcFitTolerance", tolerance)
+      self.log(logSeverity.info.value, self.tr("Arcs will be fitted from the next file loading."))
+    self.__settings.setValue("arcFit", self.ui.mnuArcFit.isChecked())
+
+
   @pyqtSlot()
   def on_mnuAppQuitter(self):
     self.close()
@@ -2217,11 +2343,16 @@ class winMain(QtWidgets.QMainWindow):
         self.ui.qtabConsole.setCurrentIndex(CN5X_TAB_GRBL)
       # Recupere les coordonnees et parametres du port a connecter
       serialDevice = self.ui.cmbPort.currentText()
-      serialDevice = serialDevice.split("-")
+      serialDevice = serialDevice.split(" - ")
       serialDevice = serialDevice[0].strip()
       baudRate = int(self.ui.cmbBauds.currentText())
+      # Mode d'envoi du GCode choisi dans les preferences
+      if self.__settings.value("charCountingStreaming", False, type=bool):
+        streamingMode = STREAMING_CHAR_COUNTING
+      else:
+        streamingMode = STREAMING_PING_PONG
       # Demarrage du communicator
-      self.__grblCom.startCom(serialDevice, baudRate)
+      self.__grblCom.startCom(serialDevice, baudRate, streamingMode)
       # Mémorise le dernier port série utilisé
       self.__settings.setValue("grblDevice", serialDevice)
     else:
@@ -2239,7 +2370,7 @@ class winMain(QtWidgets.QMainWindow):
     self.__connectionStatus = self.__grblCom.isOpen()
     if self.__connectionStatus:
       # Mise a jour de l'interface machine connectée
-      self.ui.lblConnectStatus.setText(self.tr("Connected to {}").format(self.ui.cmbPort.currentText().split("-")[0].strip()))
+      self.ui.lblConnectStatus.setText(self.tr("Connected to {}").format(self.ui.cmbPort.currentText().split(" - ")[0].strip()))
       self.ui.btnConnect.setText(self.tr("Disconnect")) # La prochaine action du bouton sera pour deconnecter
       self.setEnableDisableConnectControls()
       # Active les groupes de controles de pilotage de Grbl
@@ -2551,33 +2682,15 @@ class winMain(QtWidgets.QMainWindow):
 
   @pyqtSlot(int)
   def on_sig_error(self, errNum: int):
+    # En cours de cycle, l'arret est gere par self.__cycle (cn5XCycle)
     self.logGrbl.append(self.__decode.errorMessage(errNum))
-    if self.__cycleRun:
-      self.__grblCom.clearCom() # Vide la file d'attente de communication
-      self.__cycleRun = False
-      self.__cyclePause = False
-      # Masque de la boite de progression
-      if self.__pBox.isVisible():
-        if self.__pBox.autoClose():
-          self.__pBox.stop()
-        else:
-          self.__pBox.enableClose()
 
 
   @pyqtSlot(int)
   def on_sig_alarm(self, alarmNum: int):
+    # En cours de cycle, l'arret est gere par self.__cycle (cn5XCycle)
     self.logGrbl.append(self.__decode.alarmMessage(alarmNum))
     self.__decode.set_etatMachine(GRBL_STATUS_ALARM)
-    if self.__cycleRun:
-      self.__grblCom.clearCom() # Vide la file d'attente de communication
-      self.__cycleRun = False
-      self.__cyclePause = False
-      # Masque de la boite de progression
-      if self.__pBox.isVisible():
-        if self.__pBox.autoClose():
-          self.__pBox.stop()
-        else:
-          self.__pBox.enableClose()
 
 
   @pyqtSlot(str)
@@ -2634,27 +2747,29 @@ class winMain(QtWidgets.QMainWindow):
 
   @pyqtSlot(str)
   def on_sig_emit(self, data: str):
-    trouve = False
     if data != "":
       self.logGrbl.append(data)
-      if self.__cycleRun:
-        # Recherche la ligne dans la liste du fichier GCode
-        ligne = self.__gcodeFile.getGCodeSelectedLine()[0]
-        while ligne < self.ui.gcodeTable.model().rowCount():
-          idx = self.ui.gcodeTable.model().index(ligne, 0, QModelIndex())
-          if self.ui.gcodeTable.model().data(idx) == data:
-            self.__gcodeFile.selectGCodeFileLine(ligne)
-            trouve = True
-            break
-          else:
-            ligne += 1
-        # Mise à jour de la progressBox
-        if trouve:
-          self.__pBox.setValue(ligne + 1)
+      if self.__cycle.isActive():
         # On affiche le dernier commentaire rencontré dans la progressBox
         if data[:1] == '(' and data[-1:] == ")":
           self.__pBox.setComment(data)
 
+
+  @pyqtSlot(int)
+  def on_sig_lineSent(self, index: int):
+    ''' Envoi a Grbl de la ligne index du fichier GCode (cf. gcodeFile.enQueueLine()) '''
+    if self.__cycle.isActive():
+      self.__lastLineSent = index
+      if not self.timerProgress.isActive():
+        self.timerProgress.start()
+
+
+  def refreshProgress(self):
+    ''' Selection de la derniere ligne envoyee et mise a jour de la progressBox '''
+    if self.__lastLineSent >= 0:
+      self.__gcodeFile.selectGCodeFileLine(self.__lastLineSent)
+      self.__pBox.setValue(self.__lastLineSent + 1)
+
   @pyqtSlot(str)
   def on_sig_recu(self, data: str):
     pass
@@ -2669,6 +2784,7 @@ class winMain(QtWidgets.QMainWindow):
   @pyqtSlot()
   def on_mnuDebug_mode(self):
     ''' Set the debug button on the same status '''
+    self.__grblCom.setDebug(self.ui.mnuDebug_mode.isChecked())
     if self.ui.mnuDebug_mode.isChecked():
       if not self.ui.btnDebug.isChecked():
         self.ui.btnDebug.setChecked(True)
@@ -2708,6 +2824,7 @@ class winMain(QtWidgets.QMainWindow):
   @pyqtSlot()
   def on_btnDebug(self):
     ''' Set the debug menu on the same status '''
+    self.__grblCom.setDebug(self.ui.btnDebug.isChecked())
     if self.ui.btnDebug.isChecked():
       if not self.ui.mnuDebug_mode.isChecked():
         self.ui.mnuDebug_mode.setChecked(True)
@@ -2737,42 +2854,187 @@ class winMain(QtWidgets.QMainWindow):
     self.logDebug.clear()
 
 
+  @pyqtSlot(int)
+  def on_qtabConsole_changed(self, index: int):
+    if index == CN5X_TAB_DIAG:
+      self.refreshDiag()
+      self.timerDiag.start()
+    else:
+      self.timerDiag.stop()
+
+
+  @pyqtSlot()
+  def refreshDiag(self):
+    ''' Affichage des statistiques de communication avec Grbl '''
+    self.ui.txtDiagOutput.setPlainText(self.__grblCom.getStats().report())
+
+
+  @pyqtSlot()
+  def on_btnDiagReset(self):
+    self.__grblCom.getStats().clear()
+    self.refreshDiag()
+
+
+  @pyqtSlot()
+  def on_btnDiagExport(self):
+    opt = QtWidgets.QFileDialog.Option.DontUseNativeDialog
+    fName = QtWidgets.QFileDialog.getSaveFileName(self, self.tr("Export communication statistics"), "", self.tr("CSV file (*.csv)"), options=opt)
+    if fName[0] != "":
+      try:
+        self.__grblCom.getStats().toCsv(fName[0])
+      except OSError as err:
+        self.log(logSeverity.error.value, self.tr("Unable to write {}: {}").format(fName[0], err))
+      else:
+        self.log(logSeverity.info.value, self.tr("Communication statistics exported to {}").format(fName[0]))
+
+
   def startCycle(self, startFrom: int = 0):
 
     if self.ui.gcodeTable.model().rowCount()<=0:
       self.log(logSeverity.warning.value, self.tr("Attempt to start an empty cycle..."))
-    elif self.__cycleRun:
+    elif self.__cycle.isActive():
       self.log(logSeverity.warning.value, self.tr("Cycle already running!"))
     else:
+      # Controle des courses avant le depart
+      report = self.travelCheck(startFrom)
+      if report is not None and not report.isValid():
+        self.logTravelCheck(report)
+        m = msgBox(
+            title     = self.tr("Machine travel"),
+            text      = self.tr("The program exceeds the machine travel on {} lines.").format(report.violationCount()),
+            info      = self.tr("Grbl will stop the cycle with a soft limit alarm or the machine will hit its limits. Start the cycle anyway?"),
+            icon      = msgIconList.Warning,
+            detail    = "\n".join(self.tr("Line {}: {} = {:.3f}").format(num + 1, axis, val) for num, axis, val in report.violations()),
+            stdButton = msgButtonList.Yes | msgButtonList.Cancel,
+            defButton = msgButtonList.Cancel,
+            escButton = msgButtonList.Cancel
+        )
+        if m.afficheMsg() != msgButtonList.Yes:
+          self.log(logSeverity.warning.value, self.tr("Cycle not started."))
+          return
+
       self.log(logSeverity.info.value, self.tr("Starting cycle..."))
 
-      # Affichage de la boite de progression
-      self.__pBox.setRange(startFrom, self.ui.gcodeTable.model().rowCount())
+      # Affichage de la boite de progression, avec l'estimation faite au chargement du
+      # programme, recalculee seulement si les reglages de Grbl ont change depuis
+      estimate = self.programEstimate()
+      if estimate is not None and startFrom > 0:
+        self.log(logSeverity.info.value, self.tr("Estimated time from line {}: {}").format(startFrom + 1, formatDuration(estimate.remaining(startFrom))))
+      self.__pBox.setRange(startFrom, self.__gcodeFile.lineCount())
+      self.__pBox.setEstimate(estimate, startFrom)
       self.__pBox.start()
 
       self.__gcodeFile.selectGCodeFileLine(0)
-      self.__cycleRun = True
-      self.__cyclePause = False
 
-      self.__gcodeFile.enQueue(self.__grblCom, startFrom)
+      # Les lignes sont envoyees au fil des acquittements de Grbl par self.__feeder,
+      # via self.__cycle qui suit le deroulement du programme (cf. on_cycle_state())
+      self.__cycle.begin()
+      self.__feeder.start(startFrom)
 
-      # Attente du début du traitement par Grbl
-      while self.__decode.get_etatMachine() != GRBL_STATUS_RUN:
-        QCoreApplication.processEvents()
-      # Attente de la fin du traitement par Grbl
-      while self.__decode.get_etatMachine() != GRBL_STATUS_IDLE:
-        QCoreApplication.processEvents()
 
-      self.log(logSeverity.info.value, self.tr("Cycle completed."))
+  def programEstimate(self):
+    '''
+    Estimation de la duree du programme charge avec les reglages actuels de Grbl
+    (gcodeEstimate), None si le programme n'est pas encore analyse ou si les
+    reglages ne sont pas connus. L'estimation du chargement (on_gcodeFile_program())
+    ou celle conservee avec le programme est reprise si les reglages n'ont pas change.
+    '''
+    program = self.__gcodeFile.program()
+    if program is None:
+      return None
+    estimator = gcodeEstimator.fromDecoder(self.__decode, self.__axisNames)
+    if estimator is None:
+      return None
+    if program is not self.__estimateProgram or estimator.settingsKey() != self.__estimateSettings:
+      # Estimation faite au chargement avec ces reglages, sinon nouvelle estimation
+      self.__estimate = gcodeEstimate.fromSummary(program, estimator.summaryKey(), estimator.settingsKey())
+      if self.__estimate is None:
+        self.__estimate = estimator.estimate(program)
+        self.__estimate.toSummary(program, estimator.summaryKey())
+      self.__estimateProgram  = program
+      self.__estimateSettings = estimator.settingsKey()
+    return self.__estimate
+
+
+  def programChecks(self):
+    '''
+    Estimateur de duree (gcodeEstimator) et controle des courses (gcodeTravelCheck) avec
+    les reglages actuels de Grbl, pour le thread de chargement du programme (None pour
+    chacun s'ils ne sont pas connus).
+    '''
+    estimator = gcodeEstimator.fromDecoder(self.__decode, self.__axisNames)
+    check = gcodeTravelCheck.fromDecoder(self.__decode, self.__axisNames, self.__maxTravel)
+    return estimator, (check if check.isEnabled() else None)
+
+
+  def travelCheck(self, fromLine: int = 0):
+    '''
+    Controle des courses machine ($130...) par le programme charge, avec les offsets
+    actuels (gcodeTravelReport), None si le programme n'est pas encore analyse ou si
+    les courses ne sont pas connues.
+    '''
+    program = self.__gcodeFile.program()
+    if program is None:
+      return None
+    check = gcodeTravelCheck.fromDecoder(self.__decode, self.__axisNames, self.__maxTravel)
+    if not check.isEnabled():
+      return None
+    # Enveloppe calculee au chargement : controle complet seulement si elle sort des courses
+    report = check.checkBounds(program.summary(check.boundsKey()))
+    if report is not None:
+      return report
+    return check.check(program, fromLine)
+
+
+  def logTravelCheck(self, report):
+    envelope = ", ".join("{} {:.3f} / {:.3f}".format(axis, mini, maxi) for axis, mini, maxi in report.envelope())
+    if report.isValid():
+      self.log(logSeverity.info.value, self.tr("Program machine envelope: {}").format(envelope))
+    else:
+      message = self.tr("The program exceeds the machine travel on {} lines (envelope: {}):").format(report.violationCount(), envelope)
+      for num, axis, val in report.violations():
+        message += "\n" + self.tr("  Line {}: {} = {:.3f}").format(num + 1, axis, val)
+      self.log(logSeverity.warning.value, message)
+    if report.uncheckedFrom() >= 0:
+      self.log(logSeverity.warning.value, self.tr("Offsets changed by the program at line {}, travel not checked after it.").format(report.uncheckedFrom() + 1))
+
+
+  @pyqtSlot(object, object, object)
+  def on_gcodeFile_program(self, program, estimate, report):
+    '''
+    Programme pre-analyse disponible, avec l'estimation de sa duree et le controle des
+    courses faits par le thread de chargement (None si les reglages n'etaient pas connus)
+    '''
+    if estimate is not None:
+      # Reutilisee au depart du cycle tant que les reglages de Grbl ne changent pas (cf. programEstimate())
+      self.__estimate         = estimate
+      self.__estimateProgram  = program
+      self.__estimateSettings = estimate.settings()
+      message = self.tr("Estimated cycle time: {}").format(formatDuration(estimate.total()))
+      if len(estimate.tools()) > 1:
+        for tool, duree in estimate.tools():
+          message += "\n" + self.tr("  Tool {}: {}").format(tool, formatDuration(duree))
+      self.log(logSeverity.info.value, message)
+    if report is not None:
+      self.logTravelCheck(report)
 
-      self.__pBox.setComment(self.tr("GCode finished at: {}").format(datetime.now().strftime("%A %x %H:%M:%S")))
 
+  @pyqtSlot(int)
+  def on_cycle_state(self, state: int):
+    ''' Changement d'etat du cycle (cn5XCycle) '''
+    if state == CYCLE_FINISHED:
+      self.log(logSeverity.info.value, self.tr("Cycle completed."))
+      self.__pBox.setComment(self.tr("GCode finished at: {}").format(datetime.now().strftime("%A %x %H:%M:%S")))
+    elif state == CYCLE_ABORTED:
+      self.log(logSeverity.info.value, self.tr("Cycle stopped."))
+    if state in [CYCLE_FINISHED, CYCLE_ABORTED]:
+      self.timerProgress.stop()
+      self.refreshProgress()
+      self.__lastLineSent = -1
       self.ui.btnStart.setButtonStatus(False)
       self.ui.btnPause.setButtonStatus(False)
       self.ui.btnStop.setButtonStatus(True)
-      
-      self.__cycleRun = False
-
+      # Masque de la boite de progression
       if self.__pBox.isVisible():
         if self.__pBox.autoClose():
           self.__pBox.stop()
@@ -2785,58 +3047,24 @@ class winMain(QtWidgets.QMainWindow):
       self.log(logSeverity.warning.value, self.tr("Holding in progress, can't restart now."))
     if self.ui.lblEtat.text() == GRBL_STATUS_HOLD0:
       self.log(logSeverity.info.value, self.tr("Resuming cycle..."))
-      self.__grblCom.realTimePush(REAL_TIME_CYCLE_START_RESUME)
-      self.__cyclePause = False
+      self.__cycle.resume()
       self.ui.btnStart.setButtonStatus(True)
       self.ui.btnPause.setButtonStatus(False)
       self.ui.btnStop.setButtonStatus(False)
     else:
       self.log(logSeverity.info.value, self.tr("Holding cycle..."))
-      self.__grblCom.realTimePush(REAL_TIME_FEED_HOLD)
-      self.__cyclePause = True
+      self.__cycle.pause()
       self.ui.btnStart.setButtonStatus(False)
       self.ui.btnPause.setButtonStatus(True)
       self.ui.btnStop.setButtonStatus(False)
 
 
   def stopCycle(self):
-    if self.ui.lblEtat.text() == GRBL_STATUS_HOLD0:
-      # Deja en pause, on vide la file d'attente et on envoie un SoftReset
-      self.log(logSeverity.info.value, self.tr("Stopping cycle..."))
-      self.__grblCom.clearCom() # Vide la file d'attente de communication
-      self.__grblCom.realTimePush(REAL_TIME_SOFT_RESET) # Envoi Ctrl+X.
-    elif self.ui.lblEtat.text() == GRBL_STATUS_HOLD1:
-      # Attente que le Hold soit termine
-      self.log(logSeverity.info.value, self.tr("Holding cycle before stopping..."))
-      while self.ui.lblEtat.text() == GRBL_STATUS_HOLD1:
-        QCoreApplication.processEvents()
-      # Puis, vide la file d'attente et envoie un SoftReset
-      self.log(logSeverity.info.value, self.tr("Stopping cycle..."))
-      self.__grblCom.clearCom() # Vide la file d'attente de communication
-      self.__grblCom.realTimePush(REAL_TIME_SOFT_RESET) # Envoi Ctrl+X.
-    else:
-      # Envoie une pause
-      self.log(logSeverity.info.value, self.tr("Holding cycle before stopping..."))
-      self.__grblCom.realTimePush(REAL_TIME_FEED_HOLD)
-      # Attente que le Hold soit termine
-      while self.ui.lblEtat.text() != GRBL_STATUS_HOLD0:
-        QCoreApplication.processEvents()
-      # Puis, vide la file d'attente et envoie un SoftReset
-      self.log(logSeverity.info.value, self.tr("Stopping cycle..."))
-      self.__grblCom.clearCom() # Vide la file d'attente de communication
-      self.__grblCom.realTimePush(REAL_TIME_SOFT_RESET) # Envoi Ctrl+X.
-    self.__cycleRun = False
-    self.__cyclePause = False
-    # Masque de la boite de progression
-    if self.__pBox.isVisible():
-      if self.__pBox.autoClose():
-        self.__pBox.stop()
-      else:
-        self.__pBox.enableClose()
-    self.ui.btnStart.setButtonStatus(False)
-    self.ui.btnPause.setButtonStatus(False)
-    self.ui.btnStop.setButtonStatus(True)
-    self.log(logSeverity.info.value, self.tr("Cycle stopped."))
+    '''
+    Feed hold puis, une fois le mouvement arrete, vidage de la file d'attente et soft reset.
+    Sans attente active : la fin de l'arret est signalee par on_cycle_state(CYCLE_ABORTED).
+    '''
+    self.__cycle.stop()
 
 
   def on_gcodeTableContextMenu(self, event):
@@ -3139,6 +3367,9 @@ class winMain(QtWidgets.QMainWindow):
 
 
 if __name__ == '__main__':
+
+  # Processus d'analyse des fichiers GCode dans l'executable gele (cx_Freeze)
+  multiprocessing.freeze_support()
   
   # Suppress qt.qpa.xcb: QXcbConnection: XCB error: 3 (BadWindow)
   os.environ["QT_LOGGING_RULES"] = '*.debug=false;qt.qpa.*=false'
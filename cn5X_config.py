@@ -34,7 +34,11 @@ DEFAULT_AXIS_NAMES = ['X', 'Y', 'Z']
 
 COM_DEFAULT_BAUD_RATE = 115200
 SERIAL_READ_TIMEOUT   = 250      # ms
-GRBL_QUERY_DELAY      =  75      # ms
+CONNECT_TIMEOUT       = 3000     # ms, delai de connexion TCP (tcp://hote:port)
+GRBL_QUERY_DELAY      =  75      # ms, interrogation a frequence fixe (polling adaptatif desactive)
+GRBL_QUERY_DELAY_RUN  =  50      # ms, polling adaptatif : machine en mouvement (Run, Jog, Home...)
+GRBL_QUERY_DELAY_IDLE = 500      # ms, polling adaptatif : machine a l'arret (Idle, Alarm, Sleep...)
+COM_BATCH_DELAY       =  20      # ms, delai maxi de regroupement des signaux du thread de communication
 
 DEFAULT_JOG_SPEED     = 300
 
@@ -69,6 +73,7 @@ CMD_GRBL_RESET_SETTINGS        = "$RST=$"
 CMD_GRBL_RESET_OFFSETS         = "$RST=#"
 CMD_GRBL_RESET_ALL_EEPROM      = "$RST=*"
 CMD_GRBL_SLEEP                 = "$SLP"
+CMD_GRBL_DWELL_SYNC            = "G4 P0" # Tempo nulle : acquittee une fois les mouvements precedents termines
 
 ''' Grbl v1.1 Realtime commands '''
 REAL_TIME_SOFT_RESET           = chr(0x18) # Ctrl+X
@@ -119,6 +124,30 @@ COM_FLAG_NO_FLAG  = 0
 COM_FLAG_NO_OK    = 1
 COM_FLAG_NO_ERROR = 2
 
+COM_NO_LINE_INDEX = -1 # Commande sans ligne source dans le fichier GCode
+
+''' Modes d'envoi (streaming) du GCode vers Grbl '''
+STREAMING_PING_PONG     = 0   # Envoi d'une ligne puis attente du ok ou error (Simple Send-Response)
+STREAMING_CHAR_COUNTING = 1   # Remplissage du buffer de reception de Grbl (Character-Counting)
+GRBL_RX_BUFFER_SIZE     = 128 # Taille du buffer de reception serie de Grbl (octets)
+FEEDER_WINDOW_LINES     = 200 # Nombre maxi de lignes du programme en attente d'acquittement dans grblCom
+GCODE_STATE_RECONCILE_LINES = 500 # Envoi d'un $G toutes les n lignes du programme pour recaler l'etat modal suivi localement
+GCODE_STATE_REFRESH_DELAY   = 100 # ms, delai de regroupement des mises a jour de l'affichage de l'etat modal
+PROGRESS_REFRESH_DELAY      = 100 # ms, delai de regroupement des mises a jour de la ligne en cours et de la progressBox
+GCODE_LOADER_BLOCK          = 1024 * 1024 # Taille des blocs indexes par le thread de chargement des fichiers GCode (octets)
+GCODE_LOADER_EMIT_DELAY     = 250 # ms, delai mini entre deux envois de lignes du thread de chargement vers la liste
+GCODE_PARSE_PROCESSES       = 0   # Nombre de processus pour l'analyse des gros fichiers GCode (0 : un par coeur)
+GCODE_PARSE_PARALLEL_MIN    = 32 * 1024 * 1024 # Taille mini des fichiers GCode analyses en parallele (octets)
+GCODE_PARSE_CHUNK           = 4 * 1024 * 1024  # Taille des troncons de fichier confies a chaque processus d'analyse (octets)
+GCODE_CACHE_MAX_SIZE        = 1024 * 1024 * 1024 # Taille maxi du cache disque des fichiers GCode analyses (octets, 0 : pas de cache)
+GCODE_CACHE_MIN_SIZE        = 1024 * 1024 # Taille mini des fichiers GCode conserves dans le cache (octets)
+GCODE_ESTIMATE_PLANNER_BLOCKS = 35  # Blocs utilisables du planificateur de Grbl (Bf: de grbl-Mega-5X), limite l'anticipation des vitesses
+GCODE_ESTIMATE_ARC_TOLERANCE  = 0.002 # mm, tolerance des arcs ($12) si Grbl ne l'a pas renvoyee
+GCODE_TRAVEL_REPORT_LINES     = 10    # Nombre maxi de lignes hors courses signalees par le controle avant cycle
+GCODE_MERGE_TOLERANCE         = 0.005 # mm (ou degres), ecart maxi par defaut de la fusion des mouvements colineaires
+GCODE_ARC_FIT_TOLERANCE       = 0.005 # mm, ecart maxi par defaut entre les segments remplaces et l'arc (G2/G3)
+GCODE_ARC_FIT_MIN_SEGMENTS    = 4     # Nombre mini de segments G1 remplaces par un arc
+
 ''' qtabMain indexes '''
 CN5X_TAB_MAIN     = 0
 CN5X_TAB_PROBE_XY = 1
@@ -129,6 +158,7 @@ CN5X_TAB_GRBL     = 0
 CN5X_TAB_FILE     = 1
 CN5X_TAB_LOG      = 2
 CN5X_TAB_DEBUG    = 3
+CN5X_TAB_DIAG     = 4
 
 ''' Probe defaults parameters '''
 DEFAULT_TOOL_DIAMATER                   = 3
@@ -155,6 +185,9 @@ DEFAULT_TOOLCHANGE_POSITION_Z           = -5
 DEFAULT_TOOLCHANGE_POSITION_X           = -5
 DEFAULT_TOOLCHANGE_POSITION_Y           = -5
 
+''' Commandes GCode provoquant une ecriture en EEPROM dans Grbl '''
+GCODE_EEPROM_WRITE_CMD = ["G10", "G28.1", "G30.1"]
+
 ''' Valeurs renvoyées par grblDecode.waitForGrblReply() et grblDecode.waitForGrblProbe() '''
 SIG_OK    = 0
 SIG_ERROR = 2
@@ -0,0 +1,203 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+from PyQt6.QtCore import QObject, pyqtSignal, pyqtSlot
+from cn5X_config import *
+from grblCom import grblCom
+
+''' Etats d'un cycle (execution d'un programme GCode) '''
+CYCLE_IDLE      = 0 # Aucun cycle lance
+CYCLE_QUEUED    = 1 # Lignes confiees a grblCom, Grbl n'a pas encore demarre
+CYCLE_STREAMING = 2 # Grbl execute le programme, des lignes restent a lui envoyer
+CYCLE_RUNNING   = 3 # Toutes les lignes sont envoyees, Grbl termine les derniers mouvements
+CYCLE_HOLDING   = 4 # Pause (feed hold) en cours ou effective
+CYCLE_FINISHED  = 5 # Programme termine, Grbl est revenu au repos
+CYCLE_ABORTED   = 6 # Cycle interrompu (stop, erreur, alarme, deconnexion)
+
+CYCLE_ACTIVE_STATES = [CYCLE_QUEUED, CYCLE_STREAMING, CYCLE_RUNNING, CYCLE_HOLDING]
+
+
+class cn5XCycle(QObject):
+  '''
+  Machine a etats du cycle d'usinage, pilotee uniquement par les signaux de grblCom
+  (status reports, lignes envoyees et acquittees, alarmes) : aucune boucle d'attente,
+  le thread de l'interface ne travaille qu'a la reception des evenements.
+  Les lignes du programme doivent etre envoyees via gcodePush() de cet objet
+  (meme interface que grblCom) avec leur index pour que le cycle sache combien
+  d'acquittements attendre. Seules les lignes indexees sont comptees (sig_lineSent,
+  sig_lineAcked) : les reponses aux autres commandes ($G, $I, jog...) sont ignorees.
+  '''
+
+  sig_state = pyqtSignal(int) # Emis a chaque changement d'etat, renvoie le nouvel etat CYCLE_XXX
+  sig_log   = pyqtSignal(int, str)
+
+  def __init__(self, com: grblCom):
+    super().__init__()
+    self.__com           = com
+    self.__state         = CYCLE_IDLE
+    self.__enQueued      = False # Toutes les lignes du programme ont ete confiees a grblCom
+    self.__nbLines       = 0     # Nombre de lignes du programme (indexees) a acquitter
+    self.__nbSent        = 0     # Nombre de lignes du programme envoyees a Grbl (sig_lineSent)
+    self.__nbAcked       = 0     # Nombre de lignes du programme acquittees (sig_lineAcked)
+    self.__stopRequested = False # Arret demande : attente de la fin du feed hold avant le soft reset
+
+    self.__com.sig_status.connect(self.on_sig_status)
+    self.__com.sig_lineSent.connect(self.on_sig_lineSent)
+    self.__com.sig_lineAcked.connect(self.on_sig_lineAcked)
+    self.__com.sig_alarm.connect(self.on_sig_alarm)
+    self.__com.sig_connect.connect(self.on_sig_connect)
+
+
+  def state(self):
+    return self.__state
+
+
+  def isActive(self):
+    ''' Vrai entre le lancement du cycle et sa fin (normale ou non) '''
+    return self.__state in CYCLE_ACTIVE_STATES
+
+
+  def isHolding(self):
+    return self.__state == CYCLE_HOLDING
+
+
+  def __setState(self, state: int):
+    if state != self.__state:
+      self.__state = state
+      self.sig_state.emit(state)
+
+
+  def begin(self):
+    ''' Debut d'un nouveau cycle, les lignes seront ensuite envoyees par gcodePush() puis enQueued() '''
+    self.__enQueued      = False
+    self.__nbLines       = 0
+    self.__nbSent        = 0
+    self.__nbAcked       = 0
+    self.__stopRequested = False
+    self.__setState(CYCLE_QUEUED)
+
+
+  def gcodePush(self, buff: str, flag = COM_FLAG_NO_FLAG, index: int = COM_NO_LINE_INDEX):
+    ''' Envoi d'une ligne (compte les lignes du programme, avec index, qui seront acquittees) '''
+    if index != COM_NO_LINE_INDEX:
+      self.__nbLines += 1
+    self.__com.gcodePush(buff, flag, index)
+
+
+  def enQueued(self):
+    ''' Toutes les lignes du programme ont ete envoyees par gcodePush() '''
+    self.__enQueued = True
+    self.__checkEnd(self.__com.grblStatus())
+
+
+  def pause(self):
+    ''' Feed hold '''
+    self.__com.realTimePush(REAL_TIME_FEED_HOLD)
+
+
+  def resume(self):
+    self.__com.realTimePush(REAL_TIME_CYCLE_START_RESUME)
+
+
+  def stop(self):
+    '''
+    Arret du cycle (ou des commandes en cours hors cycle) : feed hold puis, une fois
+    le mouvement arrete (Hold:0), vidage de la file d'attente et soft reset.
+    '''
+    if self.__com.grblStatus() in [GRBL_STATUS_RUN, GRBL_STATUS_JOG, GRBL_STATUS_HOLD1]:
+      self.sig_log.emit(logSeverity.info.value, self.tr("Holding cycle before stopping..."))
+      self.__stopRequested = True
+      if self.__com.grblStatus() != GRBL_STATUS_HOLD1:
+        self.__com.realTimePush(REAL_TIME_FEED_HOLD)
+      self.__setState(CYCLE_HOLDING)
+    else:
+      self.__abort(True)
+
+
+  def __abort(self, reset: bool):
+    ''' Vide la file d'attente de communication (et envoie un soft reset si reset) '''
+    self.__com.clearCom()
+    if reset:
+      self.sig_log.emit(logSeverity.info.value, self.tr("Stopping cycle..."))
+      self.__com.realTimePush(REAL_TIME_SOFT_RESET) # Envoi Ctrl+X.
+    self.__stopRequested = False
+    self.__setState(CYCLE_ABORTED)
+
+
+  def __checkEnd(self, etat: str):
+    ''' Fin du cycle : toutes les lignes envoyees et acquittees et Grbl au repos '''
+    if self.__enQueued and self.__nbAcked >= self.__nbLines and etat in [GRBL_STATUS_IDLE, GRBL_STATUS_CHECK]:
+      self.__setState(CYCLE_FINISHED)
+      return True
+    return False
+
+
+  @pyqtSlot(str)
+  def on_sig_status(self, data: str):
+    if not self.isActive():
+      return
+    etat = self.__com.grblStatus()
+    if etat in [GRBL_STATUS_HOLD0, GRBL_STATUS_HOLD1]:
+      if self.__stopRequested and etat == GRBL_STATUS_HOLD0:
+        self.__abort(True)
+      else:
+        self.__setState(CYCLE_HOLDING)
+    elif etat in [GRBL_STATUS_RUN, GRBL_STATUS_CHECK]:
+      if self.__checkEnd(etat):
+        return
+      if self.__enQueued and self.__nbSent >= self.__nbLines:
+        self.__setState(CYCLE_RUNNING)
+      else:
+        self.__setState(CYCLE_STREAMING)
+    elif etat == GRBL_STATUS_IDLE:
+      if not self.__checkEnd(etat) and self.__state == CYCLE_HOLDING:
+        # Reprise apres une pause, en attente des lignes suivantes
+        self.__setState(CYCLE_STREAMING)
+
+
+  @pyqtSlot(int)
+  def on_sig_lineSent(self, index: int):
+    if self.isActive() and index != COM_NO_LINE_INDEX:
+      self.__nbSent += 1
+
+
+  @pyqtSlot(int, int)
+  def on_sig_lineAcked(self, index: int, errNum: int):
+    if not self.isActive() or index == COM_NO_LINE_INDEX:
+      return
+    self.__nbAcked += 1
+    if errNum != 0:
+      # Une erreur sur une ligne du programme interrompt le cycle
+      self.__abort(False)
+
+
+  @pyqtSlot(int)
+  def on_sig_alarm(self, alarmNum: int):
+    if self.isActive():
+      self.__abort(False)
+
+
+  @pyqtSlot()
+  def on_sig_connect(self):
+    if self.isActive() and not self.__com.isOpen():
+      self.__setState(CYCLE_ABORTED)
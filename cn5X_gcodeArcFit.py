@@ -0,0 +1,333 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import numpy as np
+from cn5X_config import *
+from cn5X_gcodeProgram import *
+from cn5X_gcodeTrajectory import *
+
+''' Rayon maxi des arcs (mm), au dela les points sont consideres comme alignes '''
+ARC_FIT_MAX_RADIUS = 2000.0
+
+''' Angle maxi parcouru entre deux points d'un arc (radians) '''
+ARC_FIT_MAX_STEP = 0.5 * np.pi
+
+''' Angle maxi parcouru par un arc (radians), les suites plus longues sont coupees avant d'etre testees '''
+ARC_FIT_MAX_ANGLE = np.pi
+
+''' Nombre maxi de passes de decoupage des suites de points qui ne forment pas un arc '''
+ARC_FIT_MAX_PASSES = 64
+
+''' Decimales des mots ecrits en G21 et en G20 '''
+ARC_FIT_DECIMALS = {1.0: 4, TRAJECTORY_MM_PER_INCH: 5}
+
+''' Lignes qui ne peuvent pas recevoir un G1 pour retablir le mode de mouvement apres un arc '''
+ARC_FIT_NO_RESTORE = PROGRAM_FLAG_SYSTEM | PROGRAM_FLAG_INVALID | PROGRAM_FLAG_NON_MODAL | PROGRAM_FLAG_TOOL_CHANGE | PROGRAM_FLAG_PAUSE
+
+
+def formatWord(letter: str, value: float, decimals: int):
+  ''' Mot GCode sans zeros inutiles : formatWord('X', 12.5, 4) -> 'X12.5' '''
+  text = "{:.{}f}".format(value, decimals).rstrip('0').rstrip('.')
+  if text in ["", "-", "-0"]:
+    text = "0"
+  return letter + text
+
+
+def exactWord(letter: str, value: float):
+  '''
+  Mot GCode avec le texte le plus court qui redonne exactement la valeur lue dans le
+  fichier : exactWord('X', 1234.5678) -> 'X1234.5678', exactWord('X', 10.0) -> 'X10'
+  '''
+  text = np.format_float_positional(value, trim='-')
+  if text == "-0":
+    text = "0"
+  return letter + text
+
+
+class gcodeArcFitResult():
+  ''' Resultat de gcodeArcFit.fit() '''
+
+  def __init__(self, lineCount: int, rows, arcs: dict, restores: list):
+    self.__lineCount = lineCount
+    self.__rows      = rows     # Numeros des lignes conservees (numpy, croissants)
+    self.__arcs      = arcs     # Nouveau numero de ligne -> texte de l'arc (G2/G3) qui la remplace
+    self.__restores  = restores # Nouveaux numeros des lignes a faire preceder de G1 (retour au mode G1 apres un arc)
+
+
+  def lineCount(self):
+    ''' Nombre de lignes du programme d'origine '''
+    return self.__lineCount
+
+
+  def rows(self):
+    return self.__rows
+
+
+  def arcs(self):
+    return dict(self.__arcs)
+
+
+  def restores(self):
+    return list(self.__restores)
+
+
+  def arcCount(self):
+    return len(self.__arcs)
+
+
+  def isEmpty(self):
+    return len(self.__arcs) == 0
+
+
+class gcodeArcFit():
+  '''
+  Remplacement des suites de G1 dont les points sont sur un cercle du plan actif (G17,
+  G18, G19) par un seul G2 ou G3 avec les mots I, J, K du centre (relatifs au point de
+  depart, comme les attend Grbl), calcule avec NumPy sur le programme complet.
+  - Les lignes remplacees sont des G1 simples (cf. gcodeTrajectory.plainMoves()), sans
+    commentaire, a la meme vitesse F, dans le meme plan et les memes unites, sans
+    deplacement des autres axes. Les suites sont coupees aux changements de sens de
+    rotation, aux angles de plus de 90 degres et tous les demi-tours.
+  - Chaque suite est testee sur le cercle qui passe par ses extremites et son point du
+    milieu : l'ecart entre chaque segment et l'arc correspondant (ecart radial de ses
+    extremites + fleche de la corde) doit rester inferieur a la tolerance. Les suites
+    refusees sont coupees au point le plus eloigne du cercle et testees a nouveau.
+  - Les mots d'axes de l'arc sont ceux de la derniere ligne de la suite, reecrits avec leur
+    valeur exacte : le point d'arrivee programme ne bouge pas. Les mots I, J, K sont
+    calcules en float64 depuis les valeurs du fichier.
+  - La ligne qui suit un arc repasse en G1 si elle ne donne pas elle-meme son mode de
+    mouvement. Si elle ne peut pas recevoir de G1 (commande systeme, G92, M6...), la
+    derniere ligne de la suite n'est pas remplacee et sert a ce retour en G1.
+  '''
+
+  def __init__(self, tolerance: float, minSegments: int = GCODE_ARC_FIT_MIN_SEGMENTS):
+    self.__tolerance   = tolerance
+    self.__minSegments = max(2, minSegments)
+
+
+  def fit(self, program, trajectory = None):
+    ''' Arcs trouves dans le programme (gcodeArcFitResult) '''
+    n = len(program)
+    if trajectory is None:
+      trajectory = gcodeTrajectory(program, [axis for axis in TRAJECTORY_AXES if program.column(axis) is not None])
+    axes = trajectory.axes()
+    if n < self.__minSegments or len(axes) < 2:
+      return gcodeArcFitResult(n, np.arange(n), {}, [])
+    positions = trajectory.positions()
+    plane     = trajectory.plane()
+    scale     = trajectory.scale()
+    flags     = trajectory.flags()
+    opcode    = np.frombuffer(program.opcodeColumn(), dtype=np.int16)
+    feed      = trajectory.values('F', False)
+    feed      = np.zeros(n) if feed is None else fillColumn(feed, None, 0.0)
+    words     = [(axis, np.frombuffer(program.column(axis), dtype=np.float64)) for axis in axes if program.column(axis) is not None]
+
+    # Axes du plan de chaque ligne, les autres axes ne doivent pas bouger
+    eligible = trajectory.plainMoves() & (flags == 0)
+    axis0 = np.zeros(n, dtype=np.int64)
+    axis1 = np.zeros(n, dtype=np.int64)
+    inPlane = np.zeros(n, dtype=bool)
+    delta = positions[1:] - positions[:-1]
+    for p, (a0, a1, o0, o1) in TRAJECTORY_PLANES.items():
+      if a0 not in axes or a1 not in axes:
+        continue
+      k = np.nonzero(plane == p)[0]
+      i0, i1 = axes.index(a0), axes.index(a1)
+      others = [i for i in range(len(axes)) if i not in [i0, i1]]
+      axis0[k] = i0
+      axis1[k] = i1
+      inPlane[k] = np.all(delta[k][:, others] == 0, axis=1) if len(others) > 0 else True
+    lignes = np.arange(n)
+    d0 = delta[lignes, axis0]
+    d1 = delta[lignes, axis1]
+    eligible &= inPlane & ((d0 != 0) | (d1 != 0))
+
+    # Suites de lignes : meme plan, F et unites, rotation dans le meme sens a chaque point
+    cross = d0[:-1] * d1[1:] - d1[:-1] * d0[1:]
+    dot   = d0[:-1] * d0[1:] + d1[:-1] * d1[1:]
+    link  = eligible[:-1] & eligible[1:] & (plane[:-1] == plane[1:]) & (feed[:-1] == feed[1:]) \
+            & (scale[:-1] == scale[1:]) & (cross != 0) & (dot > 0)
+    sens  = np.sign(cross)
+    link[1:] &= ~(link[:-1] & (sens[1:] != sens[:-1]))
+
+    # Suites coupees tous les ARC_FIT_MAX_ANGLE de changement de direction cumule
+    turn = np.where(link, np.abs(np.arctan2(cross, dot)), 0.0)
+    cumul = np.concatenate(([0.0], np.cumsum(turn)))
+    premier = np.maximum.accumulate(np.where(np.concatenate(([True], ~link)), np.arange(n), 0))
+    tranche = np.floor((cumul - cumul[premier]) / ARC_FIT_MAX_ANGLE)
+    link &= tranche[1:] == tranche[:-1]
+    linked = np.concatenate(([False], link)) # Ligne reliee a la precedente
+    follow = np.concatenate((link, [False])) # Ligne reliee a la suivante
+    starts = np.nonzero(eligible & ~linked)[0]
+    ends   = np.nonzero(eligible & ~follow)[0]
+
+    # La ligne qui suit la derniere suite doit pouvoir repasser en G1
+    after = ends + 1
+    blocked = after < n
+    blocked[blocked] = (opcode[after[blocked]] == PROGRAM_NO_MOTION) & ((flags[after[blocked]] & ARC_FIT_NO_RESTORE) != 0)
+    ends = np.where(blocked, ends - 1, ends)
+
+    # Test des suites, decoupage de celles qui ne forment pas un arc
+    accepted = []
+    for passe in range(ARC_FIT_MAX_PASSES):
+      garde = ends - starts + 1 >= self.__minSegments
+      starts, ends = starts[garde], ends[garde]
+      if len(starts) == 0:
+        break
+      ok, split, center = self.__check(positions, axis0[starts], axis1[starts], starts, ends)
+      accepted.append((starts[ok], ends[ok], center[ok]))
+      refus = ~ok
+      starts, ends, split = starts[refus], ends[refus], split[refus]
+      starts, ends = np.concatenate((starts, starts + split)), np.concatenate((starts + split - 1, ends))
+    if len(accepted) == 0:
+      return gcodeArcFitResult(n, np.arange(n), {}, [])
+    starts = np.concatenate([s for s, e, c in accepted])
+    ends   = np.concatenate([e for s, e, c in accepted])
+    center = np.concatenate([c for s, e, c in accepted])
+    ordre = np.argsort(starts)
+    starts, ends, center = starts[ordre], ends[ordre], center[ordre]
+    if len(starts) == 0:
+      return gcodeArcFitResult(n, np.arange(n), {}, [])
+
+    # Lignes conservees : la derniere ligne de chaque suite devient l'arc
+    cover = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(cover, starts, 1)
+    np.add.at(cover, ends, -1)
+    rows = np.nonzero(np.cumsum(cover[:n]) == 0)[0]
+
+    # Texte des arcs et lignes a repasser en G1
+    arcs = {}
+    restores = []
+    arcStarts = set(starts.tolist())
+    for s, e, (c0, c1, angle) in zip(starts.tolist(), ends.tolist(), center.tolist()):
+      a0, a1, o0, o1 = TRAJECTORY_PLANES[plane[e]]
+      i0, i1 = axis0[e], axis1[e]
+      k = scale[e]
+      decimals = ARC_FIT_DECIMALS.get(k, 4)
+      texte = ["G2" if angle < 0 else "G3"]
+      texte += [exactWord(axis, column[e]) for axis, column in words if not np.isnan(column[e])]
+      texte += [formatWord(o0, (c0 - positions[s, i0]) / k, decimals),
+                formatWord(o1, (c1 - positions[s, i1]) / k, decimals)]
+      if feed[e] > 0:
+        texte.append(exactWord('F', feed[e]))
+      row = int(np.searchsorted(rows, e))
+      arcs[row] = " ".join(texte)
+      if e + 1 < n and opcode[e + 1] == PROGRAM_NO_MOTION and e + 1 not in arcStarts:
+        restores.append(row + 1)
+    return gcodeArcFitResult(n, rows, arcs, restores)
+
+
+  def __check(self, positions, axis0, axis1, starts, ends):
+    '''
+    Test des suites de lignes starts[i]..ends[i] sur le cercle passant par leurs extremites
+    et leur point du milieu. Renvoie (suites acceptees, point de decoupage des autres
+    (rang dans la suite), [centre axe 0, centre axe 1, angle parcouru] de chaque suite).
+    '''
+    m = ends - starts + 1 # Nombre de segments
+    taille = m + 1        # Nombre de points
+    first = np.cumsum(taille) - taille
+    gid = np.repeat(np.arange(len(starts)), taille)
+    rang = np.arange(int(taille.sum())) - first[gid]
+    points = starts[gid] + rang
+    u = positions[points, axis0[gid]]
+    v = positions[points, axis1[gid]]
+
+    # Cercle passant par le premier point, le point du milieu et le dernier point
+    u0, v0 = u[first], v[first]
+    bu, bv = u[first + m // 2] - u0, v[first + m // 2] - v0
+    cu, cv = u[first + m] - u0, v[first + m] - v0
+    with np.errstate(divide='ignore', invalid='ignore'):
+      d = 2.0 * (bu * cv - bv * cu)
+      ou = (cv * (bu * bu + bv * bv) - bv * (cu * cu + cv * cv)) / d
+      ov = (bu * (cu * cu + cv * cv) - cu * (bu * bu + bv * bv)) / d
+      radius = np.hypot(ou, ov)
+      valid = (d != 0) & (radius <= ARC_FIT_MAX_RADIUS)
+
+      # Ecart radial de chaque point, angle parcouru et fleche de chaque segment
+      ru = u - (u0 + ou)[gid]
+      rv = v - (v0 + ov)[gid]
+      ecart = np.abs(np.hypot(ru, rv) - radius[gid])
+      debut = rang == 0
+      angle = np.zeros(len(u))
+      angle[1:] = np.arctan2(ru[:-1] * rv[1:] - rv[:-1] * ru[1:], ru[:-1] * ru[1:] + rv[:-1] * rv[1:])
+      corde = np.zeros(len(u))
+      corde[1:] = np.hypot(u[1:] - u[:-1], v[1:] - v[:-1])
+      r = radius[gid]
+      fleche = r - np.sqrt(np.maximum(r * r - 0.25 * corde * corde, 0.0))
+      borne = np.zeros(len(u))
+      borne[1:] = np.maximum(ecart[:-1], ecart[1:]) + fleche[1:]
+      borne[debut] = 0.0
+      angle[debut] = 0.0
+
+      erreur = np.maximum.reduceat(borne, first)
+      mini   = np.minimum.reduceat(np.where(debut, np.inf, angle), first)
+      maxi   = np.maximum.reduceat(np.where(debut, -np.inf, angle), first)
+      total  = np.add.reduceat(angle, first)
+      ok = valid & (erreur <= self.__tolerance) & ((mini > 0) | (maxi < 0)) \
+           & (np.maximum(np.abs(mini), np.abs(maxi)) <= ARC_FIT_MAX_STEP) & (np.abs(total) < 2.0 * np.pi - 1e-3)
+
+      # Decoupage au point interieur le plus eloigne du cercle, au milieu a defaut
+      interieur = ~debut & (rang < m[gid]) & ~np.isnan(ecart)
+      pire = np.maximum.reduceat(np.where(interieur, ecart, -1.0), first)
+      candidat = np.where(interieur & (ecart == pire[gid]), rang, np.iinfo(np.int64).max)
+      split = np.minimum.reduceat(candidat, first)
+      split = np.where((pire > 0) & (split < m), split, m // 2)
+    return ok, split, np.column_stack((u0 + ou, v0 + ov, total))
+
+
+if __name__ == '__main__':
+  import sys, time, math
+  # Verification : les points d'arrivee des arcs sont ceux du fichier, au chiffre pres
+  lignes = ["G21 G90 G17", "G0 X1234.5678 Y896.5432", "G1 F812.25"]
+  for i in range(1, 91):
+    angle = i * math.pi / 90
+    lignes.append("X{:.6f} Y{:.6f}".format(1214.5678 + 20.0 * math.cos(angle), 896.5432 + 20.0 * math.sin(angle)))
+  lignes[-1] = "X1194.5678 Y896.5432"
+  program = gcodeProgram()
+  program.appendBlock("\n".join(lignes).encode())
+  result = gcodeArcFit(GCODE_ARC_FIT_TOLERANCE).fit(program)
+  assert result.arcs() == {3: "G3 X1194.5678 Y896.5432 I-20 J0 F812.25"}, result.arcs()
+  print("Arc fit keeps the programmed end points: {}".format(result.arcs()[3]))
+
+  # Mesure : gcodeArcFit.py [fichier.ngc [tolerance]], par defaut 1 million de points sur des cercles de 20 mm (1 degre par point)
+  tolerance = float(sys.argv[2]) if len(sys.argv) > 2 else GCODE_ARC_FIT_TOLERANCE
+  if len(sys.argv) > 1:
+    with open(sys.argv[1], 'rb') as f:
+      data = f.read().rstrip(b'\n')
+  else:
+    lignes = ["G21 G90 G17", "G0 X20 Y0 Z1", "G1 Z-1 F800"]
+    for i in range(1, 1000001):
+      angle = i * 2.0 * math.pi / 360
+      lignes.append("X{:.4f} Y{:.4f}".format(20.0 * math.cos(angle), 20.0 * math.sin(angle)))
+    lignes.append("M30")
+    data = "\n".join(lignes).encode()
+  program = gcodeProgram()
+  program.appendBlock(data)
+  t0 = time.time()
+  result = gcodeArcFit(tolerance).fit(program)
+  t1 = time.time()
+  fitted = program.select(result.rows().tolist())
+  fitted.replaceLines(result.arcs())
+  t2 = time.time()
+  print("{} -> {} lines ({} arcs) within {} in {:.2f}s (+ {:.2f}s to rebuild the program)".format(
+    len(program), len(fitted), result.arcCount(), tolerance, t1 - t0, t2 - t1))
@@ -0,0 +1,209 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import os, sys, json, mmap, hashlib, tempfile
+from array import array
+from PyQt6.QtCore import QStandardPaths
+from cn5X_config import *
+from cn5X_gcodeProgram import gcodeProgram
+
+''' Entete des fichiers du cache, a changer si l'analyse ou le format evoluent '''
+GCODE_CACHE_MAGIC   = b'CN5XPRG\x01'
+GCODE_CACHE_VERSION = 3
+
+
+class gcodeCache():
+  '''
+  Cache disque des fichiers GCode analyses : index des debuts de lignes et programme
+  pre-analyse (gcodeProgram, avec ses resultats d'analyse summary()), pour qu'un fichier
+  deja ouvert ne soit ni re-indexe ni re-analyse.
+  - Chaque entree est identifiee par l'empreinte (BLAKE2b) et la taille du contenu du fichier ;
+    un alias par chemin, taille et date de modification evite de relire tout le fichier
+    pour calculer l'empreinte quand il n'a pas change.
+  - Format binaire projetable en memoire : entete JSON puis tableaux bruts alignes sur
+    8 octets, relus par mmap sans decodage.
+  - Taille totale limitee a maxSize octets, les entrees les moins recemment utilisees
+    (date de modification du fichier, mise a jour a chaque lecture) sont supprimees.
+  '''
+
+  def __init__(self, cacheDir: str = "", maxSize: int = GCODE_CACHE_MAX_SIZE):
+    if cacheDir == "":
+      cacheDir = os.path.join(QStandardPaths.writableLocation(QStandardPaths.StandardLocation.GenericCacheLocation), APP_NAME, "gcode")
+    self.__dir     = cacheDir
+    self.__maxSize = maxSize
+
+
+  def isEnabled(self):
+    return self.__maxSize > 0
+
+
+  def directory(self):
+    return self.__dir
+
+
+  def __aliasPath(self, filePath: str, stat):
+    alias = hashlib.blake2b("{}|{}|{}".format(os.path.abspath(filePath), stat.st_size, stat.st_mtime_ns).encode('utf-8'), digest_size=16)
+    return os.path.join(self.__dir, alias.hexdigest() + ".key")
+
+
+  def __entryPath(self, key: str):
+    return os.path.join(self.__dir, key + ".prg")
+
+
+  def key(self, filePath: str, mm, canceled = None):
+    '''
+    Cle du contenu du fichier (empreinte-taille), mm est le fichier projete en memoire.
+    L'empreinte n'est calculee que si le fichier a change depuis le dernier appel.
+    canceled() est consulte entre deux blocs lus, la cle vaut "" en cas d'annulation.
+    '''
+    stat = os.stat(filePath)
+    alias = self.__aliasPath(filePath, stat)
+    try:
+      with open(alias, 'r', encoding='ascii') as f:
+        key = f.read().strip()
+      if key != "":
+        return key
+    except OSError:
+      pass
+    empreinte = hashlib.blake2b(digest_size=16)
+    pos = 0
+    while pos < len(mm):
+      if canceled is not None and canceled():
+        return ""
+      empreinte.update(mm[pos:pos + GCODE_LOADER_BLOCK])
+      pos += GCODE_LOADER_BLOCK
+    key = "{}-{}".format(empreinte.hexdigest(), len(mm))
+    try:
+      os.makedirs(self.__dir, exist_ok=True)
+      self.__write(alias, key.encode('ascii'))
+    except OSError:
+      pass # Le cache reste utilisable, l'empreinte sera recalculee
+    return key
+
+
+  def load(self, key: str):
+    ''' Renvoie (index des debuts de lignes, gcodeProgram) de l'entree key, None si absente ou illisible '''
+    path = self.__entryPath(key)
+    try:
+      with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:8] != GCODE_CACHE_MAGIC:
+          return None
+        headerSize = int.from_bytes(mm[8:16], 'little')
+        header = json.loads(mm[16:16 + headerSize].decode('utf-8'))
+        if header["version"] != GCODE_CACHE_VERSION or header["byteorder"] != sys.byteorder:
+          return None
+        arrays = {}
+        for name, typecode, offset, count in header["arrays"]:
+          column = array(typecode)
+          column.frombytes(mm[offset:offset + count * column.itemsize])
+          if len(column) != count:
+            return None # Fichier tronque
+          arrays[name] = column
+      os.utime(path) # Entree la plus recemment utilisee
+      starts = arrays.pop("starts")
+      return starts, gcodeProgram.importState(arrays, header["program"])
+    except (OSError, ValueError, KeyError, TypeError):
+      return None
+
+
+  def save(self, key: str, starts: array, program: gcodeProgram):
+    ''' Enregistre l'entree key puis limite la taille du cache, renvoie False en cas d'erreur '''
+    arrays, meta = program.exportState()
+    arrays = dict(arrays, starts=starts)
+    descriptions = []
+    # Position des tableaux apres l'entete, qui doit etre calculee avant eux : l'entete
+    # est construit une premiere fois pour connaitre sa taille, reservee avec une marge.
+    def entete(debut):
+      descriptions.clear()
+      offset = debut
+      for name, column in arrays.items():
+        descriptions.append([name, column.typecode, offset, len(column)])
+        offset += (len(column) * column.itemsize + 7) // 8 * 8
+      return json.dumps({"version": GCODE_CACHE_VERSION, "byteorder": sys.byteorder, "arrays": descriptions, "program": meta}).encode('utf-8')
+    headerSize = (len(entete(0)) + 64 + 7) // 8 * 8
+    header = entete(16 + headerSize).ljust(headerSize, b' ')
+    try:
+      os.makedirs(self.__dir, exist_ok=True)
+      fd, tmpPath = tempfile.mkstemp(suffix=".tmp", dir=self.__dir)
+      try:
+        with os.fdopen(fd, 'wb') as f:
+          f.write(GCODE_CACHE_MAGIC)
+          f.write(headerSize.to_bytes(8, 'little'))
+          f.write(header)
+          for name, column in arrays.items():
+            data = column.tobytes()
+            f.write(data)
+            f.write(b'\0' * (-len(data) % 8))
+        os.replace(tmpPath, self.__entryPath(key))
+      except OSError:
+        os.remove(tmpPath)
+        raise
+    except OSError:
+      return False
+    self.evict()
+    return True
+
+
+  def __write(self, path: str, data: bytes):
+    fd, tmpPath = tempfile.mkstemp(suffix=".tmp", dir=self.__dir)
+    with os.fdopen(fd, 'wb') as f:
+      f.write(data)
+    os.replace(tmpPath, path)
+
+
+  def evict(self):
+    ''' Supprime les entrees les moins recemment utilisees au dela de maxSize octets, et les alias orphelins '''
+    try:
+      noms = os.listdir(self.__dir)
+    except OSError:
+      return
+    entries = []
+    for nom in noms:
+      if nom.endswith(".prg"):
+        try:
+          stat = os.stat(os.path.join(self.__dir, nom))
+        except OSError:
+          continue
+        entries.append((stat.st_mtime_ns, stat.st_size, nom))
+    entries.sort(reverse=True)
+    total = 0
+    gardees = set()
+    for mtime, taille, nom in entries:
+      total += taille
+      if total <= self.__maxSize:
+        gardees.add(nom[:-4])
+        continue
+      try:
+        os.remove(os.path.join(self.__dir, nom))
+      except OSError:
+        gardees.add(nom[:-4]) # Fichier encore ouvert (Windows)
+    for nom in noms:
+      if nom.endswith(".key"):
+        path = os.path.join(self.__dir, nom)
+        try:
+          with open(path, 'r', encoding='ascii') as f:
+            key = f.read().strip()
+          if key not in gardees:
+            os.remove(path)
+        except OSError:
+          pass
@@ -0,0 +1,349 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import hashlib
+import numpy as np
+from array import array
+from cn5X_config import *
+from cn5X_gcodeModal import MODAL_BITS, MODAL_BIT_PROGRAM_END
+from cn5X_gcodeProgram import *
+from cn5X_gcodeTrajectory import *
+
+''' Constantes du planificateur de Grbl (planner.c) '''
+ESTIMATE_JUNCTION_COS_MAX = 0.999999  # Au dela, demi-tour : vitesse de jonction nulle
+
+''' Lignes sur lesquelles Grbl vide son planificateur avant de continuer (arret complet) '''
+ESTIMATE_STOP_FLAGS = PROGRAM_FLAG_SYSTEM | PROGRAM_FLAG_TOOL_CHANGE | PROGRAM_FLAG_PAUSE | PROGRAM_FLAG_NON_MODAL | PROGRAM_FLAG_INVALID
+ESTIMATE_STOP_BITS  = MODAL_BITS["spindle"] | MODAL_BITS["coolant"] | MODAL_BIT_PROGRAM_END
+
+
+def formatDuration(seconds: float):
+  ''' Duree au format hh:mm:ss '''
+  minutes, secondes = divmod(int(round(seconds)), 60)
+  heures, minutes = divmod(minutes, 60)
+  return "{:02d}:{:02d}:{:02d}".format(heures, minutes, secondes)
+
+
+class gcodeEstimate():
+  '''
+  Resultat de gcodeEstimator.estimate() : duree totale du cycle, repartition par outil
+  et temps cumule ligne par ligne pour l'estimation du temps restant pendant le cycle.
+  '''
+
+  def __init__(self, cumulative, tools: list, moves: int, settings = None):
+    self.__cumulative = cumulative # Temps estime a la fin de chaque ligne (s)
+    self.__tools      = tools      # [(outil, duree en s)] dans l'ordre des numeros d'outil
+    self.__moves      = moves
+    self.__settings   = settings   # Reglages de Grbl de l'estimation (gcodeEstimator.settingsKey())
+
+
+  def total(self):
+    ''' Duree totale estimee (s) '''
+    return float(self.__cumulative[-1]) if len(self.__cumulative) > 0 else 0.0
+
+
+  def tools(self):
+    return list(self.__tools)
+
+
+  def moveCount(self):
+    return self.__moves
+
+
+  def settings(self):
+    ''' Reglages de Grbl utilises (gcodeEstimator.settingsKey()), l'estimation reste valable tant qu'ils ne changent pas '''
+    return self.__settings
+
+
+  def elapsed(self, num: int):
+    ''' Temps estime avant l'execution de la ligne num (s) '''
+    if num <= 0 or len(self.__cumulative) == 0:
+      return 0.0
+    return float(self.__cumulative[min(num, len(self.__cumulative)) - 1])
+
+
+  def remaining(self, num: int):
+    ''' Temps estime restant a partir de la ligne num (s) '''
+    return self.total() - self.elapsed(num)
+
+
+  def toSummary(self, program, key: str):
+    ''' Memorise l'estimation avec le programme (cf. gcodeProgram.setSummary()) sous la cle key '''
+    program.setSummary(key, {"tools": [list(tool) for tool in self.__tools], "moves": self.__moves})
+    program.setSummary(key + ".cumulative", array('d', np.asarray(self.__cumulative, dtype=np.float64).tobytes()))
+
+
+  @classmethod
+  def fromSummary(cls, program, key: str, settings = None):
+    ''' Estimation memorisee par toSummary(), None si absente '''
+    meta = program.summary(key)
+    cumulative = program.summary(key + ".cumulative")
+    if meta is None or cumulative is None:
+      return None
+    return cls(np.frombuffer(cumulative, dtype=np.float64), [tuple(tool) for tool in meta["tools"]], meta["moves"], settings)
+
+
+class gcodeEstimator():
+  '''
+  Estimation de la duree d'un programme pre-analyse (gcodeProgram) en reproduisant le
+  planificateur de Grbl avec ses propres reglages : vitesses maxi ($110...), accelerations
+  ($120...) par axe, deviation de jonction ($11) et tolerance des arcs ($12).
+  Tous les calculs sont faits sur les colonnes completes du programme (NumPy) :
+  - trajectoire programmee (gcodeTrajectory) : positions, mouvements et arcs ;
+  - vitesse nominale et acceleration de chaque mouvement limitees axe par axe, et pour
+    les arcs par les jonctions entre leurs segments ;
+  - vitesse maxi a chaque jonction (deviation de jonction), nulle apres les lignes qui
+    vident le planificateur (broche, arrosage, pause, changement d'outil, commandes $...),
+    et limitee par la distance d'arret couverte par les GCODE_ESTIMATE_PLANNER_BLOCKS
+    blocs du planificateur ;
+  - passes arriere et avant du planificateur : sur les carres des vitesses, ce sont des
+    recurrences min-plus, calculees par minimum cumule sur les sommes cumulees de 2.a.d ;
+  - duree de chaque mouvement (profil trapezoidal), des temporisations (G4) et cumul.
+  Non estimes : changements d'outil, pauses M0/M1, cycles de Grbl ($H, G28, G30), sondages
+  au dela de leur distance programmee, deplacements des lignes non modales (G28, G53...).
+  '''
+
+  def __init__(self, axisNames: list, maxRates: list, accelerations: list, junctionDeviation: float,
+               arcTolerance: float = GCODE_ESTIMATE_ARC_TOLERANCE, laserMode: bool = False, plannerBlocks: int = GCODE_ESTIMATE_PLANNER_BLOCKS):
+    self.__axes      = list(axisNames)
+    self.__rates     = np.array(maxRates, dtype=np.float64) / 60.0    # mm/s
+    self.__accels    = np.array(accelerations, dtype=np.float64)      # mm/s²
+    self.__junction  = float(junctionDeviation)
+    self.__tolerance = float(arcTolerance)
+    self.__laserMode = laserMode
+    self.__blocks    = plannerBlocks
+
+
+  @classmethod
+  def fromDecoder(cls, decoder, axisNames: list):
+    ''' Estimateur construit avec les reglages lus par grblDecode, None s'ils ne sont pas (encore) connus '''
+    try:
+      maxRates      = [float(decoder.getGrblSetting(110 + i)) for i in range(len(axisNames))]
+      accelerations = [float(decoder.getGrblSetting(120 + i)) for i in range(len(axisNames))]
+      junction      = float(decoder.getGrblSetting(11))
+    except (TypeError, ValueError):
+      return None
+    try:
+      tolerance = float(decoder.getGrblSetting(12))
+    except (TypeError, ValueError):
+      tolerance = GCODE_ESTIMATE_ARC_TOLERANCE
+    try:
+      laserMode = int(float(decoder.getGrblSetting(32))) == 1
+    except (TypeError, ValueError):
+      laserMode = False
+    if min(maxRates + accelerations) <= 0:
+      return None
+    return cls(axisNames, maxRates, accelerations, junction, tolerance, laserMode)
+
+
+  def settingsKey(self):
+    ''' Reglages utilises, pour savoir si une estimation est toujours valable '''
+    return (tuple(self.__axes), tuple(self.__rates), tuple(self.__accels), self.__junction, self.__tolerance, self.__laserMode, self.__blocks)
+
+
+  def summaryKey(self):
+    ''' Cle de l'estimation conservee avec le programme : empreinte des reglages ($11, $110..., $120...) '''
+    return "estimate." + hashlib.blake2b(repr(self.settingsKey()).encode('ascii'), digest_size=8).hexdigest()
+
+
+  def estimate(self, program, trajectory = None):
+    ''' Estimation de la duree du programme (gcodeEstimate), a partir de sa trajectoire (gcodeTrajectory) si elle est deja calculee '''
+    n = len(program)
+    if n == 0:
+      return gcodeEstimate(np.zeros(0), [], 0, self.settingsKey())
+    if trajectory is None:
+      trajectory = gcodeTrajectory(program, self.__axes)
+    flags  = trajectory.flags()
+    bits   = trajectory.modalBits()
+    motion = trajectory.motion()
+
+    # Deplacement de chaque mouvement, les mouvements de longueur nulle sont ignores par Grbl
+    m = trajectory.moves()
+    positions = trajectory.positions()
+    delta  = positions[m + 1] - positions[m]
+    length = np.sqrt(np.sum(delta * delta, axis=1))
+    isArc  = np.isin(motion[m], [TRAJECTORY_ARC_CW, TRAJECTORY_ARC_CCW])
+    keep   = (length > 0) | isArc
+    m, delta, length, isArc = m[keep], delta[keep], length[keep], isArc[keep]
+    safeLength = np.where(length > 0, length, 1.0)
+    startUnit  = delta / safeLength[:, None]
+    endUnit    = startUnit.copy()
+    envelope   = np.abs(startUnit) # Composantes maxi par axe, pour les limites de vitesse et d'acceleration
+    arcLimit   = np.full(len(m), np.inf) # Carre de la vitesse maxi dans les arcs
+    k = np.nonzero(isArc)[0]
+    if len(k) > 0:
+      self.__arcs(trajectory, k, m, delta, length, startUnit, endUnit, envelope, arcLimit)
+    keep = length > 0
+    m, length, startUnit, endUnit, envelope, arcLimit = m[keep], length[keep], startUnit[keep], endUnit[keep], envelope[keep], arcLimit[keep]
+
+    # Vitesse nominale et acceleration, limitees axe par axe
+    with np.errstate(divide='ignore'):
+      rateLimit  = np.min(np.where(envelope > 0, self.__rates / envelope, np.inf), axis=1)
+      accelLimit = np.min(np.where(envelope > 0, self.__accels / envelope, np.inf), axis=1)
+    if program.column('F') is not None:
+      feed    = fillColumn(trajectory.values('F'), None, 0.0)[m] / 60.0
+      rawFeed = fillColumn(trajectory.values('F', False), None, 0.0)[m] / 60.0
+      feed = np.where(trajectory.inverseTime()[m], rawFeed * length, feed) # G93 : F = 1 / duree en minutes
+    else:
+      feed = np.zeros(len(m))
+    feed = np.where((motion[m] == TRAJECTORY_RAPID) | (feed <= 0), np.inf, feed)
+    nominal = np.minimum(np.minimum(feed, rateLimit), np.sqrt(arcLimit))
+    nominal2 = nominal * nominal
+    dist2a = 2.0 * accelLimit * length
+
+    # Vitesse maxi a chaque jonction (carres)
+    entry = np.zeros(len(m) + 1) # Entree de chaque mouvement, puis arret final
+    if len(m) > 1:
+      previous = endUnit[:-1]
+      current  = startUnit[1:]
+      cosTheta = -np.sum(previous * current, axis=1)
+      junctionVec = current - previous
+      norm = np.sqrt(np.sum(junctionVec * junctionVec, axis=1))
+      junctionVec = np.abs(junctionVec) / np.where(norm > 0, norm, 1.0)[:, None]
+      with np.errstate(divide='ignore', invalid='ignore'):
+        junctionAccel = np.min(np.where(junctionVec > 0, self.__accels / junctionVec, np.inf), axis=1)
+        sinTheta = np.sqrt(0.5 * (1.0 - np.clip(cosTheta, -1.0, 1.0)))
+        junction2 = junctionAccel * self.__junction * sinTheta / (1.0 - sinTheta)
+      junction2 = np.where(cosTheta > ESTIMATE_JUNCTION_COS_MAX, 0.0, junction2)
+      junction2 = np.where(cosTheta < -ESTIMATE_JUNCTION_COS_MAX, np.inf, junction2)
+      entry[1:-1] = np.minimum(junction2, np.minimum(nominal2[:-1], nominal2[1:]))
+      # Arret complet entre deux mouvements separes par une ligne qui vide le planificateur
+      stop = ((flags & ESTIMATE_STOP_FLAGS) != 0) | ((bits & ESTIMATE_STOP_BITS) != 0)
+      if not self.__laserMode:
+        stop |= (bits & MODAL_BITS["speed"]) != 0
+      stops = np.cumsum(stop)
+      entry[1:-1] = np.where(stops[m[1:]] != stops[m[:-1]], 0.0, entry[1:-1])
+    # Anticipation limitee aux blocs du planificateur : arret possible a la fin du dernier bloc
+    cumul = np.concatenate(([0.0], np.cumsum(dist2a)))
+    window = cumul[np.minimum(np.arange(len(m)) + self.__blocks, len(m))] - cumul[:-1]
+    entry[:-1] = np.minimum(entry[:-1], window)
+
+    # Passes arriere puis avant : entry[k] <= entry[k+1] + 2.a.d et entry[k+1] <= entry[k] + 2.a.d
+    entry = np.minimum.accumulate((entry + cumul)[::-1])[::-1] - cumul
+    entry = cumul + np.minimum.accumulate(entry - cumul)
+    entry = np.maximum(entry, 0.0)
+
+    # Profil trapezoidal de chaque mouvement
+    v0 = np.sqrt(entry[:-1])
+    v1 = np.sqrt(entry[1:])
+    peak2 = np.minimum(nominal2, 0.5 * (entry[:-1] + entry[1:]) + 0.5 * dist2a)
+    peak  = np.sqrt(np.maximum(peak2, entry[:-1]))
+    accelLimit = np.where(np.isfinite(accelLimit), accelLimit, 1.0)
+    cruise = np.maximum(length - (2.0 * peak2 - entry[:-1] - entry[1:]) / (2.0 * accelLimit), 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      durations = (2.0 * peak - v0 - v1) / accelLimit + np.where(peak > 0, cruise / peak, 0.0)
+
+    # Duree par ligne (mouvements et temporisations G4 P en secondes), cumul et repartition par outil
+    lineTimes = np.zeros(n)
+    lineTimes[m] = durations
+    dwells = trajectory.nonModalLines("G4")
+    if len(dwells) > 0:
+      pause = trajectory.values('P', False)
+      if pause is not None:
+        lineTimes[dwells] += np.nan_to_num(pause[dwells])
+    cumulative = np.cumsum(lineTimes)
+    tools = self.__tools(trajectory, flags, lineTimes)
+    return gcodeEstimate(cumulative, tools, len(m), self.settingsKey())
+
+
+  def __arcs(self, trajectory, k, m, delta, length, startUnit, endUnit, envelope, arcLimit):
+    '''
+    Arcs (G2, G3), indices k dans les mouvements : longueur, tangentes de depart et
+    d'arrivee, limites par axe et vitesse maxi imposee par les jonctions entre les
+    segments de l'arc (decoupage de Grbl selon la tolerance $12).
+    '''
+    axis0, axis1, off0, off1, radius, angle = trajectory.arcs(m[k])
+    valid = radius > 0
+    rows  = np.arange(len(k))
+    a0 = np.where(valid, axis0, 0)
+    a1 = np.where(valid, axis1, 0)
+    d0 = np.where(valid, delta[k, a0], 0.0)
+    d1 = np.where(valid, delta[k, a1], 0.0)
+    planar = np.abs(angle) * radius
+    other2 = np.sum(delta[k] * delta[k], axis=1) - d0 * d0 - d1 * d1
+    total  = np.where(valid, np.sqrt(planar * planar + np.maximum(other2, 0.0)), length[k])
+    length[k] = total
+    safe = np.where(total > 0, total, 1.0)
+    # Tangentes (sens trigo pour G3), ponderees par la part du plan dans la longueur
+    sign  = np.sign(angle)
+    share = np.where(valid, planar / safe / np.where(valid, radius, 1.0), 0.0)
+    for units, c0, c1 in [(startUnit, -off0, -off1), (endUnit, d0 - off0, d1 - off1)]:
+      u = np.where(valid[:, None], delta[k] / safe[:, None], units[k])
+      u[rows, a0] = np.where(valid, -sign * c1 * share, u[rows, a0])
+      u[rows, a1] = np.where(valid, sign * c0 * share, u[rows, a1])
+      units[k] = u
+    env = np.abs(delta[k]) / safe[:, None]
+    env[rows, a0] = np.where(valid, planar / safe, env[rows, a0])
+    env[rows, a1] = np.where(valid, planar / safe, env[rows, a1])
+    envelope[k] = env
+    # Segments de l'arc et vitesse de jonction entre eux
+    with np.errstate(divide='ignore', invalid='ignore'):
+      segments = np.floor(np.abs(0.5 * angle * radius) / np.sqrt(self.__tolerance * (2.0 * radius - self.__tolerance)))
+      cosHalf = np.cos(0.5 * np.abs(angle) / segments)
+      accel = np.minimum(self.__accels[a0], self.__accels[a1])
+      limit = accel * self.__junction * cosHalf / (1.0 - cosHalf)
+    arcLimit[k] = np.where(valid & (segments > 0) & np.isfinite(limit), limit, np.inf)
+
+
+  def __tools(self, trajectory, flags, lineTimes):
+    ''' Duree par outil : l'outil selectionne (T) est en place a partir du changement d'outil (M6) '''
+    selected = trajectory.values('T', False)
+    selected = np.zeros(len(lineTimes)) if selected is None else fillColumn(selected, None, 0.0)
+    change = (flags & PROGRAM_FLAG_TOOL_CHANGE) != 0
+    loaded = fillColumn(selected, change, 0.0).astype(np.int64)
+    tools, index = np.unique(loaded, return_inverse=True)
+    durations = np.bincount(index, weights=lineTimes, minlength=len(tools))
+    return [(int(tool), float(duration)) for tool, duration in zip(tools, durations) if duration > 0]
+
+
+if __name__ == '__main__':
+  import sys, time, random
+  # Mesure : gcodeEstimator.py [fichier.ngc], programme synthetique de 1 million de mouvements par defaut
+  if len(sys.argv) > 1:
+    with open(sys.argv[1], 'rb') as f:
+      data = f.read().rstrip(b'\n')
+  else:
+    random.seed(0)
+    lignes = ["G21 G90 G17", "T1 M6", "M3 S12000", "G0 X0 Y0 Z5", "G1 Z-1 F800"]
+    x = y = 0.0
+    for i in range(1000000):
+      if i % 1000 == 999:
+        lignes.append("G2 X{:.3f} Y{:.3f} I1 J0".format(x, y))
+      else:
+        x += random.uniform(-0.5, 0.5)
+        y += random.uniform(-0.5, 0.5)
+        lignes.append("G1 X{:.3f} Y{:.3f}".format(x, y))
+      if i == 500000:
+        lignes += ["G0 Z5", "T2 M6", "M3 S18000", "G1 Z-1"]
+    lignes.append("M30")
+    data = "\n".join(lignes).encode()
+  program = gcodeProgram()
+  program.appendBlock(data)
+  estimator = gcodeEstimator(['X', 'Y', 'Z'], [3000, 3000, 1000], [300, 300, 100], 0.01)
+  t0 = time.time()
+  estimate = estimator.estimate(program)
+  t1 = time.time()
+  print("{} lines, {} moves estimated in {:.2f}s".format(len(program), estimate.moveCount(), t1 - t0))
+  print("Cycle time: {}".format(formatDuration(estimate.total())))
+  for tool, duree in estimate.tools():
+    print("  T{}: {}".format(tool, formatDuration(duree)))
@@ -0,0 +1,199 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+from PyQt6.QtCore import QObject, QTimer, pyqtSignal, pyqtSlot
+from cn5X_config import *
+from grblCom import grblCom
+from cn5X_cycle import *
+from cn5X_gcodeModal import gcodeModalState
+
+
+class gcodeFeeder(QObject):
+  '''
+  Alimentation a la demande de grblCom avec les lignes du fichier GCode : au plus
+  FEEDER_WINDOW_LINES lignes attendent leur acquittement dans la file de communication,
+  la fenetre est completee a chaque ok recu de Grbl. Le temps de demarrage d'un cycle
+  et la memoire occupee par la file ne dependent plus de la taille du programme.
+  Les lignes passent par le cycle (cn5XCycle) qui suit le deroulement du programme.
+  Les acquittements sont associes aux lignes par leur index (sig_lineAcked), les reponses
+  aux autres commandes ($G, $I, jog...) ne decalent donc pas le suivi.
+  L'etat modal de Grbl est suivi a partir des lignes acquittees (gcodeModalState, lu
+  dans le programme pre-analyse quand il est disponible) et emis par sig_gcodeState, $G n'est envoye que toutes les GCODE_STATE_RECONCILE_LINES
+  lignes pour recaler cet etat.
+  Avant un changement d'outil, une tempo nulle (G4 P0) est envoyee avec l'index de la
+  ligne M6 : Grbl ne l'acquitte qu'une fois les mouvements precedents termines, la boite
+  de dialogue ne s'ouvre donc qu'avec la machine a l'arret.
+  '''
+
+  sig_log        = pyqtSignal(int, str)
+  sig_gcodeState = pyqtSignal(str) # Etat modal au format de la reponse a $G ([GC:...])
+
+  def __init__(self, gcodeFile, cycle: cn5XCycle, com: grblCom, window: int = FEEDER_WINDOW_LINES):
+    super().__init__()
+    self.__gcodeFile = gcodeFile
+    self.__cycle     = cycle
+    self.__com       = com
+    self.__window    = window
+    self.__running   = False # Des lignes du fichier restent a envoyer
+    self.__filling   = False # Protection contre la reentrance (boite de dialogue de changement d'outil)
+    self.__nextLine  = 0     # Prochaine ligne du fichier a envoyer
+    self.__endLine   = -1    # Derniere ligne du fichier a envoyer
+    self.__inFlight  = {}    # Index -> ligne envoyee en attente d'acquittement (ok ou error)
+    self.__nbFed     = 0     # Lignes envoyees depuis le dernier $G
+    self.__dwellLine = -1    # Ligne de changement d'outil precedee d'un G4 P0
+    self.__dwellDone = False # G4 P0 acquitte : mouvements precedents termines
+    self.__modal     = gcodeModalState()
+
+    # Regroupement des mises a jour de l'affichage de l'etat modal
+    self.__modalTimer = QTimer()
+    self.__modalTimer.setSingleShot(True)
+    self.__modalTimer.setInterval(GCODE_STATE_REFRESH_DELAY)
+    self.__modalTimer.timeout.connect(self.on_modalTimer)
+
+    self.__com.sig_lineAcked.connect(self.on_sig_lineAcked)
+    self.__com.sig_data.connect(self.on_sig_data)
+    self.__com.sig_init.connect(self.on_sig_init)
+    self.__cycle.sig_state.connect(self.on_cycle_state)
+
+
+  def start(self, startLine: int = 0, endLine: int = -1):
+    ''' Debut de l'envoi des lignes startLine a endLine, le cycle doit avoir ete initialise par begin() '''
+    if endLine == -1:
+      endLine = self.__gcodeFile.lineCount() - 1
+    self.__nextLine = startLine
+    self.__endLine  = endLine
+    self.__inFlight.clear()
+    self.__nbFed     = 0
+    self.__dwellLine = -1
+    self.__running   = True
+    self.__fill()
+
+
+  def stop(self):
+    ''' Arret de l'alimentation, les lignes deja confiees a grblCom ne sont pas retirees '''
+    self.__running = False
+
+
+  def isRunning(self):
+    return self.__running
+
+
+  def nextLine(self):
+    return self.__nextLine
+
+
+  def modalState(self):
+    return self.__modal
+
+
+  def gcodePush(self, buff: str, flag = COM_FLAG_NO_FLAG, index: int = COM_NO_LINE_INDEX):
+    ''' Meme interface que grblCom, utilise par gcodeFile.enQueueLine() '''
+    if index != COM_NO_LINE_INDEX:
+      self.__inFlight[index] = buff
+    self.__cycle.gcodePush(buff, flag, index)
+
+
+  def __fill(self):
+    ''' Complete la fenetre de lignes en attente dans grblCom '''
+    if self.__filling:
+      return
+    self.__filling = True
+    try:
+      while self.__running and len(self.__inFlight) < self.__window and self.__nextLine <= self.__endLine:
+        if self.__gcodeFile.useToolChange() and self.__gcodeFile.isToolChangeLine(self.__nextLine):
+          # Le changement d'outil attend la fin des mouvements precedents (acquittement du G4 P0)
+          if self.__dwellLine != self.__nextLine:
+            self.__dwellLine = self.__nextLine
+            self.__dwellDone = False
+            self.gcodePush(CMD_GRBL_DWELL_SYNC, COM_FLAG_NO_FLAG, self.__nextLine)
+          if not self.__dwellDone:
+            return
+        num = self.__nextLine
+        self.__nextLine += 1
+        if not self.__gcodeFile.enQueueLine(self, num):
+          # Changement d'outil annule, on arrete le flux
+          self.sig_log.emit(logSeverity.warning.value, self.tr("Program feeding stopped at line {}.").format(num + 1))
+          self.__nextLine = self.__endLine + 1
+          break
+        self.__nbFed += 1
+        if self.__nbFed >= GCODE_STATE_RECONCILE_LINES:
+          # Recalage periodique de l'etat modal suivi localement
+          self.__nbFed = 0
+          self.__cycle.gcodePush(CMD_GRBL_GET_GCODE_STATE, COM_FLAG_NO_OK)
+      if self.__running and self.__nextLine > self.__endLine:
+        self.__running = False
+        self.__cycle.enQueued()
+    finally:
+      self.__filling = False
+
+
+  @pyqtSlot(int, int)
+  def on_sig_lineAcked(self, index: int, errNum: int):
+    buff = self.__inFlight.pop(index, None)
+    if buff is None:
+      return # Ligne envoyee hors alimentation (ligne seule, cycle precedent...)
+    if errNum != 0:
+      # Pas de relance de l'alimentation : une erreur interrompt le cycle (cf. cn5XCycle)
+      return
+    if index == self.__dwellLine and not self.__dwellDone:
+      # G4 P0 avant changement d'outil, la ligne elle-meme n'est pas encore envoyee
+      self.__dwellDone = True
+    else:
+      program = self.__gcodeFile.program()
+      if program is not None and 0 <= index < len(program):
+        self.__modal.applyProgram(program, index)
+      else:
+        self.__modal.apply(buff)
+      if self.__modal.changed() and not self.__modalTimer.isActive():
+        self.__modalTimer.start()
+    if self.__running:
+      self.__fill()
+
+
+  @pyqtSlot(str)
+  def on_sig_data(self, data: str):
+    if data[:4] == "[GC:":
+      # Reponse a $G, deja affichee par grblDecode
+      self.__modal.reconcile(data)
+
+
+  @pyqtSlot(str)
+  def on_sig_init(self, data: str):
+    # Soft reset de Grbl
+    self.__inFlight.clear()
+    self.__modal.reset()
+
+
+  @pyqtSlot()
+  def on_modalTimer(self):
+    if self.__modal.changed():
+      self.sig_gcodeState.emit(self.__modal.gcState())
+
+
+  @pyqtSlot(int)
+  def on_cycle_state(self, state: int):
+    if state not in CYCLE_ACTIVE_STATES:
+      self.__running = False
+      if state == CYCLE_ABORTED:
+        # Les lignes non acquittees ont ete retirees de la file de grblCom
+        self.__inFlight.clear()
@@ -21,10 +21,10 @@
 '                                                                         '
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 
-import os, sys
+import os, sys, shutil, tempfile
 from datetime import datetime
 from PyQt6 import QtCore, QtGui, QtWidgets
-from PyQt6.QtCore import Qt, QCoreApplication, QObject, pyqtSignal, pyqtSlot, QModelIndex, QItemSelectionModel, QSettings
+from PyQt6.QtCore import Qt, QCoreApplication, QObject, QThread, pyqtSignal, pyqtSlot, QModelIndex, QItemSelectionModel, QSettings
 from PyQt6.QtGui import QKeySequence, QStandardItemModel, QStandardItem
 from PyQt6.QtWidgets import QListView
 from cn5X_config import *
@@ -32,6 +32,9 @@ from msgbox import *
 from grblCom import grblCom
 from cn5X_toolChange import dlgToolChange
 from cn5X_gcodeParser import gcodeParser
+from cn5X_gcodeModel import gcodeListModel
+from cn5X_gcodeProgram import PROGRAM_FLAG_TOOL_CHANGE, PROGRAM_FLAG_INVALID
+from cn5X_gcodeLoader import *
 
 class gcodeFile(QObject):
   '''
@@ -40,7 +43,9 @@ class gcodeFile(QObject):
   - __init__(QListView) -> Initialise et definit les elements de l'UI qui recevront le contenu du fichier
   - showFileOpen()        -> Affiche la boite de dialogue d'ouverture
   - showFileSave()        -> Affiche la boite de dialogue d'enregistrement
-  - readFile(filePath)    -> Charge un fichier dans la QListView
+  - readFile(filePath)    -> Charge un fichier dans la QListView (indexation des lignes en tache de fond)
+  - cancelLoading()       -> Arrete l'indexation en tache de fond, les lignes restantes seront lues a la demande
+  - program()             -> Programme pre-analyse (gcodeProgram), None si pas encore disponible ou liste modifiee
   - saveFile(filePath)    -> Enregistre le contenu de la QListView dans un fichier
   - closeFile()           -> Vide la QListView
   - setGcodeChanged(bool) -> Definit si le contenu de la liste a ete modifie depuis la lecture ou l'enregistrement du fichier
@@ -48,14 +53,16 @@ class gcodeFile(QObject):
   '''
 
   sig_log     = pyqtSignal(int, str) # Message de fonctionnement du composant
+  sig_program = pyqtSignal(object, object, object) # Programme pre-analyse disponible (gcodeProgram), estimation de sa duree et controle des courses (None si inconnus)
 
   def __init__(self, ui, gcodeFileUi: QListView, dialogToolChange: dlgToolChange):
     super().__init__()
     self.__filePath         = ""
     self.__ui               = ui
     self.__gcodeFileUi      = gcodeFileUi
-    self.__gcodeFileUiModel = QStandardItemModel(self.__gcodeFileUi)
-    self.__gcodeFileUiModel.itemChanged.connect(self.on_gcodeChanged)
+    self.__gcodeFileUiModel = gcodeListModel(self.__gcodeFileUi)
+    self.__gcodeFileUiModel.dataChanged.connect(self.on_gcodeChanged)
+    self.__gcodeFileUi.setModel(self.__gcodeFileUiModel)
     self.__dlgToolChange = dialogToolChange
 
     self.__gcodeCharge      = False
@@ -67,6 +74,18 @@ class gcodeFile(QObject):
 
     self.__gcodeParser = gcodeParser()
 
+    # Thread d'indexation et de pre-analyse du fichier en tache de fond
+    self.__loader       = None
+    self.__loaderThread = None
+    self.__loaderPhase  = LOADER_PHASE_INDEX
+    self.__program      = None
+    self.__loadResult   = None # Resultat du chargement en cours (gcodeLoadResult)
+    self.__arcFitUndo   = None # (index de la liste, programme) d'avant l'ajustement des arcs
+    self.__programChecks = None # Fonction renvoyant (gcodeEstimator, gcodeTravelCheck) avec les reglages actuels de Grbl
+    if self.__ui is not None:
+      self.__ui.frmFileLoading.setVisible(False)
+      self.__ui.btnFileLoadingCancel.clicked.connect(self.cancelLoading)
+
   def showFileOpen(self):
     ''' Affiche la boite de dialogue d'ouverture '''
     fileDialog = QtWidgets.QFileDialog(None)
@@ -119,17 +138,19 @@ class gcodeFile(QObject):
 
   def readFile(self, filePath: str):
     self.sig_log.emit(logSeverity.info.value, self.tr("Reading file: {}").format(filePath))
+    self.__stopLoading()
+    self.__program    = None
+    self.__arcFitUndo = None
     try:
-      f = open(filePath,'r')
-      lignes  = f.readlines()
-      f.close()
-      self.sig_log.emit(logSeverity.info.value, self.tr("{} lines in the file").format(len(lignes)))
-      # Envoi du contenu dans la liste
-      self.__gcodeFileUiModel.clear()
-      for l in lignes:
-        item = QStandardItem(l.strip())
-        self.__gcodeFileUiModel.appendRow(item)
-      self.__gcodeFileUi.setModel(self.__gcodeFileUiModel)
+      # Projection du fichier en memoire, seul le premier bloc est indexe ici,
+      # la suite l'est par le thread de chargement pendant que la liste s'affiche,
+      # puis le programme est pre-analyse, toujours en tache de fond.
+      self.__gcodeFileUiModel.openFile(filePath, GCODE_LOADER_BLOCK)
+      if self.__gcodeFileUiModel.isIndexed():
+        self.sig_log.emit(logSeverity.info.value, self.tr("{} lines in the file").format(self.__gcodeFileUiModel.rowCount()))
+      else:
+        self.sig_log.emit(logSeverity.info.value, self.tr("{:.1f} MB file, loading lines in background").format(self.__gcodeFileUiModel.fileSize() / 1e6))
+      self.__startLoading(filePath)
       # Selectionne la premiere ligne du fichier dans la liste
       self.selectGCodeFileLine(0)
       # Selectionne l'onglet du fichier
@@ -148,6 +169,187 @@ class gcodeFile(QObject):
     return True
 
 
+  def setProgramChecks(self, checks):
+    '''
+    checks() renvoie l'estimateur de duree (gcodeEstimator) et le controle des courses
+    (gcodeTravelCheck) construits avec les reglages actuels de Grbl, ou None pour chacun
+    s'ils ne sont pas connus. Appelee a chaque chargement, dans le thread de l'interface.
+    '''
+    self.__programChecks = checks
+
+
+  def __loadOptions(self, arcFit: bool = True):
+    ''' Traitements faits par le thread de chargement apres la pre-analyse '''
+    estimator, travelCheck = self.__programChecks() if self.__programChecks is not None else (None, None)
+    return gcodeLoadOptions(
+      self.arcFitTolerance() if arcFit and self.arcFit() else 0.0,
+      self.mergeTolerance() if self.mergeCollinear() else 0.0,
+      estimator, travelCheck)
+
+
+  def __startLoading(self, filePath: str, program = None):
+    '''
+    Lance l'indexation de la suite du fichier puis la pre-analyse du programme et ses
+    traitements dans un thread. Si program est donne, seuls les traitements sont refaits,
+    sans ajustement des arcs (cf. undoArcFit()).
+    '''
+    model = self.__gcodeFileUiModel
+    self.__loadResult = None
+    self.__loader = gcodeLoader(filePath, model.indexedBytes(), model.generation(), self.__loadOptions(program is None), program)
+    self.__loaderThread = QThread()
+    self.__loader.moveToThread(self.__loaderThread)
+    self.__loader.sig_block.connect(self.on_loader_block)
+    self.__loader.sig_program.connect(self.on_loader_program)
+    self.__loader.sig_progress.connect(self.on_loader_progress)
+    self.__loader.sig_finished.connect(self.on_loader_finished)
+    self.__loader.sig_log.connect(self.sig_log.emit)
+    self.__loaderThread.started.connect(self.__loader.run)
+    self.__loaderPhase = LOADER_PHASE_INDEX
+    if not model.isIndexed():
+      model.setLoading(True)
+      if self.__ui is not None:
+        self.on_loader_progress(LOADER_PHASE_INDEX, model.indexedBytes() * 1000 // max(model.fileSize(), 1))
+    self.__loaderThread.start()
+
+
+  def __stopLoading(self):
+    ''' Arret du thread d'indexation s'il est actif, les lignes deja transmises restent dans la liste '''
+    if self.__loader is not None:
+      self.__loader.cancel()
+      self.__loaderThread.quit() # Quitte des que la boucle d'evenements du thread est libre
+      self.__loaderThread.wait() # et attend que ce soit vraiment le cas
+      self.__loader       = None
+      self.__loaderThread = None
+    self.__gcodeFileUiModel.setLoading(False)
+    if self.__ui is not None:
+      self.__ui.frmFileLoading.setVisible(False)
+
+
+  def isLoading(self):
+    return self.__loader is not None
+
+
+  def program(self):
+    return self.__program
+
+
+  def __invalidateProgram(self):
+    ''' La liste va etre modifiee, le programme pre-analyse ne lui correspond plus '''
+    self.__stopLoading()
+    self.__program    = None
+    self.__arcFitUndo = None
+
+
+  @pyqtSlot()
+  def cancelLoading(self):
+    if self.__loader is not None:
+      phase = self.__loaderPhase
+      self.__stopLoading()
+      if phase == LOADER_PHASE_INDEX:
+        self.sig_log.emit(logSeverity.warning.value, self.tr("File loading canceled, remaining lines will be read on demand"))
+      else:
+        self.sig_log.emit(logSeverity.warning.value, self.tr("Program analysis canceled"))
+
+
+  @pyqtSlot(int, int, int, object)
+  def on_loader_block(self, generation: int, start: int, end: int, starts):
+    self.__gcodeFileUiModel.appendIndex(generation, start, end, starts)
+
+
+  @pyqtSlot(int, object)
+  def on_loader_program(self, generation: int, result):
+    if self.__loader is None or generation != self.__gcodeFileUiModel.generation():
+      return # Chargement arrete ou liste modifiee entre temps
+    self.__loadResult = result
+
+
+  @pyqtSlot(int, int)
+  def on_loader_progress(self, phase: int, permille: int):
+    if phase != self.__loaderPhase:
+      self.__loaderPhase = phase
+      if phase != LOADER_PHASE_INDEX:
+        # Fichier entierement indexe
+        self.__gcodeFileUiModel.setLoading(False)
+    if self.__ui is None:
+      return
+    if phase == LOADER_PHASE_INDEX:
+      self.__ui.pgbFileLoading.setFormat(self.tr("Loading file... %p%"))
+    elif phase == LOADER_PHASE_PARSE:
+      self.__ui.pgbFileLoading.setFormat(self.tr("Analyzing program... %p%"))
+    elif phase == LOADER_PHASE_ARCS:
+      self.__ui.pgbFileLoading.setFormat(self.tr("Fitting arcs... %p%"))
+    elif phase == LOADER_PHASE_MERGE:
+      self.__ui.pgbFileLoading.setFormat(self.tr("Merging collinear moves... %p%"))
+    elif phase == LOADER_PHASE_ESTIMATE:
+      self.__ui.pgbFileLoading.setFormat(self.tr("Estimating cycle time... %p%"))
+    else:
+      self.__ui.pgbFileLoading.setFormat(self.tr("Checking machine travel... %p%"))
+    self.__ui.pgbFileLoading.setValue(permille)
+    if permille < 1000 and not self.__ui.frmFileLoading.isVisible():
+      self.__ui.frmFileLoading.setVisible(True)
+
+
+  @pyqtSlot(int, bool)
+  def on_loader_finished(self, generation: int, completed: bool):
+    if generation != self.__gcodeFileUiModel.generation():
+      return # Fin d'un chargement deja arrete
+    self.__stopLoading()
+    result = self.__loadResult
+    self.__loadResult = None
+    if completed and result is not None:
+      self.__applyResult(result)
+
+
+  def __applyResult(self, result):
+    '''
+    Report dans la liste des lignes remplacees par l'ajustement des arcs et retirees par la
+    fusion des mouvements colineaires (calcules par le thread de chargement), puis
+    transmission du programme final, de son estimation et du controle des courses.
+    '''
+    parsed  = result.parsed()
+    options = result.options()
+    self.sig_log.emit(logSeverity.info.value, self.tr("Program analysis done ({} lines)").format(len(parsed)))
+    before = len(parsed)
+    if result.arcRows() is not None:
+      rows = result.arcRows()
+      self.__arcFitUndo = (self.__gcodeFileUiModel.selectRows(rows, result.arcTexts()), parsed)
+      self.sig_log.emit(logSeverity.info.value, self.tr("{} arcs fitted within {} mm: {} -> {} lines ({:.1f}% fewer), use File > Undo arc fitting to restore the original lines.").format(
+        result.arcCount(), options.arcFitTolerance(), before, len(rows), 100.0 * (before - len(rows)) / before))
+      before = len(rows)
+    elif options.arcFitTolerance() > 0:
+      self.sig_log.emit(logSeverity.info.value, self.tr("No arcs found within {} mm.").format(options.arcFitTolerance()))
+    if result.mergeRows() is not None:
+      rows = result.mergeRows()
+      self.__gcodeFileUiModel.selectRows(rows)
+      self.sig_log.emit(logSeverity.info.value, self.tr("Collinear moves merged within {} mm: {} -> {} lines ({:.1f}% fewer).").format(
+        options.mergeTolerance(), before, len(rows), 100.0 * (before - len(rows)) / before))
+    elif options.mergeTolerance() > 0:
+      self.sig_log.emit(logSeverity.info.value, self.tr("No collinear moves to merge within {} mm.").format(options.mergeTolerance()))
+    self.__program = result.program()
+    self.sig_program.emit(self.__program, result.estimate(), result.travelReport())
+
+
+  def canUndoArcFit(self):
+    return self.__arcFitUndo is not None
+
+
+  def undoArcFit(self):
+    '''
+    Retour aux lignes d'avant l'ajustement des arcs, puis nouvelle fusion des mouvements
+    colineaires si elle est active, estimation et controle des courses dans le thread de
+    chargement (le programme est transmis par sig_program a la fin).
+    '''
+    if self.__arcFitUndo is None or self.isLoading():
+      return False
+    starts, program = self.__arcFitUndo
+    self.__arcFitUndo = None
+    self.__gcodeFileUiModel.restoreRows(starts)
+    self.__program = None
+    self.sig_log.emit(logSeverity.info.value, self.tr("Arc fitting undone ({} lines).").format(len(program)))
+    self.__startLoading(self.__filePath, program)
+    return True
+
+
   def isFileLoaded(self):
     return self.__gcodeCharge
 
@@ -195,25 +397,81 @@ class gcodeFile(QObject):
     if filePath == "":
       if self.__filePath == "":
         # Le nom du fichier n'est pas definit, il n'y a pas de fichier charge, donc, rien a sauvegarder !
-        return
+        return False
       else:
         filePath = self.__filePath
     self.sig_log.emit(logSeverity.info.value, self.tr("Saving file: {}").format(filePath))
+    # Le fichier ouvert est projete en memoire et lu a la demande : ecriture dans un
+    # fichier temporaire qui remplace ensuite le fichier de destination.
+    # Le fichier source n'est libere que le temps du remplacement (verrou de la projection
+    # sous Windows), il est reprojete avec les lignes modifiees si le remplacement echoue.
+    tmpPath = ""
+    released = False
+    self.__invalidateProgram()
     try:
-      f = open(filePath, 'w')
-      for I in range(self.__gcodeFileUiModel.rowCount()):
-        idx = self.__gcodeFileUiModel.index( I, 0, QModelIndex())
-        if self.__gcodeFileUiModel.data(idx) != "":
-          f.write(self.__gcodeFileUiModel.data(idx) + '\n')
-      f.close()
-      self.__filePath = filePath
+      fd, tmpPath = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(filePath)))
+      with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        for ligne in self.__gcodeFileUiModel.lines():
+          if ligne != "":
+            f.write(ligne + '\n')
+      if os.path.exists(filePath):
+        shutil.copymode(filePath, tmpPath) # mkstemp() cree le fichier en 0600, on garde les droits de l'original
+      row = self.__gcodeFileUi.selectionModel().currentIndex().row()
+      self.__gcodeFileUiModel.releaseFile()
+      released = True
+      os.replace(tmpPath, filePath)
     except Exception as e:
       self.sig_log.emit(logSeverity.error.value, self.tr("Save file error: {}").format(filePath))
       self.sig_log.emit(logSeverity.error.value, str(e))
-    # Supprime les lignes vides dans la grille d'affichage
-    self.delEmptyRow()
+      if tmpPath != "" and os.path.exists(tmpPath):
+        os.remove(tmpPath)
+      if released:
+        try:
+          self.__gcodeFileUiModel.reopenFile()
+        except OSError as e:
+          self.sig_log.emit(logSeverity.error.value, self.tr("Unable to reopen the file, the GCode list is cleared: {}").format(str(e)))
+          self.__gcodeFileUiModel.clear()
+          self.__gcodeCharge = False
+      return False
+    # Rechargement du fichier enregistre (sans les lignes vides)
+    self.__filePath = filePath
+    try:
+      self.__gcodeFileUiModel.openFile(filePath)
+    except OSError as e:
+      self.sig_log.emit(logSeverity.error.value, self.tr("File saved but not reloaded: {}").format(str(e)))
+      self.__gcodeFileUiModel.clear()
+      self.__gcodeCharge  = False
+      self.__gcodeChanged = False
+      return True
+    self.__startLoading(filePath)
+    if row >= 0:
+      self.selectGCodeFileLine(min(row, self.__gcodeFileUiModel.rowCount() - 1))
     # Reinit du flag fichier change
     self.__gcodeChanged = False
+    return True
+
+
+  def lineCount(self):
+    ''' Nombre exact de lignes (termine l'indexation du fichier si necessaire) '''
+    model = self.__gcodeFileUiModel
+    if not model.isIndexed():
+      # Fin de l'indexation sans attendre le thread, qui reprend pour la seule pre-analyse
+      loading = self.__loader is not None
+      self.__stopLoading()
+      model.indexAll()
+      if loading and self.__program is None:
+        self.__startLoading(self.__filePath)
+    return model.rowCount()
+
+
+  def isToolChangeLine(self, num: int):
+    ''' Renvoie vrai si la ligne num contient une demande de changement d'outil (M6) '''
+    if self.__program is not None and num < len(self.__program):
+      return self.__program.hasFlag(num, PROGRAM_FLAG_TOOL_CHANGE)
+    gcodeLine = self.__gcodeFileUiModel.lineText(num)
+    if gcodeLine is None or gcodeLine == "":
+      return False
+    return "M6" in self.__gcodeParser.wordList(gcodeLine)
 
 
   def enQueue(self, com: grblCom, startLine: int = 0, endLine: int = -1):
@@ -223,83 +481,105 @@ class gcodeFile(QObject):
     QtWidgets.QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
     
     if endLine == -1:
-      endLine = self.__gcodeFileUiModel.rowCount()
+      endLine = self.lineCount()
 
     for I in range(startLine, endLine + 1):
-      idx = self.__gcodeFileUiModel.index( I, 0, QModelIndex())
-      if self.__gcodeFileUiModel.data(idx) != "":
-        gcodeLine = self.__gcodeFileUiModel.data(idx)
-        if gcodeLine is not None:
-          dico  = self.__gcodeParser.wordDict(gcodeLine)
-          wlist = self.__gcodeParser.wordList(gcodeLine)
-
-          if ('T' in dico):
-            # Appel d'outil, on memorise le nouvel (ou futur) outil
-            # actif et on en force l'envoi vers Grbl.
-            try:
-              self.__toolNumber = int(float(dico['T']))
-            except ValueError as e:
-              # Erreur sur la valeur de T non numérique ou absente
-              self.sig_log.emit(logSeverity.error.value, self.tr("enQueue(): Invalid tool number (T) value '{}'.").format(dico['T']))
-              self.__toolNumber = 0
-            com.gcodePush("T{}".format(self.__toolNumber))
-            self.sig_log.emit(logSeverity.info.value, self.tr("enQueue(): Select tool number T{}.").format(self.__toolNumber))
-
-          if ("M6" in wlist):
-            # Demande de changement d'outil.
-            # La commande M6 ne sera pas envoyée à Grbl
-            if self.useToolChange():
-              # Traitement des changements d'outil manuels
-              if self.ignoreFirstToolChange() and not self.__firstToolDone:
-                # Ignore le premier changement d'outil du programme
-                # Si l'option est active, l'opérateur est sensé avoir
-                # déjà monté le premier outil avant le début de l'usinage
-                # donc, on ne fait rien (on trace juste dans la log)
-                self.sig_log.emit(logSeverity.info.value, self.tr("Ignoring first tool change (T{}).").format(self.__toolNumber))
-              else:
-                # Appel de la boite de dialogue de changement d'outil
-                RC = self.toolChange(self.__toolNumber)
-                if RC == QtWidgets.QDialog.Rejected:
-                  # Annulation du changement d'outil, on arrête le flux. 
-                  # Restore le curseur souris sablier en fin d'envoi
-                  QtWidgets.QApplication.restoreOverrideCursor()
-                  return False
-              if not self.__firstToolDone:
-                # Mémorise que le premier changement d'outil à eu lieu
-                self.__firstToolDone = True
-          else:
-            # Les autres commandes que M6 sont envoyées à Grbl 
-            com.gcodePush(gcodeLine)
-
-          # Force une mise à jour des status GCode
-          com.gcodePush(CMD_GRBL_GET_GCODE_STATE, COM_FLAG_NO_OK)
+      if not self.enQueueLine(com, I):
+        # Restore le curseur souris sablier en fin d'envoi
+        QtWidgets.QApplication.restoreOverrideCursor()
+        return False
 
     # Restore le curseur souris sablier en fin d'envoi
     QtWidgets.QApplication.restoreOverrideCursor()
+    return True
+
+
+  def enQueueLine(self, com: grblCom, num: int):
+    '''
+    Envoi de la ligne num dans la file d'attente du grblCom (ou de tout objet
+    exposant gcodePush()), avec traitement des appels (T) et changements (M6) d'outils.
+    num accompagne la ligne jusqu'a Grbl et revient dans sig_lineSent et sig_lineAcked.
+    Renvoie False si le changement d'outil a ete annule (arret du flux).
+    '''
+    gcodeLine = self.__gcodeFileUiModel.lineText(num)
+    if gcodeLine is None or gcodeLine == "":
+      return True
+
+    program = self.__program
+    if program is not None and num < len(program) and not program.hasFlag(num, PROGRAM_FLAG_INVALID):
+      # Ligne deja analysee au chargement du fichier
+      toolNumber = program.value('T', num)
+      toolChange = program.hasFlag(num, PROGRAM_FLAG_TOOL_CHANGE)
+    else:
+      dico       = self.__gcodeParser.wordDict(gcodeLine)
+      toolNumber = None
+      toolChange = "M6" in self.__gcodeParser.wordList(gcodeLine)
+      if ('T' in dico):
+        try:
+          toolNumber = float(dico['T'])
+        except ValueError as e:
+          # Erreur sur la valeur de T non numérique ou absente
+          self.sig_log.emit(logSeverity.error.value, self.tr("enQueue(): Invalid tool number (T) value '{}'.").format(dico['T']))
+          toolNumber = 0
+
+    if toolNumber is not None:
+      # Appel d'outil, on memorise le nouvel (ou futur) outil
+      # actif et on en force l'envoi vers Grbl.
+      self.__toolNumber = int(toolNumber)
+      # L'index n'accompagne qu'un seul envoi par ligne : la ligne complete si elle est envoyee
+      com.gcodePush("T{}".format(self.__toolNumber), COM_FLAG_NO_FLAG, num if toolChange else COM_NO_LINE_INDEX)
+      self.sig_log.emit(logSeverity.info.value, self.tr("enQueue(): Select tool number T{}.").format(self.__toolNumber))
+
+    if toolChange:
+      # Demande de changement d'outil.
+      # La commande M6 ne sera pas envoyée à Grbl
+      if self.useToolChange():
+        # Traitement des changements d'outil manuels
+        if self.ignoreFirstToolChange() and not self.__firstToolDone:
+          # Ignore le premier changement d'outil du programme
+          # Si l'option est active, l'opérateur est sensé avoir
+          # déjà monté le premier outil avant le début de l'usinage
+          # donc, on ne fait rien (on trace juste dans la log)
+          self.sig_log.emit(logSeverity.info.value, self.tr("Ignoring first tool change (T{}).").format(self.__toolNumber))
+        else:
+          # Appel de la boite de dialogue de changement d'outil
+          RC = self.toolChange(self.__toolNumber)
+          if RC == QtWidgets.QDialog.Rejected:
+            # Annulation du changement d'outil, on arrête le flux.
+            return False
+        if not self.__firstToolDone:
+          # Mémorise que le premier changement d'outil à eu lieu
+          self.__firstToolDone = True
+    else:
+      # Les autres commandes que M6 sont envoyées à Grbl
+      com.gcodePush(gcodeLine, COM_FLAG_NO_FLAG, num)
+
+    return True
 
 
   def delEmptyRow(self):
     """ Elimination des lignes GCode vides """
-    for I in reversed(range(self.__gcodeFileUiModel.rowCount())):
+    for I in reversed(range(self.lineCount())):
       # On commence par la fin pour pouvoir supprimer sans tout decaler pour la suite
-      idx = self.__gcodeFileUiModel.index( I, 0, QModelIndex())
-      if self.__gcodeFileUiModel.data(idx) == "":
-        self.__gcodeFileUiModel.removeRow(I)
+      if self.__gcodeFileUiModel.lineText(I) == "":
+        self.__invalidateProgram()
+        self.__gcodeFileUiModel.removeRows(I, 1)
 
 
   def deleteGCodeFileLine(self, num: int):
-    self.__gcodeFileUiModel.removeRow(num)
+    self.__invalidateProgram() # Les modifications de la liste reindexent tout le fichier
+    self.__gcodeFileUiModel.removeRows(num, 1)
     self.__gcodeChanged = True
 
 
   def insertGCodeFileLine(self, num: int):
-    item = QStandardItem("")
-    self.__gcodeFileUiModel.insertRow(num, item)
+    self.__invalidateProgram()
+    self.__gcodeFileUiModel.insertRows(num, 1)
 
 
   def addGCodeFileLine(self, num: int):
-    item = QStandardItem("")
-    self.__gcodeFileUiModel.insertRow(num+1, item)
+    self.__invalidateProgram()
+    self.__gcodeFileUiModel.insertRows(num+1, 1)
 
 
   def showConfirmChangeLost(self):
@@ -327,10 +607,10 @@ class gcodeFile(QObject):
             return False
           else:
             self.__filePath = filePath
-        self.saveFile(self.__filePath)
-        return True
+        return self.saveFile(self.__filePath)
       elif Ret == msgButtonList.Discard:
         # Fermer le fichier consiste en vider la fenetre GCode
+        self.__invalidateProgram()
         self.__gcodeFileUiModel.clear()
         self.__gcodeChanged = False
         self.__gcodeCharge  =False
@@ -341,15 +621,17 @@ class gcodeFile(QObject):
       # GCode non modifie, on ferme sans confirmation
       # Fermer le fichier consiste en vider la fenetre GCode
       # et a supprimer le status GCode charge.
+      self.__invalidateProgram()
       self.__gcodeFileUiModel.clear()
       self.__gcodeChanged = False
       self.__gcodeCharge  =False
       return True
 
 
-  @pyqtSlot("QStandardItem*")
-  def on_gcodeChanged(self, item):
+  @pyqtSlot(QModelIndex, QModelIndex)
+  def on_gcodeChanged(self, topLeft: QModelIndex, bottomRight: QModelIndex):
     self.__gcodeChanged = True
+    self.__invalidateProgram()
 
 
   def gcodeChanged(self):
@@ -378,3 +660,19 @@ class gcodeFile(QObject):
     return self.__settings.value("ignoreFirstToolChange", False, type=bool)
 
 
+  def mergeCollinear(self):
+    return self.__settings.value("mergeCollinear", False, type=bool)
+
+
+  def mergeTolerance(self):
+    return self.__settings.value("mergeTolerance", GCODE_MERGE_TOLERANCE, type=float)
+
+
+  def arcFit(self):
+    return self.__settings.value("arcFit", False, type=bool)
+
+
+  def arcFitTolerance(self):
+    return self.__settings.value("arcFitTolerance", GCODE_ARC_FIT_TOLERANCE, type=float)
+
+
@@ -0,0 +1,498 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import os, time, mmap, threading, multiprocessing
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, wait
+from array import array
+from PyQt6.QtCore import QObject, pyqtSignal, pyqtSlot
+from cn5X_config import *
+from cn5X_gcodeModel import gcodeListModel
+from cn5X_gcodeProgram import gcodeProgram
+from cn5X_gcodeCache import gcodeCache
+from cn5X_gcodeArcFit import gcodeArcFit
+from cn5X_gcodeMerge import gcodeMerge
+from cn5X_gcodeEstimator import gcodeEstimate
+
+''' Etapes du chargement, cf. sig_progress '''
+LOADER_PHASE_INDEX    = 0 # Indexation des debuts de lignes
+LOADER_PHASE_PARSE    = 1 # Pre-analyse du programme (gcodeProgram)
+LOADER_PHASE_ARCS     = 2 # Remplacement des suites de G1 par des arcs (gcodeArcFit)
+LOADER_PHASE_MERGE    = 3 # Fusion des mouvements colineaires (gcodeMerge)
+LOADER_PHASE_ESTIMATE = 4 # Estimation de la duree du cycle (gcodeEstimator)
+LOADER_PHASE_TRAVEL   = 5 # Controle des courses machine (gcodeTravelCheck)
+
+
+class gcodeLoadOptions():
+  '''
+  Traitements du programme faits par le thread de chargement apres la pre-analyse.
+  L'estimateur et le controle des courses sont construits dans le thread de l'interface
+  avec les reglages de Grbl du moment, None s'ils ne sont pas connus.
+  '''
+
+  def __init__(self, arcFitTolerance: float = 0.0, mergeTolerance: float = 0.0, estimator = None, travelCheck = None):
+    self.__arcFitTolerance = arcFitTolerance # 0 : pas d'ajustement des arcs
+    self.__mergeTolerance  = mergeTolerance  # 0 : pas de fusion des mouvements colineaires
+    self.__estimator       = estimator
+    self.__travelCheck     = travelCheck
+
+
+  def arcFitTolerance(self):
+    return self.__arcFitTolerance
+
+
+  def mergeTolerance(self):
+    return self.__mergeTolerance
+
+
+  def estimator(self):
+    return self.__estimator
+
+
+  def travelCheck(self):
+    return self.__travelCheck
+
+
+  def summaryPrefix(self):
+    '''
+    Prefixe des resultats memorises avec le programme pre-analyse (gcodeProgram.summary()) :
+    l'estimation et l'enveloppe sont celles du programme final, qui depend des traitements.
+    '''
+    if self.__arcFitTolerance <= 0 and self.__mergeTolerance <= 0:
+      return ""
+    return "arcs={}|merge={}|".format(self.__arcFitTolerance, self.__mergeTolerance)
+
+
+class gcodeLoadResult():
+  '''
+  Resultat du chargement transmis par gcodeLoader.sig_program : programme pre-analyse,
+  lignes a conserver dans la liste apres l'ajustement des arcs et la fusion, estimation
+  de la duree et controle des courses.
+  '''
+
+  def __init__(self, parsed, options: gcodeLoadOptions = None):
+    self.__options     = options if options is not None else gcodeLoadOptions()
+    self.__parsed      = parsed # Programme d'avant l'ajustement des arcs et la fusion
+    self.__program     = parsed
+    self.__arcRows     = None   # Lignes conservees par l'ajustement des arcs, None si rien n'a change
+    self.__arcTexts    = None   # Nouveau numero de ligne -> texte (arcs et retours en G1)
+    self.__arcCount    = 0
+    self.__mergeRows   = None   # Lignes conservees par la fusion, None si rien n'a change
+    self.__estimate    = None
+    self.__travel      = None
+    self.__newSummary  = False  # Resultats ajoutes au programme pre-analyse, a enregistrer dans le cache
+
+
+  def options(self):
+    return self.__options
+
+
+  def parsed(self):
+    return self.__parsed
+
+
+  def program(self):
+    ''' Programme final, apres l'ajustement des arcs et la fusion '''
+    return self.__program
+
+
+  def setProgram(self, program):
+    self.__program = program
+
+
+  def setArcFit(self, rows: list, texts: dict, arcCount: int):
+    self.__arcRows  = rows
+    self.__arcTexts = texts
+    self.__arcCount = arcCount
+
+
+  def arcRows(self):
+    return self.__arcRows
+
+
+  def arcTexts(self):
+    return self.__arcTexts
+
+
+  def arcCount(self):
+    return self.__arcCount
+
+
+  def setMergeRows(self, rows: list):
+    self.__mergeRows = rows
+
+
+  def mergeRows(self):
+    return self.__mergeRows
+
+
+  def setEstimate(self, estimate):
+    self.__estimate = estimate
+
+
+  def estimate(self):
+    ''' Estimation de la duree du programme final (gcodeEstimate), None si les reglages de Grbl ne sont pas connus '''
+    return self.__estimate
+
+
+  def setTravelReport(self, report):
+    self.__travel = report
+
+
+  def travelReport(self):
+    ''' Controle des courses du programme final (gcodeTravelReport), None si les courses ne sont pas connues '''
+    return self.__travel
+
+
+  def setNewSummary(self):
+    self.__newSummary = True
+
+
+  def hasNewSummary(self):
+    return self.__newSummary
+
+
+class gcodeLoader(QObject):
+  '''
+  QObject worker d'indexation d'un fichier GCode, execute dans son propre thread.
+  Parcourt le fichier par blocs de GCODE_LOADER_BLOCK octets a partir de start et
+  transmet les debuts de lignes trouves (sig_block) au plus toutes les
+  GCODE_LOADER_EMIT_DELAY millisecondes, pour que la liste se remplisse pendant
+  le chargement sans bloquer l'interface.
+  Le programme complet est ensuite pre-analyse (gcodeProgram), puis, toujours dans ce
+  thread, passe par les traitements demandes (gcodeLoadOptions) : ajustement des arcs,
+  fusion des mouvements colineaires, estimation de la duree et controle des courses.
+  Le tout est transmis a la fin par sig_program (gcodeLoadResult).
+  Index et programme sont conserves dans le cache disque (gcodeCache) et directement relus
+  a la reouverture d'un fichier inchange.
+  Si program est donne, le fichier n'est pas relu : seuls les traitements sont refaits
+  (cf. gcodeFile.undoArcFit()).
+  '''
+
+  sig_block    = pyqtSignal(int, int, int, object) # generation, debut, fin (octets) et debuts de lignes (array) du bloc
+  sig_program  = pyqtSignal(int, object)           # generation et resultat du chargement (gcodeLoadResult)
+  sig_progress = pyqtSignal(int, int)              # Etape (LOADER_PHASE_*) et avancement en pour mille
+  sig_finished = pyqtSignal(int, bool)             # generation, fin normale (True) ou annulation (False)
+  sig_log      = pyqtSignal(int, str)
+
+  def __init__(self, filePath: str, start: int, generation: int, options: gcodeLoadOptions = None, program = None):
+    super().__init__()
+    self.__filePath   = filePath
+    self.__start      = start
+    self.__generation = generation
+    self.__options    = options if options is not None else gcodeLoadOptions()
+    self.__program    = program
+    self.__cancel     = threading.Event()
+
+
+  def cancel(self):
+    ''' Demande d'arret, peut etre appele depuis n'importe quel thread '''
+    self.__cancel.set()
+
+
+  def isCanceled(self):
+    return self.__cancel.is_set()
+
+
+  @pyqtSlot()
+  def run(self):
+    if self.__program is not None:
+      result = self.__analyze(self.__program)
+      if result is not None:
+        self.sig_program.emit(self.__generation, result)
+      self.sig_finished.emit(self.__generation, result is not None)
+      return
+    try:
+      with open(self.__filePath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+          self.sig_program.emit(self.__generation, gcodeLoadResult(gcodeProgram(), self.__options))
+          self.sig_finished.emit(self.__generation, True)
+          return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+          self.sig_finished.emit(self.__generation, self.__load(mm, size))
+    except (OSError, ValueError) as err:
+      self.sig_log.emit(logSeverity.error.value, self.tr("gcodeLoader: Error reading {}: {}").format(self.__filePath, err))
+      self.sig_finished.emit(self.__generation, False)
+
+
+  def __load(self, mm, size: int):
+    ''' Lecture depuis le cache ou indexation et analyse du fichier, renvoie False en cas d'annulation '''
+    cache = gcodeCache()
+    key = ""
+    if cache.isEnabled() and size >= GCODE_CACHE_MIN_SIZE:
+      key = cache.key(self.__filePath, mm, self.__cancel.is_set)
+      if key == "":
+        return False
+      cached = cache.load(key)
+      if cached is not None:
+        starts, program = cached
+        # Fin de l'index a partir de la partie deja indexee par la liste
+        self.sig_block.emit(self.__generation, self.__start, size, starts[bisect_left(starts, self.__start):])
+        self.sig_progress.emit(LOADER_PHASE_PARSE, 1000)
+        self.sig_log.emit(logSeverity.info.value, self.tr("gcodeLoader: {} lines read from the cache.").format(len(program)))
+        result = self.__analyze(program, mm, starts)
+        if result is None:
+          return False
+        self.sig_program.emit(self.__generation, result)
+        if result.hasNewSummary():
+          # Estimation ou enveloppe calculees pour la premiere fois (nouveaux reglages de Grbl...)
+          if not cache.save(key, starts, program):
+            self.sig_log.emit(logSeverity.warning.value, self.tr("gcodeLoader: Unable to write the cache in {}.").format(cache.directory()))
+        return True
+    # L'index complet sert au cache et au texte des lignes qui repassent en G1 apres un arc
+    keep = key != "" or self.__options.arcFitTolerance() > 0
+    starts = self.__index(mm, size, keep)
+    if starts is None:
+      return False
+    index = None
+    if keep:
+      # Index complet, y compris la partie indexee par la liste a l'ouverture du fichier
+      index = gcodeListModel.buildIndex(mm, size, 0, self.__start)
+      index.extend(starts)
+    program = self.__parse(mm, size)
+    if program is None:
+      return False
+    result = self.__analyze(program, mm, index)
+    if result is None:
+      return False
+    self.sig_program.emit(self.__generation, result)
+    if key != "":
+      if not cache.save(key, index, program):
+        self.sig_log.emit(logSeverity.warning.value, self.tr("gcodeLoader: Unable to write the cache in {}.").format(cache.directory()))
+    return True
+
+
+  def __analyze(self, program, mm = None, index = None):
+    '''
+    Traitements du programme pre-analyse (gcodeLoadOptions), une etape de sig_progress
+    chacun, l'avancement est celui de l'ensemble des traitements. Renvoie le
+    gcodeLoadResult, None en cas d'annulation.
+    mm et index (debuts de toutes les lignes) donnent le texte des lignes du fichier.
+    L'estimation et l'enveloppe du programme final sont memorisees avec le programme
+    pre-analyse (summary(), enregistre dans le cache) et relues au chargement suivant.
+    '''
+    options = self.__options
+    parsed  = program
+    prefix  = options.summaryPrefix()
+    result  = gcodeLoadResult(program, options)
+    stages  = []
+    if options.arcFitTolerance() > 0 and mm is not None and index is not None:
+      stages.append(LOADER_PHASE_ARCS)
+    if options.mergeTolerance() > 0:
+      stages.append(LOADER_PHASE_MERGE)
+    if options.estimator() is not None:
+      stages.append(LOADER_PHASE_ESTIMATE)
+    if options.travelCheck() is not None and options.travelCheck().isEnabled():
+      stages.append(LOADER_PHASE_TRAVEL)
+    if LOADER_PHASE_ARCS in stages:
+      if not self.__stage(LOADER_PHASE_ARCS, stages):
+        return None
+      fit = gcodeArcFit(options.arcFitTolerance()).fit(program)
+      if not fit.isEmpty():
+        rows  = fit.rows().tolist()
+        texts = fit.arcs()
+        for row in fit.restores():
+          texts[row] = "G1 " + self.__lineText(mm, index, rows[row])
+        program = program.select(rows)
+        program.replaceLines(texts)
+        result.setArcFit(rows, texts, fit.arcCount())
+    if LOADER_PHASE_MERGE in stages:
+      if not self.__stage(LOADER_PHASE_MERGE, stages):
+        return None
+      rows = gcodeMerge(options.mergeTolerance()).merge(program)
+      if len(rows) < len(program):
+        rows = rows.tolist()
+        program = program.select(rows)
+        result.setMergeRows(rows)
+    result.setProgram(program)
+    if LOADER_PHASE_ESTIMATE in stages:
+      if not self.__stage(LOADER_PHASE_ESTIMATE, stages):
+        return None
+      key = options.estimator().summaryKey()
+      estimate = gcodeEstimate.fromSummary(parsed, prefix + key, options.estimator().settingsKey())
+      if estimate is None:
+        estimate = options.estimator().estimate(program)
+        estimate.toSummary(parsed, prefix + key)
+        result.setNewSummary()
+      if program is not parsed:
+        estimate.toSummary(program, key)
+      result.setEstimate(estimate)
+    if LOADER_PHASE_TRAVEL in stages:
+      if not self.__stage(LOADER_PHASE_TRAVEL, stages):
+        return None
+      check = options.travelCheck()
+      key = check.boundsKey()
+      bounds = parsed.summary(prefix + key)
+      if bounds is None:
+        bounds = check.bounds(program)
+        parsed.setSummary(prefix + key, bounds)
+        result.setNewSummary()
+      program.setSummary(key, bounds)
+      # Controle complet seulement si l'enveloppe sort des courses, pour trouver les lignes
+      report = check.checkBounds(bounds)
+      result.setTravelReport(report if report is not None else check.check(program))
+    if self.__cancel.is_set():
+      return None
+    return result
+
+
+  def __stage(self, phase: int, stages: list):
+    ''' Debut d'une etape de traitement, renvoie False si le chargement est annule '''
+    if self.__cancel.is_set():
+      return False
+    self.sig_progress.emit(phase, stages.index(phase) * 1000 // len(stages))
+    return True
+
+
+  @staticmethod
+  def __lineText(mm, index, num: int):
+    ''' Texte de la ligne num du fichier, comme gcodeListModel.lineText() '''
+    start = index[num]
+    end = mm.find(b'\n', start)
+    if end == -1:
+      end = len(mm)
+    return mm[start:end].decode('utf-8', errors='replace').strip()
+
+
+  def __index(self, mm, size: int, keep: bool = False):
+    '''
+    Indexation de start a la fin du fichier, renvoie None en cas d'annulation, sinon
+    les debuts de lignes trouves si keep est vrai (pour le cache), un tableau vide sinon.
+    '''
+    starts    = array('q')
+    pos       = self.__start
+    debut     = pos            # Debut de la partie non encore transmise
+    pending   = array('q')
+    lastEmit  = time.time()
+    progress  = -1
+    while pos < size:
+      if self.__cancel.is_set():
+        return None
+      # Bloc suivant, arrondi a la fin de ligne. Les petits blocs limitent la duree
+      # pendant laquelle le thread garde le GIL (decoupage des lignes en C).
+      fin = min(pos + GCODE_LOADER_BLOCK, size)
+      if fin < size:
+        nl = mm.find(b'\n', fin - 1)
+        fin = size if nl == -1 else nl + 1
+      pending.extend(gcodeListModel.buildIndex(mm, size, pos, fin))
+      pos = fin
+      if (time.time() - lastEmit) * 1000 >= GCODE_LOADER_EMIT_DELAY or pos >= size:
+        if keep:
+          starts.extend(pending)
+        self.sig_block.emit(self.__generation, debut, pos, pending)
+        debut    = pos
+        pending  = array('q')
+        lastEmit = time.time()
+      permille = pos * 1000 // size
+      if permille != progress:
+        progress = permille
+        self.sig_progress.emit(LOADER_PHASE_INDEX, progress)
+    return starts
+
+
+  @staticmethod
+  def __split(mm, size: int, blockSize: int):
+    ''' Bornes (debut, fin) des blocs d'environ blockSize octets, coupes apres une fin de ligne '''
+    bornes = []
+    pos = 0
+    while pos < size:
+      fin = min(pos + blockSize, size)
+      if fin < size:
+        nl = mm.find(b'\n', fin - 1)
+        fin = size if nl == -1 else nl + 1
+      bornes.append((pos, fin))
+      pos = fin
+    return bornes
+
+
+  def __parse(self, mm, size: int):
+    '''
+    Pre-analyse de toutes les lignes du fichier, decoupees comme dans gcodeListModel,
+    dans plusieurs processus pour les gros fichiers. Renvoie None en cas d'annulation.
+    '''
+    processes = GCODE_PARSE_PROCESSES if GCODE_PARSE_PROCESSES > 0 else (os.cpu_count() or 1)
+    program = None
+    if processes > 1 and size >= GCODE_PARSE_PARALLEL_MIN:
+      try:
+        program = self.__parseParallel(mm, size, processes)
+      except (OSError, RuntimeError) as err:
+        # Processus indisponibles (environnement restreint...), analyse dans ce thread
+        self.sig_log.emit(logSeverity.warning.value, self.tr("gcodeLoader: Parallel analysis unavailable ({}), using a single thread.").format(err))
+    if program is None and not self.__cancel.is_set():
+      program = self.__parseSerial(mm, size)
+    return program
+
+
+  def __parseSerial(self, mm, size: int):
+    program  = gcodeProgram()
+    progress = -1
+    for debut, fin in self.__split(mm, size, GCODE_LOADER_BLOCK):
+      if self.__cancel.is_set():
+        return None
+      # Le saut de ligne final ne commence pas de nouvelle ligne
+      program.appendBlock(mm[debut:fin - 1] if mm[fin - 1] == 0x0a else mm[debut:fin])
+      permille = fin * 1000 // size
+      if permille != progress:
+        progress = permille
+        self.sig_progress.emit(LOADER_PHASE_PARSE, progress)
+    return program
+
+
+  def __parseParallel(self, mm, size: int, processes: int):
+    '''
+    Analyse des troncons de GCODE_PARSE_CHUNK octets dans un groupe de processus, puis
+    raccordement dans l'ordre du fichier (gcodeProgram.extend() reporte l'etat modal
+    de sortie de chaque troncon en entree du suivant).
+    '''
+    bornes = self.__split(mm, size, GCODE_PARSE_CHUNK)
+    # spawn : pas de fork d'un processus qui execute Qt, et meme comportement sous Windows
+    pool = ProcessPoolExecutor(max_workers=min(processes, len(bornes)), mp_context=multiprocessing.get_context('spawn'))
+    try:
+      futures = [pool.submit(parseChunk, self.__filePath, debut, fin) for debut, fin in bornes]
+      program  = gcodeProgram()
+      progress = -1
+      for (debut, fin), future in zip(bornes, futures):
+        while not future.done():
+          if self.__cancel.is_set():
+            return None
+          wait([future], timeout=0.1)
+        program.extend(future.result())
+        permille = fin * 1000 // size
+        if permille != progress:
+          progress = permille
+          self.sig_progress.emit(LOADER_PHASE_PARSE, progress)
+      return program
+    finally:
+      # Sans attendre les troncons en cours en cas d'annulation
+      pool.shutdown(wait=False, cancel_futures=True)
+
+
+def parseChunk(filePath: str, start: int, end: int):
+  ''' Analyse des octets start a end du fichier, executee dans un processus de l'analyse parallele '''
+  with open(filePath, 'rb') as f:
+    f.seek(start)
+    data = f.read(end - start)
+  program = gcodeProgram()
+  program.parseBlock(data[:-1] if data[-1:] == b'\n' else data)
+  return program
@@ -0,0 +1,149 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import numpy as np
+from cn5X_config import *
+from cn5X_gcodeProgram import *
+from cn5X_gcodeTrajectory import *
+
+''' Nombre maxi de passes de fusion '''
+MERGE_MAX_PASSES = 64
+
+
+class gcodeMerge():
+  '''
+  Fusion des suites de mouvements lineaires (G1) colineaires ou presque, pour reduire le
+  nombre de lignes a transmettre a Grbl (un aller-retour serie par ligne).
+  Une ligne est retiree et son mouvement fusionne avec celui de la ligne suivante, qui
+  est conservee telle quelle, si :
+  - les deux lignes sont des G1 en coordonnees absolues (G90), a la meme vitesse F,
+    sans autre mot (M, G non modaux, commentaires...) et la ligne retiree ne change
+    pas l'etat modal (G1 et F deja en vigueur) ;
+  - la ligne suivante porte tous les axes de la ligne retiree, pour que ses
+    coordonnees suffisent a atteindre le point final ;
+  - tous les points retires restent a moins de tolerance du segment fusionne, axes
+    rotatifs compris (distance calculee dans l'espace de tous les axes, mm et degres).
+  Les points sont retires par passes, en alternant les rangs pairs et impairs pour ne
+  jamais retirer deux points voisins a la fois. Chaque segment conserve un majorant de
+  l'ecart des points deja retires : le retrait d'un point P entre A et B le porte a
+  max(ecart AP, ecart PB) + distance de P a AB, qui doit rester inferieur a la tolerance.
+  '''
+
+  def __init__(self, tolerance: float):
+    self.__tolerance = tolerance
+
+
+  def merge(self, program, trajectory = None):
+    ''' Numeros des lignes conservees (numpy, croissants) '''
+    n = len(program)
+    if trajectory is None:
+      trajectory = gcodeTrajectory(program, [axis for axis in TRAJECTORY_AXES if program.column(axis) is not None])
+    if n < 3 or len(trajectory.axes()) == 0:
+      return np.arange(n)
+    positions = trajectory.positions()
+    motion    = trajectory.motion()
+    flags     = trajectory.flags()
+    feed      = trajectory.values('F')
+    feed      = np.zeros(n) if feed is None else fillColumn(feed, None, 0.0)
+
+    # Lignes G1 simples, la derniere d'une suite est conservee et peut porter un commentaire
+    kept   = trajectory.plainMoves()
+    simple = kept & (flags == 0)
+
+    # Lignes retirables : G1 et F deja en vigueur, ligne suivante compatible portant tous leurs axes
+    candidate = np.zeros(n, dtype=bool)
+    candidate[1:-1] = simple[1:-1] & kept[2:] & (motion[:-2] == TRAJECTORY_LINEAR) \
+                      & (feed[:-2] == feed[1:-1]) & (feed[1:-1] == feed[2:])
+    for axis in trajectory.axes():
+      present = ~np.isnan(trajectory.values(axis, False))
+      candidate[1:-1] &= ~present[1:-1] | present[2:]
+    lignes = np.nonzero(candidate)[0]
+    if len(lignes) == 0:
+      return np.arange(n)
+
+    # Points concernes : lignes candidates et leurs voisines (fin de chaque ligne). Les
+    # points retires sont enleves des tableaux a chaque passe, les voisins conserves d'un
+    # point sont donc toujours ses voisins dans les tableaux.
+    inRegion = candidate.copy()
+    inRegion[lignes - 1] = True
+    inRegion[lignes + 1] = True
+    region = np.nonzero(inRegion)[0]
+    points = positions[region + 1]
+    isCandidate = candidate[region]
+    error = np.zeros(len(region)) # Majorant de l'ecart du segment qui se termine a chaque point
+    keep = np.ones(n, dtype=bool)
+    tolerance = self.__tolerance
+    idle = 0
+    for passe in range(MERGE_MAX_PASSES):
+      c = np.nonzero(isCandidate[1:-1])[0] + 1
+      c = c[c % 2 == passe % 2]
+      # Distance de chaque point au segment entre ses voisins
+      A = points[c - 1]
+      AB = points[c + 1] - A
+      AP = points[c] - A
+      norm2 = np.sum(AB * AB, axis=1)
+      t = np.clip(np.sum(AP * AB, axis=1) / np.where(norm2 > 0, norm2, 1.0), 0.0, 1.0)
+      ecart = np.sqrt(np.sum((AP - t[:, None] * AB) ** 2, axis=1))
+      bound = np.maximum(error[c], error[c + 1]) + ecart
+      remove = bound <= tolerance
+      if not np.any(remove):
+        idle += 1
+        if idle >= 2:
+          break
+        continue
+      idle = 0
+      c = c[remove]
+      error[c + 1] = bound[remove]
+      keep[region[c]] = False
+      alive = np.ones(len(region), dtype=bool)
+      alive[c] = False
+      region      = region[alive]
+      points      = points[alive]
+      isCandidate = isCandidate[alive]
+      error       = error[alive]
+
+    return np.nonzero(keep)[0]
+
+
+if __name__ == '__main__':
+  import sys, time, math
+  # Mesure : gcodeMerge.py [fichier.ngc [tolerance]], par defaut 1 million de points sur des cercles (5 degres de A par tour)
+  tolerance = float(sys.argv[2]) if len(sys.argv) > 2 else GCODE_MERGE_TOLERANCE
+  if len(sys.argv) > 1:
+    with open(sys.argv[1], 'rb') as f:
+      data = f.read().rstrip(b'\n')
+  else:
+    lignes = ["G21 G90 G17", "G0 X20 Y0 Z1 A0", "G1 Z-1 F800"]
+    for i in range(1, 1000001):
+      angle = i * 2.0 * math.pi / 3600
+      lignes.append("X{:.4f} Y{:.4f} A{:.4f}".format(20.0 * math.cos(angle), 20.0 * math.sin(angle), i * 5.0 / 3600))
+    lignes.append("M30")
+    data = "\n".join(lignes).encode()
+  program = gcodeProgram()
+  program.appendBlock(data)
+  t0 = time.time()
+  rows = gcodeMerge(tolerance).merge(program)
+  t1 = time.time()
+  merged = program.select(rows.tolist())
+  t2 = time.time()
+  print("{} -> {} lines within {} in {:.2f}s (+ {:.2f}s to rebuild the program)".format(len(program), len(merged), tolerance, t1 - t0, t2 - t1))
@@ -0,0 +1,315 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+from cn5X_config import *
+from cn5X_gcodeParser import gcodeParser
+
+''' Groupes modaux suivis, valeurs initiales identiques a celles de Grbl apres un reset '''
+MODAL_DEFAULT_STATE = {
+  "motion":   "G0",
+  "wcs":      "G54",
+  "plane":    "G17",
+  "units":    "G21",
+  "distance": "G90",
+  "feedMode": "G94",
+  "spindle":  "M5",
+  "coolant":  "M9",
+  "tool":     0,
+  "feed":     0.0,
+  "speed":    0.0
+}
+
+''' Mots G modaux et groupe correspondant '''
+MODAL_G_GROUPS = {
+  "G0": "motion", "G1": "motion", "G2": "motion", "G3": "motion",
+  "G38.2": "motion", "G38.3": "motion", "G38.4": "motion", "G38.5": "motion", "G80": "motion",
+  "G54": "wcs", "G55": "wcs", "G56": "wcs", "G57": "wcs", "G58": "wcs", "G59": "wcs",
+  "G17": "plane", "G18": "plane", "G19": "plane",
+  "G20": "units", "G21": "units",
+  "G90": "distance", "G91": "distance",
+  "G93": "feedMode", "G94": "feedMode"
+}
+
+''' Bits de changement d'etat modal par groupe, cf. gcodeProgram.modalBits() '''
+MODAL_BITS = {group: 1 << i for i, group in enumerate(MODAL_DEFAULT_STATE)}
+MODAL_BIT_PROGRAM_END = 1 << len(MODAL_DEFAULT_STATE) # M2 ou M30
+
+''' Etat repris par Grbl en fin de programme (M2, M30) '''
+MODAL_PROGRAM_END = {
+  "motion":   "G1",
+  "wcs":      "G54",
+  "plane":    "G17",
+  "distance": "G90",
+  "feedMode": "G94",
+  "spindle":  "M5",
+  "coolant":  "M9"
+}
+
+
+class gcodeModalState():
+  '''
+  Suivi cote client de l'etat modal du parser GCode de Grbl (mouvement, plan, unites,
+  mode de distance, systeme de coordonnees, avance, broche, arrosage et outil).
+  L'etat est mis a jour avec chaque ligne acquittee par Grbl (apply()) et recale
+  sur la reponse a $G quand elle est disponible (reconcile()). gcState() renvoie
+  l'etat au format de la reponse a $G pour que grblDecode l'affiche.
+  '''
+
+  def __init__(self):
+    self.__parser = gcodeParser()
+    self.__state  = dict(MODAL_DEFAULT_STATE)
+    self.__changed = True
+    self.__coolant    = None  # (M7, M8) vus sur la ligne en cours d'application
+    self.__programEnd = False # M2 ou M30 vu sur la ligne en cours d'application
+
+
+  def reset(self):
+    ''' Etat initial de Grbl (soft reset) '''
+    self.__state   = dict(MODAL_DEFAULT_STATE)
+    self.__changed = True
+
+
+  def state(self):
+    return dict(self.__state)
+
+
+  def setState(self, state: dict):
+    ''' Reprise d'un etat complet (cf. state()) '''
+    self.__state   = dict(state)
+    self.__changed = True
+
+
+  def changed(self):
+    ''' Renvoie vrai si l'etat a change depuis le dernier appel a gcState() '''
+    return self.__changed
+
+
+  def __set(self, group: str, value):
+    if self.__state[group] != value:
+      self.__state[group] = value
+      self.__changed = True
+
+
+  def apply(self, gcodeLine: str):
+    ''' Mise a jour de l'etat avec une ligne executee par Grbl '''
+    if gcodeLine[:1] == "$":
+      # Commandes systeme de Grbl (le jog $J= ne modifie pas l'etat modal)
+      return
+    self.__coolant    = None
+    self.__programEnd = False
+    words, comments = self.__parser.tokenize(gcodeLine)
+    for letter, text, value in words:
+      if value is None:
+        continue
+      if letter in "GM":
+        # Mot normalise : "G01" -> "G1", "G038.20" -> "G38.2"
+        self.__applyCode("{}{:g}".format(letter, value))
+      elif letter in "FST":
+        if letter == "F":
+          self.__set("feed", value)
+        elif letter == "S":
+          self.__set("speed", value)
+        else:
+          self.__set("tool", int(value))
+    self.__endLine()
+
+
+  def applyProgram(self, program, num: int):
+    '''
+    Mise a jour de l'etat avec la ligne num du programme pre-analyse (gcodeProgram),
+    sans nouvelle analyse du texte de la ligne.
+    '''
+    bits = program.modalBits(num)
+    if bits == 0:
+      return
+    if bits & MODAL_BITS["motion"]:
+      self.__set("motion", program.motion(num))
+    if bits & MODAL_BITS["feed"]:
+      self.__set("feed", program.value('F', num))
+    if bits & MODAL_BITS["speed"]:
+      self.__set("speed", program.value('S', num))
+    if bits & MODAL_BITS["tool"]:
+      self.__set("tool", int(program.value('T', num)))
+    self.__coolant    = None
+    self.__programEnd = False
+    for code in program.codes(num):
+      self.__applyCode(code)
+    self.__endLine()
+
+
+  def __applyCode(self, code: str):
+    ''' Mot G ou M normalise ("G1", "M8"...) '''
+    if code in MODAL_G_GROUPS:
+      self.__set(MODAL_G_GROUPS[code], code)
+    elif code in ["M3", "M4", "M5"]:
+      self.__set("spindle", code)
+    elif code == "M7":
+      self.__coolant = (True, self.__coolant[1]) if self.__coolant is not None else (True, None)
+    elif code == "M8":
+      self.__coolant = (self.__coolant[0], True) if self.__coolant is not None else (None, True)
+    elif code == "M9":
+      self.__coolant = (False, False)
+    elif code in ["M2", "M30"]:
+      self.__programEnd = True
+
+
+  def __endLine(self):
+    '''
+    Fin de l'application d'une ligne : arrosage (M7 et M8 se cumulent, M9 les arrete
+    tous les deux) puis fin de programme, executee en dernier par Grbl.
+    '''
+    if self.__coolant is not None:
+      self.__applyCoolant()
+    if self.__programEnd:
+      for group, value in MODAL_PROGRAM_END.items():
+        self.__set(group, value)
+
+
+  def __applyCoolant(self):
+    mist, flood = self.__coolant
+    coolant = self.__state["coolant"]
+    if mist is False:
+      coolant = "M9"
+    else:
+      mist  = mist  or coolant in ["M7", "M78"]
+      flood = flood or coolant in ["M8", "M78"]
+      coolant = "M78" if mist and flood else "M7" if mist else "M8"
+    self.__set("coolant", coolant)
+
+
+  def reconcile(self, gcState: str):
+    ''' Recalage sur la reponse de Grbl a $G : [GC:G0 G54 G17 G21 G90 G94 M5 M9 T0 F0 S0] '''
+    coolant = []
+    for word in gcState[4:-1].split(" "):
+      if word == "":
+        continue
+      letter = word[0]
+      if letter == "G" and word in MODAL_G_GROUPS:
+        self.__set(MODAL_G_GROUPS[word], word)
+      elif word in ["M3", "M4", "M5"]:
+        self.__set("spindle", word)
+      elif word in ["M7", "M8"]:
+        coolant.append(word)
+      elif word == "M9":
+        coolant = []
+      elif letter in "FST":
+        try:
+          value = float(word[1:])
+        except ValueError:
+          continue
+        self.__set({"F": "feed", "S": "speed", "T": "tool"}[letter], int(value) if letter == "T" else value)
+    self.__set("coolant", "M78" if len(coolant) == 2 else coolant[0] if len(coolant) == 1 else "M9")
+    # L'etat affiche est maintenant celui renvoye par Grbl
+    self.__changed = False
+
+
+  def gcState(self):
+    ''' Etat au format de la reponse de Grbl a $G '''
+    self.__changed = False
+    s = self.__state
+    return "[GC:{} {} {} {} {} {} {} {} T{} F{:g} S{:g}]".format(
+      s["motion"], s["wcs"], s["plane"], s["units"], s["distance"], s["feedMode"],
+      s["spindle"], s["coolant"], s["tool"], s["feed"], s["speed"]
+    )
+
+
+if __name__ == '__main__':
+  # Verification rapide : suivi d'un petit programme
+  modal = gcodeModalState()
+  for ligne in ["G21 G90 G54", "G00 X0 Y0 (rapid)", "M3 S12000", "M8", "M7", "G01 Z-1 F250", "G91 G2 X5 I2.5", "T2 M6", "M9 M5", "M30"]:
+    modal.apply(ligne)
+    print("{:24} {}".format(ligne, modal.gcState()))
+
+  # Verification de l'analyse du programme (cf. gcodeProgram, gcodeLoader) : sur des programmes
+  # aleatoires, les colonnes et modalState() doivent etre identiques a l'analyse ligne par ligne
+  # quel que soit le mode de construction (blocs, troncons recuperes par pickle et raccordes par
+  # extend(), vrai groupe de processus).
+  import os, sys, random, pickle, tempfile, multiprocessing
+  from concurrent.futures import ProcessPoolExecutor
+  from cn5X_gcodeProgram import gcodeProgram
+  from cn5X_gcodeLoader import parseChunk
+
+  def ligneAleatoire():
+    return random.choice([
+      "G0 X{} Y{}", "G1 X{} F{}", "G01 Z{} (plonge)", "X{} Y{}", "G2 X{} Y{} I{} J0", "G3 X{} R{}",
+      "G17", "G18 G91", "G19 G90", "G20", "G21", "G54", "G55 G0 X{}", "G93 G1 X{} F{}", "G94",
+      "M3 S{}", "M4", "M5", "M7", "M8", "M9", "M7 M8", "T{} M6", "T{}", "F{}", "S{}", "G4 P{}",
+      "G92 X{}", "G10 L2 P1 X{}", "G28", "G38.2 Z{} F{}", "M0", "M2", "M30", "$H", "$J=X{} F{}",
+      "; commentaire", "", "G1 X1.2.3", "G1 XA", "n10 g1 x{}", "G80", "G43.1 Z{}", "G61", "M56"
+    ]).format(*(round(random.uniform(-50, 50), random.randint(0, 4)) for _ in range(4)))
+
+  def colonnes(program):
+    return (program.opcodeColumn().tobytes(), program.flagsColumn().tobytes(), program.modalBitsColumn().tobytes(),
+            {l: program.column(l).tobytes() for l in program.letters()}, [program.codes(n) for n in range(len(program))])
+
+  def identiques(program, reference, etats, mode):
+    assert colonnes(program) == colonnes(reference), mode
+    for num in range(len(reference) + 1):
+      assert program.modalState(num).state() == etats[num], (mode, num)
+
+  random.seed(1)
+  pool = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('spawn'))
+  try:
+    for essai in range(200):
+      lignes = [ligneAleatoire() for _ in range(random.randint(1, 300))]
+      # Reference : analyse et suivi de l'etat ligne par ligne
+      reference = gcodeProgram()
+      modal = gcodeModalState()
+      etats = [modal.state()]
+      for ligne in lignes:
+        reference.append(ligne)
+        modal.apply(ligne)
+        etats.append(modal.state())
+      coupes = sorted(random.sample(range(1, len(lignes)), min(len(lignes) - 1, random.randint(0, 5)))) if len(lignes) > 1 else []
+      troncons = [lignes[d:f] for d, f in zip([0] + coupes, coupes + [len(lignes)])]
+      # Blocs analyses a la suite
+      blocs = gcodeProgram()
+      for troncon in troncons:
+        blocs.appendBlock("\n".join(troncon).encode())
+      identiques(blocs, reference, etats, "blocks")
+      # Troncons analyses separement, transmis par pickle et raccordes
+      raccord = gcodeProgram()
+      for troncon in troncons:
+        part = gcodeProgram()
+        part.parseBlock("\n".join(troncon).encode())
+        raccord.extend(pickle.loads(pickle.dumps(part)))
+      identiques(raccord, reference, etats, "extend")
+      # Groupe de processus reel (parseChunk() de gcodeLoader) sur un fichier temporaire
+      if essai % 20 == 0:
+        fd, chemin = tempfile.mkstemp(suffix=".ngc")
+        with os.fdopen(fd, 'wb') as f:
+          bornes = []
+          for troncon in troncons:
+            debut = f.tell()
+            f.write(("\n".join(troncon) + "\n").encode())
+            bornes.append((debut, f.tell()))
+        try:
+          parallele = gcodeProgram()
+          for part in pool.map(parseChunk, [chemin] * len(bornes), *zip(*bornes)):
+            parallele.extend(part)
+          identiques(parallele, reference, etats, "pool")
+        finally:
+          os.remove(chemin)
+  finally:
+    pool.shutdown()
+  print("gcodeProgram columns and modalState() identical to the line by line analysis on 200 random programs (blocks, extend, process pool)")
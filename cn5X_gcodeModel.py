@@ -0,0 +1,359 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import os, sys, time, mmap, operator
+from array import array
+from itertools import accumulate, islice, repeat
+from PyQt6.QtCore import Qt, QAbstractListModel, QModelIndex
+from cn5X_config import *
+
+''' Taille des blocs indexes a l'ouverture du fichier et a la demande de la vue (fetchMore()) '''
+GCODE_INDEX_CHUNK = 16 * 1024 * 1024
+
+
+class gcodeListModel(QAbstractListModel):
+  '''
+  Modele de la liste des lignes du fichier GCode pour la QListView.
+  Le fichier est projete en memoire (mmap), seul un index des debuts de lignes
+  (8 octets par ligne) est construit, par blocs : le premier a l'ouverture, les
+  suivants par le thread de chargement (appendIndex(), cf. gcodeLoader), quand la
+  vue les demande (fetchMore()) ou quand toutes les lignes sont necessaires
+  (indexAll()). Le texte d'une ligne n'est decode que lorsque la vue (ou l'envoi
+  a Grbl) le demande.
+  Les lignes modifiees ou inserees sont conservees dans une liste a part (overlay) :
+  une valeur d'index negative -(n+1) designe l'element n de cette liste.
+  '''
+
+  def __init__(self, parent = None):
+    super().__init__(parent)
+    self.__file    = None
+    self.__path    = ""
+    self.__mmap    = None
+    self.__size    = 0
+    self.__indexed = 0           # Nombre d'octets du fichier deja indexes
+    self.__generation = 0        # Incremente a chaque ouverture, identifie les blocs du thread de chargement
+    self.__loading = False       # Indexation confiee au thread de chargement
+    self.__starts  = array('q') # Debut de chaque ligne dans le fichier ou -(n+1) pour self.__overlay[n]
+    self.__overlay = []
+
+
+  def openFile(self, filePath: str, firstBlock: int = GCODE_INDEX_CHUNK):
+    ''' Projette le fichier en memoire et indexe le premier bloc de lignes (firstBlock octets) '''
+    f = open(filePath, 'rb')
+    try:
+      size = os.fstat(f.fileno()).st_size
+      mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+    except Exception:
+      f.close()
+      raise
+    self.beginResetModel()
+    self.__close()
+    self.__file    = f
+    self.__path    = filePath
+    self.__mmap    = mm
+    self.__size    = size
+    self.__indexed = 0
+    self.__overlay = []
+    self.__generation += 1
+    self.__loading = False
+    self.__starts, self.__indexed = self.__nextBlock(firstBlock)
+    self.endResetModel()
+
+
+  def fileSize(self):
+    return self.__size
+
+
+  def indexedBytes(self):
+    return self.__indexed
+
+
+  def generation(self):
+    return self.__generation
+
+
+  def setLoading(self, loading: bool):
+    ''' Pendant le chargement en tache de fond, la vue ne demande pas d'indexation (fetchMore()) '''
+    self.__loading = loading
+
+
+  def appendIndex(self, generation: int, start: int, end: int, starts: array):
+    '''
+    Ajout des lignes indexees par le thread de chargement entre les octets start et end.
+    Les blocs d'un autre fichier ou deja indexes entre temps (indexAll()) sont ignores.
+    '''
+    if generation != self.__generation or start != self.__indexed:
+      return False
+    if len(starts) > 0:
+      row = len(self.__starts)
+      self.beginInsertRows(QModelIndex(), row, row + len(starts) - 1)
+      self.__starts.extend(starts)
+      self.endInsertRows()
+    self.__indexed = end
+    return True
+
+
+  def isIndexed(self):
+    ''' Vrai si toutes les lignes du fichier sont dans l'index '''
+    return self.__indexed >= self.__size
+
+
+  def __nextBlock(self, nbOctets: int):
+    ''' Index des lignes des nbOctets suivants, arrondi a la fin de ligne : renvoie (debuts de lignes, fin du bloc) '''
+    fin = min(self.__indexed + nbOctets, self.__size)
+    if fin < self.__size:
+      nl = self.__mmap.find(b'\n', fin - 1)
+      fin = self.__size if nl == -1 else nl + 1
+    return self.buildIndex(self.__mmap, self.__size, self.__indexed, fin), fin
+
+
+  def __appendBlock(self, nbOctets: int):
+    ''' Ajoute a la liste les lignes des nbOctets suivants du fichier '''
+    if self.__indexed >= self.__size:
+      return
+    starts, fin = self.__nextBlock(nbOctets)
+    if len(starts) > 0:
+      row = len(self.__starts)
+      self.beginInsertRows(QModelIndex(), row, row + len(starts) - 1)
+      self.__starts.extend(starts)
+      self.endInsertRows()
+    self.__indexed = fin
+
+
+  def canFetchMore(self, parent = QModelIndex()):
+    return not parent.isValid() and not self.__loading and self.__indexed < self.__size
+
+
+  def fetchMore(self, parent = QModelIndex()):
+    ''' Indexe le bloc suivant quand la vue arrive en fin de liste '''
+    if not parent.isValid():
+      self.__appendBlock(GCODE_INDEX_CHUNK)
+
+
+  def indexAll(self):
+    ''' Indexe tout le reste du fichier (nombre exact de lignes, enregistrement, modifications...) '''
+    self.__appendBlock(self.__size)
+
+
+  @staticmethod
+  def buildIndex(mm, size: int, start: int = 0, end: int = -1):
+    '''
+    Renvoie le tableau des debuts de lignes de mm entre start et end, en un seul passage.
+    Le decoupage de chaque bloc (split) et le cumul des longueurs sont faits en C.
+    '''
+    if end == -1:
+      end = size
+    starts = array('q')
+    if mm is None or start >= end:
+      return starts
+    starts.append(start)
+    pos = start
+    while pos < end:
+      fin = min(pos + GCODE_INDEX_CHUNK, end)
+      if fin < end:
+        # Coupe le bloc apres le dernier saut de ligne
+        nl = mm.rfind(b'\n', pos, fin)
+        if nl == -1:
+          nl = mm.find(b'\n', fin, end)
+        fin = end if nl == -1 else nl + 1
+      lignes = mm[pos:fin].split(b'\n')
+      # Debut de la ligne suivante = debut de la ligne + longueur + 1 (saut de ligne)
+      starts.extend(islice(accumulate(map(operator.add, map(len, lignes[:-1]), repeat(1)), initial=pos), 1, None))
+      pos = fin
+    if starts[-1] >= end:
+      # La ligne commencant a end appartient au bloc suivant (ou le fichier
+      # se termine par un saut de ligne : pas de ligne vide supplementaire)
+      starts.pop()
+    return starts
+
+
+  def __close(self):
+    if self.__mmap is not None:
+      self.__mmap.close()
+      self.__mmap = None
+    if self.__file is not None:
+      self.__file.close()
+      self.__file = None
+
+
+  def releaseFile(self):
+    '''
+    Libere le fichier projete sans toucher a l'index ni aux lignes modifiees, pour qu'il
+    puisse etre remplace (cf. gcodeFile.saveFile()). Les lignes du fichier ne sont plus
+    lisibles jusqu'a reopenFile() ou openFile().
+    '''
+    self.indexAll()
+    self.__close()
+
+
+  def reopenFile(self):
+    ''' Reprojette le fichier libere par releaseFile(), inchange depuis : l'index reste valable '''
+    if self.__path == "":
+      return # Liste sans fichier source
+    f = open(self.__path, 'rb')
+    try:
+      mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.__size > 0 else None
+    except Exception:
+      f.close()
+      raise
+    self.__file = f
+    self.__mmap = mm
+
+
+  def clear(self):
+    ''' Vide la liste et libere le fichier '''
+    self.beginResetModel()
+    self.__close()
+    self.__path    = ""
+    self.__size    = 0
+    self.__indexed = 0
+    self.__generation += 1
+    self.__loading = False
+    self.__starts  = array('q')
+    self.__overlay = []
+    self.endResetModel()
+
+
+  def lineText(self, row: int):
+    ''' Texte de la ligne row (sans les espaces de debut et de fin), None si row est hors limites '''
+    if row < 0 or row >= len(self.__starts):
+      return None
+    start = self.__starts[row]
+    if start < 0:
+      return self.__overlay[-start - 1]
+    end = self.__mmap.find(b'\n', start)
+    if end == -1:
+      end = len(self.__mmap)
+    return self.__mmap[start:end].decode('utf-8', errors='replace').strip()
+
+
+  def lines(self):
+    ''' Iterateur sur le texte de toutes les lignes '''
+    self.indexAll()
+    for row in range(len(self.__starts)):
+      yield self.lineText(row)
+
+
+  def rowCount(self, parent = QModelIndex()):
+    if parent.isValid():
+      return 0
+    return len(self.__starts)
+
+
+  def data(self, index: QModelIndex, role = Qt.ItemDataRole.DisplayRole):
+    if not index.isValid():
+      return None
+    if role in [Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.EditRole]:
+      return self.lineText(index.row())
+    return None
+
+
+  def flags(self, index: QModelIndex):
+    if not index.isValid():
+      return Qt.ItemFlag.NoItemFlags
+    return Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsEditable
+
+
+  def setData(self, index: QModelIndex, value, role = Qt.ItemDataRole.EditRole):
+    if not index.isValid() or role != Qt.ItemDataRole.EditRole:
+      return False
+    self.__overlay.append(str(value))
+    self.__starts[index.row()] = -len(self.__overlay)
+    self.dataChanged.emit(index, index, [role])
+    return True
+
+
+  def selectRows(self, rows, texts: dict = None):
+    '''
+    Ne conserve que les lignes rows (numeros croissants) et remplace le texte des lignes
+    {nouveau numero: texte} (cf. gcodeMerge, gcodeArcFit). Renvoie l'index precedent,
+    pour restoreRows().
+    '''
+    self.indexAll()
+    starts = self.__starts
+    self.beginResetModel()
+    self.__starts = array('q', map(starts.__getitem__, rows))
+    if texts is not None:
+      for row, text in texts.items():
+        self.__overlay.append(text)
+        self.__starts[row] = -len(self.__overlay)
+    self.__generation += 1
+    self.endResetModel()
+    return starts
+
+
+  def restoreRows(self, starts: array):
+    ''' Retour aux lignes d'avant selectRows() '''
+    self.beginResetModel()
+    self.__starts = starts
+    self.__generation += 1
+    self.endResetModel()
+
+
+  def insertRows(self, row: int, count: int, parent = QModelIndex()):
+    # Les modifications de structure se font sur l'index complet du fichier
+    self.indexAll()
+    if parent.isValid() or row < 0 or row > len(self.__starts):
+      return False
+    self.beginInsertRows(parent, row, row + count - 1)
+    for i in range(count):
+      self.__overlay.append("")
+      self.__starts.insert(row, -len(self.__overlay))
+    self.endInsertRows()
+    return True
+
+
+  def removeRows(self, row: int, count: int, parent = QModelIndex()):
+    self.indexAll()
+    if parent.isValid() or row < 0 or row + count > len(self.__starts):
+      return False
+    self.beginRemoveRows(parent, row, row + count - 1)
+    del self.__starts[row:row + count]
+    self.endRemoveRows()
+    return True
+
+
+if __name__ == '__main__':
+  # Ouverture d'un gros fichier : python3 cn5X_gcodeModel.py [nombre de lignes]
+  import tempfile
+  nbLignes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+  with tempfile.NamedTemporaryFile('w', suffix='.ngc', delete=False) as f:
+    for i in range(nbLignes):
+      f.write("G1 X{:.3f} Y{:.3f} Z-0.5\n".format(i * 0.001, (i % 1000) * 0.01))
+    nomFichier = f.name
+  taille = os.path.getsize(nomFichier)
+  model = gcodeListModel()
+  t0 = time.perf_counter()
+  model.openFile(nomFichier)
+  tOuverture = time.perf_counter() - t0
+  t0 = time.perf_counter()
+  model.indexAll()
+  duree = time.perf_counter() - t0
+  n = model.rowCount()
+  print("{:.1f} MB opened in {:.3f}s, {} lines fully indexed in {:.3f}s ({:.0f} MB/s), index {:.1f} MB".format(
+    taille / 1e6, tOuverture, n, duree, taille / 1e6 / duree, n * 8 / 1e6))
+  assert n == nbLignes
+  assert model.lineText(0) == "G1 X0.000 Y0.000 Z-0.5"
+  assert model.lineText(n - 1) == "G1 X{:.3f} Y{:.3f} Z-0.5".format((n - 1) * 0.001, ((n - 1) % 1000) * 0.01)
+  model.clear()
+  os.remove(nomFichier)
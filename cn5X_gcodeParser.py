@@ -21,6 +21,7 @@
 '                                                                         '
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 
+import re
 from PyQt6.QtCore import Qt, QObject, pyqtSignal, pyqtSlot
 from cn5X_config import *
 
@@ -28,10 +29,37 @@ LINE_FLAG_OVERFLOW            = 1
 LINE_FLAG_COMMENT_PARENTHESES = 2
 LINE_FLAG_COMMENT_SEMICOLON   = 4
 
+''' Commentaires selon protocol.c de Grbl : "(" jusqu'a ")" ou la fin de ligne (pas d'imbrication), ";" jusqu'a la fin de ligne '''
+GCODE_COMMENT_RE = re.compile(r'\([^)]*\)?|;.*', re.DOTALL)
+''' Espaces et caracteres de controle (<= ' ') et suppression de bloc ("/") ignores par Grbl '''
+GCODE_IGNORED_CHARS = str.maketrans('', '', ''.join(chr(c) for c in range(33)) + '/')
+''' Decoupage de la ligne nettoyee sur les lettres des mots GCode '''
+GCODE_WORD_SPLIT_RE = re.compile('([' + VALIDES_GCODE_WORDS + '])')
+''' Mot GCode : lettre, valeur numerique acceptee par read_float() de Grbl et reste (invalide) jusqu'a la lettre suivante '''
+GCODE_TOKEN_RE = re.compile('([' + VALIDES_GCODE_WORDS + '])([+-]?(?:[0-9]+\\.?[0-9]*|\\.[0-9]+))?([^' + VALIDES_GCODE_WORDS + ']*)')
+
+''' Tables de tokenizeBlock() (octets) '''
+GCODE_BLOCK_COMMENT_RE = re.compile(rb'\([^)\n]*\)?|;[^\n]*')
+GCODE_BLOCK_IGNORED    = bytes(c for c in range(33) if c != ord('\n')) + b'/'
+GCODE_BLOCK_LETTERS    = VALIDES_GCODE_WORDS.encode()
+GCODE_BLOCK_NUMBER     = b'0123456789.+-'
+GCODE_BLOCK_NOT_LETTER = bytes(c for c in range(256) if c not in GCODE_BLOCK_LETTERS + b'\n')
+GCODE_BLOCK_SEPARATORS = bytes.maketrans(GCODE_BLOCK_LETTERS + b'\n', b' ' * (len(GCODE_BLOCK_LETTERS) + 1))
+# Forme des lignes : lettre -> A, chiffre, point ou signe -> 0, autre caractere -> ?
+GCODE_BLOCK_SHAPE      = bytes.maketrans(bytes(range(256)), bytes(
+  ord('A') if c in GCODE_BLOCK_LETTERS else ord('0') if c in GCODE_BLOCK_NUMBER else c if c == ord('\n') else ord('?') for c in range(256)
+))
+
 
 class gcodeParser(QObject):
   '''
   Analyse d'une ligne de GCode
+  Le decoupage est fait en un seul passage par tokenize() (expressions regulieres et
+  table de traduction precompilees), noComment(), wordDict() et wordList() en derivent.
+  Ligne par ligne, le cout fixe des appels Python limite le gain a environ x4 par
+  rapport a l'algorithme d'origine : les traitements en nombre (chargement du fichier,
+  gcodeProgram) passent par tokenizeBlock() (environ x14). tokenize() reste utilise
+  au rythme de la liaison serie (suivi de l'etat modal, envoi d'une ligne, saisie).
   '''
 
   sig_log     = pyqtSignal(int, str) # Message de fonctionnement du composant
@@ -40,6 +68,122 @@ class gcodeParser(QObject):
     super().__init__()
 
 
+  @staticmethod
+  def __clean(gcodeLine: str, comments: list = None):
+    '''
+    Ligne sans commentaires, espaces ni caracteres de controle, en majuscules.
+    Les positions (debut, fin) des commentaires dans gcodeLine sont ajoutees a comments.
+    '''
+    if '(' not in gcodeLine and ';' not in gcodeLine:
+      line = gcodeLine.replace(' ', '')
+      if '/' in line or not line.isprintable():
+        # Tabulations, caracteres de controle...
+        line = line.translate(GCODE_IGNORED_CHARS)
+      return line.upper()
+    morceaux = []
+    pos = 0
+    for m in GCODE_COMMENT_RE.finditer(gcodeLine):
+      morceaux.append(gcodeLine[pos:m.start()])
+      if comments is not None:
+        comments.append(m.span())
+      pos = m.end()
+    morceaux.append(gcodeLine[pos:])
+    return "".join(morceaux).translate(GCODE_IGNORED_CHARS).upper()
+
+
+  @staticmethod
+  def __split(line: str):
+    '''
+    Liste des (lettre, valeur) de la ligne nettoyee. Comme dans l'algorithme d'origine,
+    les caracteres precedant la premiere lettre sont ajoutes a la valeur du premier mot,
+    et une ligne sans lettre donne un seul mot de lettre vide.
+    '''
+    parts = GCODE_WORD_SPLIT_RE.split(line)
+    if len(parts) == 1:
+      return [("", parts[0])]
+    words = [(parts[1], parts[0] + parts[2])]
+    words.extend(zip(parts[3::2], parts[4::2]))
+    return words
+
+
+  def tokenize(self, gcodeLine: str):
+    '''
+    Decoupage complet de la ligne en un seul passage, renvoie (mots, commentaires) :
+    - mots : liste de (lettre, texte de la valeur, valeur numerique ou None si invalide) ;
+    - commentaires : liste des positions (debut, fin) des commentaires dans gcodeLine.
+    '''
+    comments = []
+    line = self.__clean(gcodeLine, comments)
+    if line != "" and line[0] in VALIDES_GCODE_WORDS:
+      letters, numbers, rests = zip(*GCODE_TOKEN_RE.findall(line))
+      if '' not in numbers and not any(rests):
+        # Cas courant : toutes les valeurs sont des nombres, conversion en une fois
+        return list(zip(letters, numbers, map(float, numbers))), comments
+    # Valeurs invalides, caracteres avant la premiere lettre ou ligne vide
+    words = []
+    for letter, text in self.__split(line):
+      m = GCODE_TOKEN_RE.fullmatch(letter + text) if letter != "" else None
+      words.append((letter, text, float(text) if m is not None and m.group(2) and m.group(3) == "" else None))
+    return words, comments
+
+
+  @staticmethod
+  def __shapeOk(shape: bytes):
+    ''' Chaque ligne de la forme est une suite de lettres (A) suivies chacune d'une valeur (0) '''
+    return b'?' not in shape and b'AA' not in shape and b'A\n' not in shape and b'\n0' not in shape \
+           and shape[:1] != b'0' and shape[-1:] != b'A'
+
+
+  def tokenizeBlock(self, data: bytes):
+    '''
+    Decoupage d'un bloc de lignes (octets separes par \\n) en un seul passage, sans boucle
+    Python par ligne ni par mot dans le cas courant. Renvoie (lettres, valeurs, commentaires) :
+    - lettres : par ligne, lettres des mots de la ligne (b'GXYF'), ou None si la ligne n'est pas
+      une simple suite de mots numeriques (commande $, valeur invalide, caractere non ASCII...)
+      et doit etre analysee par tokenize() ;
+    - valeurs : valeurs numeriques des mots des lignes decoupees, dans l'ordre ;
+    - commentaires : numeros des lignes contenant un commentaire.
+    Memes regles que tokenize() pour les commentaires, espaces et valeurs.
+    '''
+    comments = []
+    if b'(' in data or b';' in data:
+      morceaux = []
+      pos = 0
+      ligne = 0
+      for m in GCODE_BLOCK_COMMENT_RE.finditer(data):
+        ligne += data.count(b'\n', pos, m.start())
+        if len(comments) == 0 or comments[-1] != ligne:
+          comments.append(ligne)
+        morceaux.append(data[pos:m.start()])
+        pos = m.end()
+      morceaux.append(data[pos:])
+      data = b"".join(morceaux)
+    data  = data.translate(None, GCODE_BLOCK_IGNORED).upper()
+    shape = data.translate(GCODE_BLOCK_SHAPE)
+    if self.__shapeOk(shape):
+      try:
+        values = list(map(float, data.translate(GCODE_BLOCK_SEPARATORS).split()))
+        return data.translate(None, GCODE_BLOCK_NOT_LETTER).split(b'\n'), values, comments
+      except ValueError:
+        pass # Valeur mal formee (1.2.3, +-1...), recherche ligne par ligne
+    # Lignes a analyser par tokenize() exclues du decoupage du bloc
+    lignes  = data.split(b'\n')
+    letters = []
+    values  = []
+    for l, forme in zip(lignes, shape.split(b'\n')):
+      if not self.__shapeOk(forme):
+        letters.append(None)
+        continue
+      try:
+        valeurs = list(map(float, l.translate(GCODE_BLOCK_SEPARATORS).split()))
+      except ValueError:
+        letters.append(None)
+        continue
+      values.extend(valeurs)
+      letters.append(l.translate(None, GCODE_BLOCK_NOT_LETTER))
+    return letters, values, comments
+
+
   @pyqtSlot(str)
   def noComment(self, gcodeLine: str):
     '''
@@ -47,88 +191,142 @@ class gcodeParser(QObject):
     Utilisation du même algorithme (protocol.c) que Grbl pour la
     supression des commentaires et des espaces dans la ligne.
     '''
+    return self.__clean(gcodeLine)
+
+
+  @pyqtSlot(str)
+  def wordDict(self, gcodeLine: str):
+    '''
+    Renvoi un dictionnaire des mots GCode contenus dans la ligne
+    Sous la forme {'mot': 'valeurs', 'mot': 'valeurs', ...}
+    '''
+    return dict(self.__split(self.__clean(gcodeLine)))
+
+
+  @pyqtSlot(str)
+  def wordList(self, gcodeLine: str):
+    '''
+    Renvoi une liste des mots GCode contenus dans la ligne avec leurs valeurs
+    '''
+    return [letter + text for letter, text in self.__split(self.__clean(gcodeLine))]
+
+
+if __name__ == '__main__':
+  import sys, time, random
+
+  def referenceNoComment(gcodeLine: str):
+    ''' Algorithme caractere par caractere d'origine, pour comparaison '''
     line = ""
     line_flags = 0
     for c in gcodeLine:
       if line_flags:
         if (c == ')'):
-          # End of '()' comment. Resume line allowed.
           if (line_flags & LINE_FLAG_COMMENT_PARENTHESES):
             line_flags &= ~(LINE_FLAG_COMMENT_PARENTHESES)
       else:
         if (c <= ' '):
-          # Throw away whitepace and control characters
           pass
         elif (c == '/'):
-          # Block delete NOT SUPPORTED. Ignore character.
           pass
         elif (c == '('):
-          # Enable comments flag and ignore all characters until ')' or EOL.
-          # NOTE: This doesn't follow the NIST definition exactly, but is good enough for now.
           line_flags |= LINE_FLAG_COMMENT_PARENTHESES;
         elif (c == ';'):
-          # NOTE: ';' comment to EOL is a LinuxCNC definition. Not NIST.
           line_flags |= LINE_FLAG_COMMENT_SEMICOLON;
         else:
-          # Ajout du caractère à la ligne
           line += c.upper();
     return line
 
-
-  @pyqtSlot(str)
-  def wordDict(self, gcodeLine: str):
-    '''
-    Renvoi un dictionnaire des mots GCode contenus dans la ligne
-    Sous la forme {'mot': 'valeurs', 'mot': 'valeurs', ...}
-    '''
-    words = dict()
+  def referenceWordList(gcodeLine: str):
+    liste = []
     currentWord  = ""
     currentValue = ""
-    for c in self.noComment(gcodeLine):
+    for c in referenceNoComment(gcodeLine):
       if c in VALIDES_GCODE_WORDS:
         if currentWord != "":
-          # Ajoute le mot courant au dictionnaire avant de passer au suivant
-          words[currentWord] = currentValue
+          liste.append(currentWord + currentValue)
           currentValue = ""
-        # C'est le nouveau mot courant nouveau mot
         currentWord = c
       else:
         currentValue += c
-    # Ajoute le dernier mot
-    words[currentWord] = currentValue
-    # Revoi le résultat
-    return words
-
+    liste.append(currentWord + currentValue)
+    return liste
 
-  @pyqtSlot(str)
-  def wordList(self, gcodeLine: str):
-    '''
-    Renvoi une liste des mots GCode contenus dans la ligne avec leurs valeurs
-    '''
-    liste = []
+  def referenceWordDict(gcodeLine: str):
+    words = dict()
     currentWord  = ""
     currentValue = ""
-    for c in self.noComment(gcodeLine):
+    for c in referenceNoComment(gcodeLine):
       if c in VALIDES_GCODE_WORDS:
         if currentWord != "":
-          # Ajoute le mot courant au la liste avant de passer au suivant
-          liste.append(currentWord + currentValue)
+          words[currentWord] = currentValue
           currentValue = ""
-        # C'est le nouveau mot courant nouveau mot
         currentWord = c
       else:
         currentValue += c
-    # Ajoute le dernier mot
-    liste.append(currentWord + currentValue)
-    # Revoi le résultat
-    return liste
-
-
-
-
-
+    words[currentWord] = currentValue
+    return words
 
+  def referenceNumber(text: str):
+    try:
+      return float(text) if text.strip() == text and not any(c in text for c in "eEnN_") else None
+    except ValueError:
+      return None
 
+  parser = gcodeParser()
 
+  # Verification de l'equivalence sur des lignes aleatoires
+  random.seed(0)
+  alphabet = "GXYZMFSTIJ0123456789.-+ ()(;/\t$eE" + "gxyz"
+  for i in range(200000):
+    l = "".join(random.choice(alphabet) for _ in range(random.randint(0, 24)))
+    assert parser.noComment(l) == referenceNoComment(l), repr(l)
+    assert parser.wordList(l) == referenceWordList(l), repr(l)
+    assert parser.wordDict(l) == referenceWordDict(l), repr(l)
+    words, comments = parser.tokenize(l)
+    assert [letter + text for letter, text, value in words] == referenceWordList(l), repr(l)
+    assert [value for letter, text, value in words] == [referenceNumber(text) if letter != "" else None for letter, text, value in words], repr(l)
+    # Le texte hors commentaires est bien celui garde par Grbl
+    horsCommentaires = "".join(l[f:d] for (_, f), (d, _) in zip([(0, 0)] + comments, comments + [(len(l), len(l))]))
+    assert referenceNoComment(horsCommentaires) == referenceNoComment(l), repr(l)
+    assert all(l[d] in "(;" for d, f in comments), repr(l)
+  print("tokenize/noComment/wordList/wordDict identical to the reference on 200000 random lines")
 
+  # tokenizeBlock() : memes mots et valeurs que tokenize() pour les lignes decoupees
+  alphabet += "é\r"
+  for i in range(2000):
+    lignes = ["".join(random.choice(alphabet) for _ in range(random.randint(0, 24))) for _ in range(random.randint(1, 50))]
+    letters, values, comments = parser.tokenizeBlock("\n".join(lignes).encode('utf-8'))
+    assert len(letters) == len(lignes)
+    pos = 0
+    for num, l in enumerate(lignes):
+      words, commentaires = parser.tokenize(l)
+      assert (len(commentaires) > 0) == (num in comments), repr(l)
+      if letters[num] is None:
+        continue
+      assert all(value is not None for letter, text, value in words if letter != "") and \
+             letters[num].decode() == "".join(letter for letter, text, value in words), repr(l)
+      assert values[pos:pos + len(letters[num])] == [value for letter, text, value in words if letter != ""], repr(l)
+      pos += len(letters[num])
+    assert pos == len(values)
+  print("tokenizeBlock identical to tokenize on 2000 random blocks")
 
+  # Mesure : tst.ngc repete jusqu'a un million de lignes
+  fichier = sys.argv[1] if len(sys.argv) > 1 else "tst.ngc"
+  with open(fichier, encoding='utf-8', errors='replace') as f:
+    source = [l.strip() for l in f]
+  lignes = (source * (1000000 // len(source) + 1))[:1000000]
+  t0 = time.time()
+  for l in lignes:
+    referenceWordDict(l)
+    referenceWordList(l)
+  t1 = time.time()
+  for l in lignes:
+    parser.tokenize(l)
+  t2 = time.time()
+  blocs = ["\n".join(lignes[debut:debut + 20000]).encode('utf-8') for debut in range(0, len(lignes), 20000)]
+  t3 = time.time()
+  for bloc in blocs:
+    parser.tokenizeBlock(bloc)
+  t4 = time.time()
+  print("{} lines from {} : reference wordDict + wordList {:.2f}s, tokenize {:.2f}s (x{:.1f}), tokenizeBlock {:.2f}s (x{:.1f})".format(
+    len(lignes), fichier, t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1), t4 - t3, (t1 - t0) / (t4 - t3)))
@@ -0,0 +1,486 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+from array import array
+from bisect import bisect_left, bisect_right
+from cn5X_config import *
+from cn5X_gcodeParser import gcodeParser
+from cn5X_gcodeModal import gcodeModalState, MODAL_DEFAULT_STATE, MODAL_G_GROUPS, MODAL_BITS, MODAL_BIT_PROGRAM_END
+
+''' Indicateurs par ligne, cf. gcodeProgram.flags() '''
+PROGRAM_FLAG_EMPTY       = 1   # Pas de GCode (ligne vide ou commentaire seul)
+PROGRAM_FLAG_COMMENT     = 2   # Commentaire () ou ;
+PROGRAM_FLAG_SYSTEM      = 4   # Commande systeme de Grbl ($...)
+PROGRAM_FLAG_TOOL_CHANGE = 8   # M6
+PROGRAM_FLAG_PAUSE       = 16  # M0 ou M1
+PROGRAM_FLAG_NON_MODAL   = 32  # G4, G10, G28, G30, G53, G92... (a relire dans le texte si necessaire)
+PROGRAM_FLAG_INVALID     = 64  # Valeur non numerique, la ligne doit etre relue dans le texte
+
+''' Colonne opcode : mot G de mouvement de la ligne x 10 (G1 -> 10, G38.2 -> 382), ou -1 '''
+PROGRAM_NO_MOTION = -1
+
+''' Mots G sans effet modal (groupe 0 de Grbl), conserves dans codes() '''
+PROGRAM_NON_MODAL_CODES = ["G4", "G10", "G28", "G28.1", "G30", "G30.1", "G53", "G92", "G92.1", "G43.1", "G49"]
+
+PROGRAM_NAN = float('nan')
+
+''' Mots G et M reconnus : (bits modaux, indicateurs, conserve dans codes()) '''
+PROGRAM_CODES = {code: (MODAL_BITS[group], 0, group != "motion") for code, group in MODAL_G_GROUPS.items()}
+PROGRAM_CODES.update({code: (MODAL_BITS["spindle"], 0, True) for code in ["M3", "M4", "M5"]})
+PROGRAM_CODES.update({code: (MODAL_BITS["coolant"], 0, True) for code in ["M7", "M8", "M9"]})
+PROGRAM_CODES.update({code: (MODAL_BIT_PROGRAM_END, 0, True) for code in ["M2", "M30"]})
+PROGRAM_CODES.update({code: (0, PROGRAM_FLAG_PAUSE, False) for code in ["M0", "M1"]})
+PROGRAM_CODES.update({code: (0, PROGRAM_FLAG_NON_MODAL, True) for code in PROGRAM_NON_MODAL_CODES})
+PROGRAM_CODES["M6"] = (0, PROGRAM_FLAG_TOOL_CHANGE, False)
+PROGRAM_BIT_MOTION = MODAL_BITS["motion"]
+
+''' Groupes modaux portes par les colonnes (les autres le sont par codes()) '''
+PROGRAM_COLUMN_BITS = [MODAL_BITS["motion"], MODAL_BITS["feed"], MODAL_BITS["speed"], MODAL_BITS["tool"]]
+
+
+class gcodeProgram():
+  '''
+  Representation compacte d'un programme GCode pre-analyse une seule fois au chargement
+  du fichier, pour que l'envoi, le suivi de l'etat modal (et les analyses du programme
+  complet) n'aient plus a decouper le texte de chaque ligne.
+  Stockage en colonnes (array), une valeur par ligne du fichier :
+  - opcode    : mot G de mouvement de la ligne (x 10), PROGRAM_NO_MOTION si absent ;
+  - valeurs   : une colonne float64 par lettre presente dans le fichier (axes, I, J, K,
+                R, P, F, S, T...), creee a la premiere apparition, NaN si le mot est absent.
+                Le float64 conserve exactement les valeurs ecrites (X1234.5678 n'a pas
+                de representation float32 a 4 decimales), au prix de 8 octets par valeur ;
+  - flags     : PROGRAM_FLAG_* ;
+  - modalBits : groupes modaux modifies par la ligne (MODAL_BITS, MODAL_BIT_PROGRAM_END).
+  Les mots G et M autres que le mouvement (rares) sont conserves a part, par ligne.
+
+  Le programme est decoupe en troncons (un par bloc analyse) dont l'etat modal d'entree
+  est memorise, a partir de l'etat de Grbl apres un reset. L'etat de sortie d'un troncon
+  s'obtient en appliquant seulement les lignes portant des mots modaux autres que le
+  mouvement et les dernieres lignes de mouvement, F, S et T du troncon. Les troncons
+  analyses en parallele (parseBlock() dans d'autres processus) sont ainsi raccordes par
+  extend() sans reanalyse, et modalState() reconstitue l'etat avant n'importe quelle ligne.
+  '''
+
+  def __init__(self):
+    self.__parser    = gcodeParser()
+    self.__count     = 0
+    self.__opcode    = array('h')
+    self.__flags     = array('B')
+    self.__modalBits = array('H')
+    self.__values    = {}  # lettre -> array('d')
+    self.__codes     = {}  # ligne -> tuple des mots G et M normalises (hors mouvement)
+    # Troncons : premiere ligne et etat modal d'entree, le dernier est en cours de remplissage
+    self.__chunkFirst = array('q', [0])
+    self.__chunkEntry = [dict(MODAL_DEFAULT_STATE)]
+    self.__codeLines  = array('q') # Lignes du troncon en cours ayant des codes()
+    self.__lastSet    = {}         # Bit modal -> derniere ligne du troncon en cours le modifiant
+    self.__summary    = {}         # Resultats des analyses du programme complet, conserves avec lui (cf. gcodeCache)
+
+
+  def __getstate__(self):
+    # Le parser (QObject) n'est pas transmis entre processus
+    state = self.__dict__.copy()
+    del state['_gcodeProgram__parser']
+    return state
+
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.__parser = gcodeParser()
+
+
+  def __len__(self):
+    return self.__count
+
+
+  def lineCount(self):
+    return self.__count
+
+
+  def append(self, gcodeLine: str):
+    ''' Analyse de la ligne suivante du fichier et ajout dans les colonnes '''
+    flags = 0
+    words = []
+    tokens, comments = self.__parser.tokenize(gcodeLine)
+    if len(comments) > 0:
+      flags |= PROGRAM_FLAG_COMMENT
+    if gcodeLine[:1] == "$":
+      flags |= PROGRAM_FLAG_SYSTEM
+    else:
+      for letter, text, value in tokens:
+        if value is not None:
+          words.append((letter, value))
+        elif letter != "" or text != "":
+          # Mot sans valeur numerique
+          flags |= PROGRAM_FLAG_INVALID
+    self.__appendWords(words, flags)
+
+
+  def appendBlock(self, data: bytes):
+    ''' Analyse d'un bloc de lignes (cf. parseBlock()) formant un troncon du programme '''
+    self.parseBlock(data)
+    self.__closeChunk()
+
+
+  def parseBlock(self, data: bytes):
+    '''
+    Analyse d'un bloc de lignes du fichier (octets separes par \\n, sans saut de ligne final),
+    decoupe en une fois par gcodeParser.tokenizeBlock(). Les lignes que le bloc ne sait pas
+    decouper (commandes $, valeurs invalides...) passent par append().
+    Les lignes s'ajoutent au troncon en cours, qui reste ouvert (cf. extend()).
+    '''
+    letters, values, comments = self.__parser.tokenizeBlock(data)
+    comments = set(comments)
+    lignes = None
+    pos = 0
+    for num, lettres in enumerate(letters):
+      if lettres is None:
+        if lignes is None:
+          lignes = data.split(b'\n')
+        self.append(lignes[num].decode('utf-8', errors='replace').strip())
+        continue
+      fin = pos + len(lettres)
+      self.__appendWords(zip(lettres.decode(), values[pos:fin]), PROGRAM_FLAG_COMMENT if num in comments else 0)
+      pos = fin
+
+
+  def __appendWords(self, words, flags: int):
+    ''' Ajout d'une ligne a partir de ses mots (lettre, valeur) '''
+    num    = self.__count
+    bits   = 0
+    opcode = PROGRAM_NO_MOTION
+    codes  = []
+    values = {}
+    for letter, value in words:
+      if letter == 'G' or letter == 'M':
+        code = "{}{:g}".format(letter, value)
+        entry = PROGRAM_CODES.get(code)
+        if entry is not None:
+          bits  |= entry[0]
+          flags |= entry[1]
+          if entry[2]:
+            codes.append(code)
+          elif entry[0] == PROGRAM_BIT_MOTION:
+            opcode = int(round(value * 10))
+      else:
+        values[letter] = value
+    if 'F' in values: bits |= MODAL_BITS["feed"]
+    if 'S' in values: bits |= MODAL_BITS["speed"]
+    if 'T' in values: bits |= MODAL_BITS["tool"]
+    if opcode == PROGRAM_NO_MOTION and len(codes) == 0 and len(values) == 0 \
+       and not flags & (PROGRAM_FLAG_SYSTEM | PROGRAM_FLAG_TOOL_CHANGE | PROGRAM_FLAG_PAUSE | PROGRAM_FLAG_NON_MODAL | PROGRAM_FLAG_INVALID):
+      flags |= PROGRAM_FLAG_EMPTY
+
+    # Nouvelles colonnes, completees pour les lignes precedentes
+    for letter in values:
+      if letter not in self.__values:
+        self.__values[letter] = array('d', [PROGRAM_NAN]) * num
+    for letter, column in self.__values.items():
+      column.append(values.get(letter, PROGRAM_NAN))
+    self.__opcode.append(opcode)
+    self.__flags.append(flags)
+    self.__modalBits.append(bits)
+    if len(codes) > 0:
+      self.__codes[num] = tuple(codes)
+      self.__codeLines.append(num)
+    if bits:
+      for bit in PROGRAM_COLUMN_BITS:
+        if bits & bit:
+          self.__lastSet[bit] = num
+    self.__count += 1
+
+
+  def __closeChunk(self):
+    '''
+    Fin du troncon en cours : calcul de son etat modal de sortie, qui est l'etat
+    d'entree du troncon suivant (passe de raccordement des troncons).
+    '''
+    if self.__count == self.__chunkFirst[-1]:
+      return
+    modal = gcodeModalState()
+    modal.setState(self.__chunkEntry[-1])
+    for num in sorted(set(self.__codeLines).union(self.__lastSet.values())):
+      modal.applyProgram(self, num)
+    self.__chunkFirst.append(self.__count)
+    self.__chunkEntry.append(modal.state())
+    self.__codeLines = array('q')
+    self.__lastSet   = {}
+
+
+  def extend(self, part):
+    '''
+    Ajout a la suite d'un programme analyse separement (dans un autre processus) avec
+    parseBlock(). Ses lignes forment un nouveau troncon dont l'etat modal d'entree est
+    l'etat de sortie du programme actuel.
+    '''
+    self.__closeChunk()
+    offset = self.__count
+    n = part.__count
+    for letter in part.__values:
+      if letter not in self.__values:
+        self.__values[letter] = array('d', [PROGRAM_NAN]) * offset
+    for letter, column in self.__values.items():
+      if letter in part.__values:
+        column.extend(part.__values[letter])
+      else:
+        column.extend(array('d', [PROGRAM_NAN]) * n)
+    self.__opcode.extend(part.__opcode)
+    self.__flags.extend(part.__flags)
+    self.__modalBits.extend(part.__modalBits)
+    for num, codes in part.__codes.items():
+      self.__codes[num + offset] = codes
+    self.__codeLines = array('q', (num + offset for num in part.__codeLines))
+    self.__lastSet   = {bit: num + offset for bit, num in part.__lastSet.items()}
+    self.__count += n
+    self.__closeChunk()
+
+
+  def modalState(self, num: int):
+    ''' Etat modal (gcodeModalState) avant l'execution de la ligne num, en partant de l'etat apres reset de Grbl '''
+    chunk = bisect_right(self.__chunkFirst, num) - 1
+    modal = gcodeModalState()
+    modal.setState(self.__chunkEntry[chunk])
+    modalBits = self.__modalBits
+    for n in range(self.__chunkFirst[chunk], min(num, self.__count)):
+      if modalBits[n]:
+        modal.applyProgram(self, n)
+    return modal
+
+
+  def chunkCount(self):
+    return len(self.__chunkFirst)
+
+
+  def summary(self, key: str, default = None):
+    return self.__summary.get(key, default)
+
+
+  def setSummary(self, key: str, value):
+    '''
+    Memorise le resultat d'une analyse du programme complet : valeur JSON (nombres, chaines,
+    listes, dictionnaires) ou array, enregistre tel quel dans le cache (cf. gcodeCache).
+    '''
+    self.__summary[key] = value
+
+
+  def exportState(self):
+    '''
+    Contenu complet du programme pour l'enregistrement (cf. gcodeCache) :
+    (dictionnaire nom -> array, dictionnaire des donnees serialisables en JSON).
+    '''
+    self.__closeChunk()
+    summary = dict(self.__summary) # Copie : le thread de l'interface peut ajouter des resultats pendant l'enregistrement
+    arrays = {
+      "opcode":     self.__opcode,
+      "flags":      self.__flags,
+      "modalBits":  self.__modalBits,
+      "chunkFirst": self.__chunkFirst
+    }
+    for letter, column in self.__values.items():
+      arrays["values." + letter] = column
+    for key, value in summary.items():
+      if isinstance(value, array):
+        arrays["summary." + key] = value
+    meta = {
+      "count":      self.__count,
+      "codes":      {str(num): list(codes) for num, codes in self.__codes.items()},
+      "chunkEntry": self.__chunkEntry,
+      "summary":    {key: value for key, value in summary.items() if not isinstance(value, array)}
+    }
+    return arrays, meta
+
+
+  @classmethod
+  def importState(cls, arrays: dict, meta: dict):
+    ''' Programme reconstitue a partir de exportState() '''
+    program = cls()
+    program.__count      = meta["count"]
+    program.__opcode     = arrays["opcode"]
+    program.__flags      = arrays["flags"]
+    program.__modalBits  = arrays["modalBits"]
+    program.__chunkFirst = arrays["chunkFirst"]
+    program.__values     = {name[7:]: column for name, column in arrays.items() if name.startswith("values.")}
+    program.__codes      = {int(num): tuple(codes) for num, codes in meta["codes"].items()}
+    program.__chunkEntry = meta["chunkEntry"]
+    program.__summary    = meta["summary"]
+    program.__summary.update({name[8:]: column for name, column in arrays.items() if name.startswith("summary.")})
+    return program
+
+
+  def select(self, rows):
+    '''
+    Programme reduit aux lignes rows (numeros croissants). Les lignes retirees ne doivent
+    pas changer l'etat modal (cf. gcodeMerge) : l'etat d'entree de chaque troncon reste
+    valable. Les resultats des analyses (summary()) ne sont pas conserves.
+    '''
+    self.__closeChunk()
+    rows = list(rows)
+    program = gcodeProgram()
+    program.__count     = len(rows)
+    program.__opcode    = array('h', map(self.__opcode.__getitem__, rows))
+    program.__flags     = array('B', map(self.__flags.__getitem__, rows))
+    program.__modalBits = array('H', map(self.__modalBits.__getitem__, rows))
+    program.__values    = {letter: array('d', map(column.__getitem__, rows)) for letter, column in self.__values.items()}
+    for num, codes in self.__codes.items():
+      row = bisect_left(rows, num)
+      if row < len(rows) and rows[row] == num:
+        program.__codes[row] = codes
+    # Troncons renumerotes, ceux dont toutes les lignes ont ete retirees disparaissent
+    program.__chunkFirst = array('q')
+    program.__chunkEntry = []
+    for first, entry in zip(self.__chunkFirst, self.__chunkEntry):
+      row = bisect_left(rows, first)
+      if len(program.__chunkFirst) > 0 and program.__chunkFirst[-1] == row:
+        continue
+      program.__chunkFirst.append(row)
+      program.__chunkEntry.append(entry)
+    return program
+
+
+  def replaceLines(self, lines: dict):
+    '''
+    Remplace le contenu des lignes {numero: texte} (cf. gcodeArcFit). L'etat d'entree des
+    troncons qui commencent juste apres une ligne remplacee est recalcule, les lignes
+    remplacees ne doivent pas changer l'etat de sortie des autres troncons.
+    '''
+    if len(lines) == 0:
+      return
+    self.__closeChunk()
+    parsed = gcodeProgram()
+    parsed.appendBlock("\n".join(lines.values()).encode())
+    for letter in parsed.__values:
+      if letter not in self.__values:
+        self.__values[letter] = array('d', [PROGRAM_NAN]) * self.__count
+    for row, num in enumerate(lines):
+      self.__opcode[num]    = parsed.__opcode[row]
+      self.__flags[num]     = parsed.__flags[row]
+      self.__modalBits[num] = parsed.__modalBits[row]
+      for letter, column in self.__values.items():
+        values = parsed.__values.get(letter)
+        column[num] = PROGRAM_NAN if values is None else values[row]
+      if row in parsed.__codes:
+        self.__codes[num] = parsed.__codes[row]
+      else:
+        self.__codes.pop(num, None)
+    for chunk in range(1, len(self.__chunkFirst) - 1):
+      if self.__chunkFirst[chunk] - 1 in lines:
+        modal = self.modalState(self.__chunkFirst[chunk - 1])
+        for num in range(self.__chunkFirst[chunk - 1], self.__chunkFirst[chunk]):
+          if self.__modalBits[num]:
+            modal.applyProgram(self, num)
+        self.__chunkEntry[chunk] = modal.state()
+
+
+  def opcode(self, num: int):
+    return self.__opcode[num]
+
+
+  def motion(self, num: int):
+    ''' Mot G de mouvement de la ligne ("G1"), None si absent '''
+    op = self.__opcode[num]
+    if op == PROGRAM_NO_MOTION:
+      return None
+    return "G{:g}".format(op / 10)
+
+
+  def flags(self, num: int):
+    return self.__flags[num]
+
+
+  def hasFlag(self, num: int, flag: int):
+    return (self.__flags[num] & flag) != 0
+
+
+  def modalBits(self, num: int):
+    return self.__modalBits[num]
+
+
+  def codes(self, num: int):
+    ''' Mots G et M de la ligne, hors mouvement ('G21', 'M3', 'M8', 'G4'...) '''
+    return self.__codes.get(num, ())
+
+
+  def codeLines(self):
+    ''' Numeros des lignes ayant des codes(), par ordre croissant '''
+    return sorted(self.__codes)
+
+
+  def opcodeColumn(self):
+    ''' Colonnes completes opcode, flags et modalBits (array), pour les analyses du programme complet '''
+    return self.__opcode
+
+
+  def flagsColumn(self):
+    return self.__flags
+
+
+  def modalBitsColumn(self):
+    return self.__modalBits
+
+
+  def value(self, letter: str, num: int):
+    ''' Valeur du mot letter de la ligne num, None si le mot est absent '''
+    column = self.__values.get(letter)
+    if column is None:
+      return None
+    v = column[num]
+    return None if v != v else v # NaN
+
+
+  def column(self, letter: str):
+    ''' Colonne complete des valeurs d'un mot (array('d'), NaN si absent), None si le mot n'apparait pas '''
+    return self.__values.get(letter)
+
+
+  def letters(self):
+    return "".join(sorted(self.__values))
+
+
+  def memorySize(self):
+    ''' Taille occupee par les colonnes (octets) '''
+    taille = sum(len(a) * a.itemsize for a in [self.__opcode, self.__flags, self.__modalBits])
+    taille += sum(len(a) * a.itemsize for a in self.__values.values())
+    return taille
+
+
+if __name__ == '__main__':
+  import sys, time
+  # Mesure : gcodeProgram.py [fichier.ngc]
+  program = gcodeProgram()
+  if len(sys.argv) > 1:
+    with open(sys.argv[1], 'rb') as f:
+      data = f.read()
+    t0 = time.time()
+    program.appendBlock(data[:-1] if data[-1:] == b'\n' else data)
+  else:
+    lignes = ["G21 G90 G54", "G00 X0 Y0 (rapid)", "M3 S12000", "M8", "G01 Z-1 F250", "X10.5 Y-3", "G2 X5 Y5 I2.5 J0", "T2 M6", "$H", "", "M30"]
+    t0 = time.time()
+    for l in lignes:
+      program.append(l)
+  t1 = time.time()
+  print("{} lines parsed in {:.3f}s ({:.0f} lines/s), columns {}, {:.1f} MB".format(
+    len(program), t1 - t0, len(program) / max(t1 - t0, 1e-9), program.letters(), program.memorySize() / 1e6))
+  if len(sys.argv) == 1:
+    for num, l in enumerate(lignes):
+      print("{:24} op={:4} flags={:3} bits={:5} codes={} X={} F={} T={}".format(l, program.opcode(num), program.flags(num),
+        program.modalBits(num), program.codes(num), program.value('X', num), program.value('F', num), program.value('T', num)))
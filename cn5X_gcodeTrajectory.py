@@ -0,0 +1,313 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import numpy as np
+from cn5X_config import *
+from cn5X_gcodeModal import MODAL_G_GROUPS, MODAL_PROGRAM_END
+from cn5X_gcodeProgram import *
+
+''' Constantes de Grbl (motion_control.c, gcode.c) '''
+TRAJECTORY_ARC_EPSILON = 5e-7 # ARC_ANGULAR_TRAVEL_EPSILON
+TRAJECTORY_MM_PER_INCH = 25.4
+
+''' Mouvements (opcode du programme), les sondages G38.x sont traites comme des G1 '''
+TRAJECTORY_RAPID   = 0
+TRAJECTORY_LINEAR  = 10
+TRAJECTORY_ARC_CW  = 20
+TRAJECTORY_ARC_CCW = 30
+TRAJECTORY_MOTIONS = [TRAJECTORY_RAPID, TRAJECTORY_LINEAR, TRAJECTORY_ARC_CW, TRAJECTORY_ARC_CCW, 382, 383, 384, 385]
+
+''' Plans des arcs : axe 0, axe 1 et mots de l'offset du centre correspondants '''
+TRAJECTORY_PLANES = {
+  "G17": ("X", "Y", "I", "J"),
+  "G18": ("Z", "X", "K", "I"),
+  "G19": ("Y", "Z", "J", "K")
+}
+
+''' Axes lineaires et rotatifs possibles, dans l'ordre de Grbl '''
+TRAJECTORY_AXES = "XYZABCUVW"
+
+''' Changements d'etat admis sur une ligne G1 simple (cf. plainMoves()) '''
+TRAJECTORY_PLAIN_BITS = MODAL_BITS["motion"] | MODAL_BITS["feed"]
+
+''' Mots convertis en mm en G20 '''
+TRAJECTORY_LENGTH_WORDS = ['F', 'I', 'J', 'K', 'R']
+
+
+class gcodeTrajectory():
+  '''
+  Trajectoire programmee reconstituee a partir des colonnes d'un programme pre-analyse
+  (gcodeProgram), avec NumPy sur le programme complet, pour les analyses qui en ont
+  besoin (duree, courses...) :
+  - etat modal a chaque ligne (mouvement, plan, unites, distance, mode d'avance, repere),
+    par remplissage a partir des lignes qui le modifient ;
+  - positions en mm et en coordonnees programme a la fin de chaque ligne : mots absents
+    remplis par la derniere valeur, deplacements relatifs (G91) cumules ;
+  - lignes de mouvement et geometrie des arcs (centre, rayon, angle) calculee comme Grbl.
+  Les lignes non modales (G10, G28, G53, G92...) ne sont pas des mouvements, leurs
+  coordonnees sont reprises comme position courante ; nonModalLines() permet de les traiter.
+  Si les offsets des reperes sont donnes (offsets : 'G54' -> offset par axe), les
+  coordonnees machine des lignes G53 sont ramenees en coordonnees programme.
+  '''
+
+  def __init__(self, program, axisNames: list, start = None, offsets: dict = None):
+    self.__program = program
+    self.__axes    = list(axisNames)
+    n = len(program)
+    self.__count   = n
+    self.__opcode  = np.frombuffer(program.opcodeColumn(), dtype=np.int16)
+    self.__flags   = np.frombuffer(program.flagsColumn(), dtype=np.uint8)
+    self.__bits    = np.frombuffer(program.modalBitsColumn(), dtype=np.uint16)
+
+    # Groupes modaux portes par codes() (rares), puis remplissage ligne par ligne
+    changes = {"plane": [], "units": [], "distance": [], "feedMode": [], "wcs": []}
+    self.__nonModal = {}
+    for num in program.codeLines():
+      for code in program.codes(num):
+        group = MODAL_G_GROUPS.get(code)
+        if group in changes:
+          changes[group].append((num, code))
+        elif code in ["M2", "M30"]:
+          for group in ["plane", "distance", "feedMode", "wcs"]:
+            changes[group].append((num, MODAL_PROGRAM_END[group]))
+        elif code in PROGRAM_NON_MODAL_CODES:
+          self.__nonModal.setdefault(code, []).append(num)
+    self.__plane    = fillModal(n, changes["plane"], "G17")
+    self.__scale    = np.where(fillModal(n, changes["units"], "G21") == "G20", TRAJECTORY_MM_PER_INCH, 1.0)
+    self.__relative = fillModal(n, changes["distance"], "G90") == "G91"
+    self.__inverse  = fillModal(n, changes["feedMode"], "G94") == "G93"
+    wcsIndex        = fillIndex(n, changes["wcs"])
+    wcsValues       = ["G54"] + [value for num, value in changes["wcs"]]
+    self.__wcs      = np.array(wcsValues)[wcsIndex]
+    self.__motion   = fillColumn(self.__opcode.astype(np.int64), self.__opcode != PROGRAM_NO_MOTION, TRAJECTORY_RAPID)
+    nonModal = (self.__flags & PROGRAM_FLAG_NON_MODAL) != 0
+
+    # Offset (coordonnees machine - coordonnees programme) de chaque ligne selon son repere
+    if offsets is None:
+      offsets = {}
+    table = np.zeros((len(wcsValues), len(self.__axes)))
+    for i, code in enumerate(wcsValues):
+      if code in offsets:
+        table[i] = np.array(offsets[code][:len(self.__axes)], dtype=np.float64)
+    self.__offsets = table[wcsIndex]
+    g53 = self.nonModalLines("G53")
+
+    # Positions a la fin de chaque ligne, une colonne par axe, la ligne 0 est la position de depart
+    lignes = np.arange(n)
+    self.__positions = np.zeros((n + 1, len(self.__axes)))
+    if start is not None:
+      self.__positions[0] = np.array(start[:len(self.__axes)], dtype=np.float64)
+    anyAxis = np.zeros(n, dtype=bool)
+    for i, axis in enumerate(self.__axes):
+      v = self.values(axis)
+      if v is None:
+        self.__positions[1:, i] = self.__positions[0, i]
+        continue
+      if len(g53) > 0:
+        v[g53] -= self.__offsets[g53, i]
+      present = ~np.isnan(v)
+      anyAxis |= present
+      increment = present & self.__relative & ~nonModal
+      cumul = np.cumsum(np.where(increment, v, 0.0))
+      last  = np.maximum.accumulate(np.where(present & ~increment, lignes, -1))
+      base  = np.where(last >= 0, v[last] - cumul[last], self.__positions[0, i])
+      self.__positions[1:, i] = base + cumul
+
+    # Mouvements : lignes avec des mots d'axes dans un mode de mouvement
+    moving = anyAxis & np.isin(self.__motion, TRAJECTORY_MOTIONS) \
+             & ((self.__flags & (PROGRAM_FLAG_NON_MODAL | PROGRAM_FLAG_SYSTEM | PROGRAM_FLAG_INVALID)) == 0)
+    self.__moves = np.nonzero(moving)[0]
+
+
+  def lineCount(self):
+    return self.__count
+
+
+  def axes(self):
+    return list(self.__axes)
+
+
+  def flags(self):
+    ''' Colonnes flags et modalBits du programme (numpy) '''
+    return self.__flags
+
+
+  def modalBits(self):
+    return self.__bits
+
+
+  def motion(self):
+    ''' Mode de mouvement a chaque ligne (opcode : 0, 10, 20, 30...) '''
+    return self.__motion
+
+
+  def plane(self):
+    ''' Plan ('G17'...), facteur d'unite (25.4 en G20), G91, G93 et repere ('G54'...) a chaque ligne '''
+    return self.__plane
+
+
+  def scale(self):
+    return self.__scale
+
+
+  def relative(self):
+    return self.__relative
+
+
+  def inverseTime(self):
+    return self.__inverse
+
+
+  def wcs(self):
+    return self.__wcs
+
+
+  def positions(self):
+    ''' Positions (mm, coordonnees programme) : ligne 0 depart, ligne num + 1 fin de la ligne num '''
+    return self.__positions
+
+
+  def offsets(self):
+    ''' Offset du repere de chaque ligne (nuls si les offsets n'ont pas ete donnes) '''
+    return self.__offsets
+
+
+  def moves(self):
+    ''' Numeros des lignes de mouvement '''
+    return self.__moves
+
+
+  def nonModalLines(self, code: str):
+    ''' Numeros des lignes portant un mot non modal ('G4', 'G92'...) '''
+    return np.array(self.__nonModal.get(code, []), dtype=np.int64)
+
+
+  def plainMoves(self):
+    '''
+    Lignes G1 simples (bool par ligne) : mouvement lineaire en coordonnees absolues, sans
+    autre mot que G1, F, les axes et un commentaire (cf. gcodeMerge, gcodeArcFit).
+    '''
+    plain = np.zeros(self.__count, dtype=bool)
+    plain[self.__moves] = True
+    plain &= (self.__motion == TRAJECTORY_LINEAR) & ~self.__relative & ~self.__inverse
+    plain &= (self.__bits | TRAJECTORY_PLAIN_BITS) == TRAJECTORY_PLAIN_BITS
+    plain &= (self.__flags | PROGRAM_FLAG_COMMENT) == PROGRAM_FLAG_COMMENT
+    codeLines = self.__program.codeLines()
+    if len(codeLines) > 0:
+      plain[codeLines] = False
+    return plain
+
+
+  def values(self, letter: str, convert: bool = True):
+    '''
+    Colonne d'un mot en float64 (NaN si absent), None si le mot n'apparait pas dans le
+    programme. Les axes et les mots F, I, J, K, R sont convertis en mm si convert est vrai.
+    '''
+    column = self.__program.column(letter)
+    if column is None:
+      return None
+    values = np.frombuffer(column, dtype=np.float64).copy()
+    if convert and (letter in self.__axes or letter in TRAJECTORY_LENGTH_WORDS):
+      values *= self.__scale
+    return values
+
+
+  def lineValues(self, letter: str, lignes):
+    ''' Valeurs d'un mot (en mm) aux lignes donnees, NaN si absent '''
+    column = self.__program.column(letter)
+    if column is None:
+      return np.full(len(lignes), np.nan)
+    values = np.frombuffer(column, dtype=np.float64)[lignes]
+    if letter in self.__axes or letter in TRAJECTORY_LENGTH_WORDS:
+      values *= self.__scale[lignes]
+    return values
+
+
+  def arcs(self, lignes):
+    '''
+    Geometrie des arcs (G2, G3) des lignes donnees, comme les calcule Grbl (mc_arc) :
+    (axe 0, axe 1, offset du centre sur ces axes, rayon, angle parcouru en radians,
+    negatif en G2). Les axes valent -1 si ceux du plan ne sont pas definis.
+    '''
+    count = len(lignes)
+    axis0 = np.full(count, -1, dtype=np.int64)
+    axis1 = np.full(count, -1, dtype=np.int64)
+    off0  = np.full(count, np.nan)
+    off1  = np.full(count, np.nan)
+    plane = self.__plane[lignes]
+    for p, (a0, a1, o0, o1) in TRAJECTORY_PLANES.items():
+      if a0 not in self.__axes or a1 not in self.__axes:
+        continue
+      k = np.nonzero(plane == p)[0]
+      axis0[k] = self.__axes.index(a0)
+      axis1[k] = self.__axes.index(a1)
+      off0[k]  = self.lineValues(o0, lignes[k])
+      off1[k]  = self.lineValues(o1, lignes[k])
+    valid = axis0 >= 0
+    rows  = np.arange(count)
+    delta = self.__positions[lignes + 1] - self.__positions[lignes]
+    d0 = np.where(valid, delta[rows, axis0], 0.0)
+    d1 = np.where(valid, delta[rows, axis1], 0.0)
+    off0 = np.nan_to_num(off0)
+    off1 = np.nan_to_num(off1)
+    clockwise = self.__motion[lignes] == TRAJECTORY_ARC_CW
+    # Arcs definis par leur rayon
+    r = self.lineValues('R', lignes)
+    radiusMode = valid & ~np.isnan(r)
+    if np.any(radiusMode):
+      with np.errstate(divide='ignore', invalid='ignore'):
+        h = -np.sqrt(np.maximum(4.0 * r * r - d0 * d0 - d1 * d1, 0.0)) / np.hypot(d0, d1)
+      h = np.where(clockwise, h, -h)
+      h = np.where(r < 0, -h, h)
+      h = np.nan_to_num(h, nan=0.0, posinf=0.0, neginf=0.0)
+      off0 = np.where(radiusMode, 0.5 * (d0 - d1 * h), off0)
+      off1 = np.where(radiusMode, 0.5 * (d1 + d0 * h), off1)
+    radius = np.where(valid, np.hypot(off0, off1), 0.0)
+    r0, r1 = -off0, -off1         # Centre -> depart
+    t0, t1 = d0 - off0, d1 - off1 # Centre -> arrivee
+    angle = np.arctan2(r0 * t1 - r1 * t0, r0 * t0 + r1 * t1)
+    angle = np.where(clockwise & (angle >= -TRAJECTORY_ARC_EPSILON), angle - 2 * np.pi, angle)
+    angle = np.where(~clockwise & (angle <= TRAJECTORY_ARC_EPSILON), angle + 2 * np.pi, angle)
+    angle = np.where(radius > 0, angle, 0.0)
+    return axis0, axis1, off0, off1, radius, angle
+
+
+def fillIndex(n: int, changes: list):
+  ''' Rang du dernier changement [(ligne, valeur)] d'un groupe modal a chaque ligne, a partir de 1 (0 : valeur initiale) '''
+  last = np.zeros(n, dtype=np.int64)
+  if len(changes) > 0:
+    last[[num for num, value in changes]] = np.arange(1, len(changes) + 1)
+  return np.maximum.accumulate(last)
+
+
+def fillModal(n: int, changes: list, default):
+  ''' Valeur d'un groupe modal a chaque ligne a partir de ses changements [(ligne, valeur)] '''
+  return np.array([default] + [value for num, value in changes])[fillIndex(n, changes)]
+
+
+def fillColumn(values, present = None, default = 0.0):
+  ''' Derniere valeur presente a chaque ligne (present : valeurs non NaN par defaut), default avant la premiere '''
+  if present is None:
+    present = ~np.isnan(values)
+  last = np.maximum.accumulate(np.where(present, np.arange(1, len(values) + 1), 0))
+  return np.concatenate(([default], values))[last]
@@ -0,0 +1,321 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import numpy as np
+from cn5X_config import *
+from cn5X_gcodeTrajectory import *
+
+''' Marge sur les courses (mm), pour l'arrondi des conversions (G20, offsets) '''
+TRAVEL_TOLERANCE = 1e-6
+
+''' Mots non modaux qui changent les offsets en cours de programme : le controle s'arrete a la premiere ligne '''
+TRAVEL_OFFSET_CODES = ["G10", "G92", "G92.1", "G43.1", "G49"]
+
+''' Deuxieme position de depart du calcul de l'enveloppe (cf. gcodeTravelCheck.bounds()) '''
+TRAVEL_BOUNDS_START = 1000.0
+
+''' Points extremes des arcs dans leur plan (angles 0, 90, 180 et 270 degres) '''
+TRAVEL_ARC_EXTREMES = [(0.0, 1.0, 0.0), (0.5 * np.pi, 0.0, 1.0), (np.pi, -1.0, 0.0), (1.5 * np.pi, 0.0, -1.0)]
+
+
+class gcodeTravelReport():
+  ''' Resultat de gcodeTravelCheck.check() '''
+
+  def __init__(self, axes: list, minimum, maximum, violations: list, count: int, uncheckedFrom: int):
+    self.__axes          = axes
+    self.__minimum       = minimum
+    self.__maximum       = maximum
+    self.__violations    = violations    # [(ligne, axe, position machine)], premieres lignes hors courses
+    self.__count         = count         # Nombre de lignes hors courses
+    self.__uncheckedFrom = uncheckedFrom # Premiere ligne non controlee (changement d'offsets), -1 si aucune
+
+
+  def isValid(self):
+    return self.__count == 0
+
+
+  def envelope(self):
+    ''' Enveloppe des positions machine du programme : [(axe, mini, maxi)] des axes deplaces '''
+    return [(axis, float(self.__minimum[i]), float(self.__maximum[i])) for i, axis in enumerate(self.__axes) if self.__minimum[i] <= self.__maximum[i]]
+
+
+  def violations(self):
+    return list(self.__violations)
+
+
+  def violationCount(self):
+    return self.__count
+
+
+  def uncheckedFrom(self):
+    return self.__uncheckedFrom
+
+
+class gcodeTravelCheck():
+  '''
+  Controle avant cycle des courses de la machine : enveloppe en coordonnees machine de
+  tous les points atteints par le programme (fins de mouvements et points extremes des
+  arcs), calculee avec NumPy sur la trajectoire du programme complet (gcodeTrajectory).
+  Les positions machine sont les positions programme plus l'offset du repere de chaque
+  ligne : WCO actuel (G5x actif + G92 + longueur d'outil) corrige de l'ecart entre le
+  repere actif et celui de la ligne (G54 a G59 lus par $#). Les lignes G53 sont controlees
+  avec leurs coordonnees machine.
+  Comme pour les soft limits de Grbl, chaque axe doit rester entre -$130... et 0. Les axes
+  dont la course n'est pas connue ne sont pas controles, ni les lignes qui suivent un
+  changement d'offsets par le programme (G10, G92, G43.1...).
+  L'enveloppe en coordonnees programme (bounds()), qui ne depend pas des offsets, est
+  conservee avec le programme : checkBounds() s'en sert pour valider le programme sans
+  recalculer sa trajectoire.
+  '''
+
+  def __init__(self, axisNames: list, maxTravel: list, offsets: dict, start = None):
+    self.__axes      = list(axisNames)
+    self.__maxTravel = np.array(maxTravel[:len(self.__axes)], dtype=np.float64)
+    self.__offsets   = {wcs: np.array(offset[:len(self.__axes)], dtype=np.float64) for wcs, offset in offsets.items()}
+    self.__start     = start
+
+
+  @classmethod
+  def fromDecoder(cls, decoder, axisNames: list, maxTravel: list):
+    ''' Controle avec les offsets actuels lus par grblDecode et la position de travail actuelle comme depart '''
+    nbAxis = len(axisNames)
+    wco    = np.array(decoder.getWco()[:nbAxis], dtype=np.float64)
+    actif  = np.array(decoder.getOffsetG5x()[:nbAxis], dtype=np.float64)
+    offsets = {}
+    for num in range(54, 60):
+      offsets["G{}".format(num)] = wco - actif + np.array(decoder.getG5x(num)[:nbAxis], dtype=np.float64)
+    return cls(axisNames, maxTravel, offsets, decoder.getWpos()[:nbAxis])
+
+
+  def isEnabled(self):
+    ''' Faux si aucune course n'est connue ($130... pas encore lus) '''
+    return bool(np.any(self.__maxTravel > 0))
+
+
+  def boundsKey(self):
+    ''' Cle de l'enveloppe (bounds()) conservee avec le programme '''
+    return "travelBounds." + ",".join(self.__axes)
+
+
+  def check(self, program, fromLine: int = 0, trajectory = None):
+    ''' Controle des lignes fromLine et suivantes du programme (gcodeTravelReport) '''
+    if trajectory is None:
+      trajectory = gcodeTrajectory(program, self.__axes, self.__start, self.__offsets)
+    lignes, points, uncheckedFrom = self.__points(trajectory, fromLine)
+    points = points + trajectory.offsets()[lignes]
+    minimum = np.min(points, axis=0, initial=np.inf)
+    maximum = np.max(points, axis=0, initial=-np.inf)
+
+    # Positions hors de [-course, 0]
+    checked = self.__maxTravel > 0
+    with np.errstate(invalid='ignore'):
+      outside = checked & ((points > TRAVEL_TOLERANCE) | (points < -self.__maxTravel - TRAVEL_TOLERANCE))
+    bad = np.nonzero(np.any(outside, axis=1))[0]
+    violations = []
+    count = 0
+    if len(bad) > 0:
+      badLines, first = np.unique(lignes[bad], return_index=True)
+      count = len(badLines)
+      for num, index in zip(badLines[:GCODE_TRAVEL_REPORT_LINES], first[:GCODE_TRAVEL_REPORT_LINES]):
+        point = bad[index]
+        axis = int(np.argmax(outside[point]))
+        violations.append((int(num), self.__axes[axis], float(points[point, axis])))
+    return gcodeTravelReport(self.__axes, minimum, maximum, violations, count, uncheckedFrom)
+
+
+  @staticmethod
+  def __points(trajectory, fromLine: int = 0):
+    '''
+    Points atteints par les lignes fromLine et suivantes, en coordonnees programme (fins
+    des mouvements et points extremes des arcs) : (lignes, points, premiere ligne non
+    controlee ou -1).
+    '''
+    positions = trajectory.positions()
+    motion    = trajectory.motion()
+
+    # Fin du controle au premier changement d'offsets par le programme
+    uncheckedFrom = -1
+    for code in TRAVEL_OFFSET_CODES:
+      lignes = trajectory.nonModalLines(code)
+      if len(lignes) > 0 and (uncheckedFrom < 0 or lignes[0] < uncheckedFrom):
+        uncheckedFrom = int(lignes[0])
+    lastLine = uncheckedFrom if uncheckedFrom >= 0 else trajectory.lineCount()
+
+    # Fins des mouvements et des lignes G53
+    m = trajectory.moves()
+    g53 = trajectory.nonModalLines("G53")
+    if len(g53) > 0:
+      m = np.union1d(m, g53)
+    m = m[(m >= fromLine) & (m < lastLine)]
+    lignes = [m]
+    points = [positions[m + 1]]
+
+    # Points extremes des arcs franchis entre le depart et l'arrivee
+    arcs = m[np.isin(motion[m], [TRAJECTORY_ARC_CW, TRAJECTORY_ARC_CCW])]
+    if len(arcs) > 0:
+      axis0, axis1, off0, off1, radius, angle = trajectory.arcs(arcs)
+      valid = radius > 0
+      arcs, axis0, axis1, off0, off1, radius, angle = arcs[valid], axis0[valid], axis1[valid], off0[valid], off1[valid], radius[valid], angle[valid]
+      rows  = np.arange(len(arcs))
+      depart = positions[arcs]
+      centre0 = depart[rows, axis0] + off0
+      centre1 = depart[rows, axis1] + off1
+      startAngle = np.arctan2(-off1, -off0)
+      for phi, c0, c1 in TRAVEL_ARC_EXTREMES:
+        sweep = np.where(angle > 0, np.mod(phi - startAngle, 2 * np.pi), np.mod(startAngle - phi, 2 * np.pi))
+        k = np.nonzero(sweep <= np.abs(angle))[0]
+        if len(k) == 0:
+          continue
+        # Point extreme dans le plan, position de depart sur les autres axes
+        point = depart[k].copy()
+        point[rows[:len(k)], axis0[k]] = centre0[k] + c0 * radius[k]
+        point[rows[:len(k)], axis1[k]] = centre1[k] + c1 * radius[k]
+        lignes.append(arcs[k])
+        points.append(point)
+
+    return np.concatenate(lignes), np.concatenate(points), uncheckedFrom
+
+
+  def bounds(self, program):
+    '''
+    Enveloppe des points du programme en coordonnees programme, par repere, a conserver
+    avec lui (valeur JSON, cf. gcodeProgram.setSummary()). Les coordonnees qui dependent
+    de la position de depart (axes pas encore programmes...) sont gardees a part, par
+    rapport au depart. Les trajectoires calculees depuis deux departs differents donnent
+    la part de chaque coordonnee qui en depend. L'enveloppe n'est pas exacte (checkBounds()
+    renvoie alors None) si des lignes G53 sont presentes ou si un point ne suit pas le
+    depart en bloc (arc qui part d'une position inconnue...).
+    '''
+    trajectoire = gcodeTrajectory(program, self.__axes, np.zeros(len(self.__axes)))
+    decale      = gcodeTrajectory(program, self.__axes, np.full(len(self.__axes), TRAVEL_BOUNDS_START))
+    lignes, points, uncheckedFrom = self.__points(trajectoire)
+    autres = self.__points(decale)[1]
+    ecart = autres - points
+    depart = np.abs(ecart - TRAVEL_BOUNDS_START) <= TRAVEL_TOLERANCE
+    exact = bool(np.all(depart | (np.abs(ecart) <= TRAVEL_TOLERANCE))) and len(trajectoire.nonModalLines("G53")) == 0
+    wcs = trajectoire.wcs()[lignes]
+    def borne(valeurs):
+      return [float(v) if np.isfinite(v) else None for v in valeurs]
+    reperes = {}
+    for code in np.unique(wcs).tolist():
+      k = wcs == code
+      fixes    = np.where(k[:, None] & ~depart, points, np.nan)
+      relatifs = np.where(k[:, None] & depart, points, np.nan)
+      with np.errstate(invalid='ignore'):
+        reperes[code] = [borne(np.fmin.reduce(fixes, axis=0, initial=np.inf)), borne(np.fmax.reduce(fixes, axis=0, initial=-np.inf)),
+                         borne(np.fmin.reduce(relatifs, axis=0, initial=np.inf)), borne(np.fmax.reduce(relatifs, axis=0, initial=-np.inf))]
+    return {"axes": self.__axes, "exact": exact, "uncheckedFrom": uncheckedFrom, "wcs": reperes}
+
+
+  def checkBounds(self, bounds: dict):
+    '''
+    Controle rapide avec l'enveloppe calculee par bounds() et les offsets actuels :
+    gcodeTravelReport valide si tous les points sont dans les courses, None s'il faut
+    faire le controle complet (check()) pour trouver les lignes hors courses.
+    '''
+    if bounds is None or not bounds["exact"] or bounds["axes"] != self.__axes:
+      return None
+    nbAxis  = len(self.__axes)
+    start   = np.zeros(nbAxis) if self.__start is None else np.array(self.__start[:nbAxis], dtype=np.float64)
+    minimum = np.full(nbAxis, np.inf)
+    maximum = np.full(nbAxis, -np.inf)
+    for code, (mini, maxi, miniDepart, maxiDepart) in bounds["wcs"].items():
+      offset = self.__offsets.get(code, np.zeros(nbAxis))
+      for valeurs, base, fonction, cumul in [(mini, 0.0, np.fmin, minimum), (maxi, 0.0, np.fmax, maximum),
+                                             (miniDepart, start, np.fmin, minimum), (maxiDepart, start, np.fmax, maximum)]:
+        valeurs = np.array([np.nan if v is None else v for v in valeurs], dtype=np.float64)
+        cumul[:] = fonction(cumul, valeurs + base + offset)
+    checked = self.__maxTravel > 0
+    with np.errstate(invalid='ignore'):
+      outside = checked & ((maximum > TRAVEL_TOLERANCE) | (minimum < -self.__maxTravel - TRAVEL_TOLERANCE))
+    if np.any(outside):
+      return None
+    return gcodeTravelReport(self.__axes, minimum, maximum, [], 0, bounds["uncheckedFrom"])
+
+
+if __name__ == '__main__':
+  import sys, time, math
+  from cn5X_gcodeProgram import gcodeProgram
+  # Verification : courses 300 x 200 x 80 mm, G54 et G55 lus par $#, depart a l'origine machine
+  offsets = {"G{}".format(num): np.zeros(3) for num in range(54, 60)}
+  offsets["G54"] = np.array([-250.0, -150.0, -60.0])
+  offsets["G55"] = np.array([-100.0, -100.0, -40.0])
+  check = gcodeTravelCheck(["X", "Y", "Z"], [300.0, 200.0, 80.0], offsets, [0.0, 0.0, 0.0])
+  lignes = [
+    "G21 G90 G54",
+    "G0 X0 Y0 Z10",
+    "G1 X40 F500",
+    "G1 X260",             # X machine +10
+    "G0 X100 Y140",
+    "G2 X140 Y140 I20 J0", # Extremites dans les courses, sommet de l'arc a Y machine +10
+    "G55 G0 X50 Y50",
+    "G53 G0 Z1",           # Coordonnees machine
+    "G92 X0",              # Fin du controle
+    "G0 X1000"
+  ]
+  program = gcodeProgram()
+  program.appendBlock("\n".join(lignes).encode())
+  report = check.check(program)
+  assert [(num, axis) for num, axis, position in report.violations()] == [(3, "X"), (5, "Y"), (7, "Z")], report.violations()
+  assert report.violationCount() == 3 and report.uncheckedFrom() == 8, (report.violationCount(), report.uncheckedFrom())
+  assert [(num, axis, round(position, 6)) for num, axis, position in check.check(program, 4).violations()] == [(5, "Y", 10.0), (7, "Z", 1.0)]
+  print("Travel check: {} lines out of travel {}, unchecked from line {}, envelope {}".format(
+    report.violationCount(), report.violations(), report.uncheckedFrom(), report.envelope()))
+
+  # Enveloppe conservee avec le programme (JSON) : meme resultat que check() sans la trajectoire
+  import json
+  assert check.checkBounds(check.bounds(program)) is None # Lignes G53
+  valide = gcodeProgram()
+  valide.appendBlock("\n".join(["G21 G90 G54", "G0 Z10", "X0 Y0", "G1 X40 F500", "G2 X80 Y0 I20 J0", "G55 G0 X50 Y50"]).encode())
+  bounds = json.loads(json.dumps(check.bounds(valide)))
+  for depart in [[0.0, 0.0, 0.0], [-10.0, -20.0, -5.0]]:
+    autre = gcodeTravelCheck(["X", "Y", "Z"], [300.0, 200.0, 80.0], offsets, depart)
+    rapide, complet = autre.checkBounds(bounds), autre.check(valide)
+    assert rapide is not None and rapide.isValid() and complet.isValid()
+    assert np.allclose([b for a, *b in rapide.envelope()], [b for a, *b in complet.envelope()]), (rapide.envelope(), complet.envelope())
+  decales = dict(offsets, G54=np.array([-50.0, -150.0, -60.0]))
+  assert gcodeTravelCheck(["X", "Y", "Z"], [300.0, 200.0, 80.0], decales, [0.0, 0.0, 0.0]).checkBounds(bounds) is None
+  print("Travel bounds: {}".format(bounds))
+
+  # Mesure : gcodeTravel.py [fichier.ngc], par defaut 1 million de points sur des cercles
+  if len(sys.argv) > 1:
+    with open(sys.argv[1], 'rb') as f:
+      data = f.read().rstrip(b'\n')
+  else:
+    lignes = ["G21 G90 G54", "G0 X20 Y0 Z1", "G1 Z-1 F800"]
+    for i in range(1, 1000001):
+      angle = i * 2.0 * math.pi / 3600
+      lignes.append("X{:.4f} Y{:.4f}".format(100.0 + 20.0 * math.cos(angle), 50.0 + 20.0 * math.sin(angle)))
+    lignes.append("M30")
+    data = "\n".join(lignes).encode()
+  program = gcodeProgram()
+  program.appendBlock(data)
+  t0 = time.time()
+  report = check.check(program)
+  t1 = time.time()
+  bounds = check.bounds(program)
+  t2 = time.time()
+  check.checkBounds(bounds)
+  t3 = time.time()
+  print("{} lines checked in {:.2f}s, {} out of travel, bounds in {:.2f}s, checked from the bounds in {:.1f}ms".format(
+    len(program), t1 - t0, report.violationCount(), t2 - t1, 1000 * (t3 - t2)))
@@ -21,12 +21,15 @@
 '                                                                         '
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 
-import sys, time
+import sys, os, time
 from math import *
 from PyQt6 import QtCore
 from PyQt6.QtCore import QCoreApplication, QObject, QThread, QTimer, QEventLoop, pyqtSignal, pyqtSlot, QIODevice
 from cn5X_config import *
-from grblComSerial import grblComSerial
+from grblComSerial import *
+from grblComStats import grblComStats
+from grblComTransport import isReplayPort
+from grblComRecorder import REC_FILE_EXT
 
 GCODE_PARAMETER_OUTPUT_CHANGE_CMD = ["G10", "G28.1", "G30.1", "G38", "G43.1", "G49", "G92"]
 GCODE_SYSTEM_COORDINATE_CHANGE_CMD = ["G54", "G55", "G56", "G57", "G58", "G59"]
@@ -48,6 +51,8 @@ class grblCom(QObject):
   sig_data       = pyqtSignal(str)      # Emis a la reception des autres donnees de Grbl, renvoie la ligne complete
   sig_probe      = pyqtSignal(str)      # Emis a la reception d'un résultat de probe
   sig_emit       = pyqtSignal(str)      # Emis a l'envoi des donnees sur le port serie
+  sig_lineSent   = pyqtSignal(int)      # Emis a l'envoi d'une ligne du fichier GCode, renvoie son index (cf. gcodePush())
+  sig_lineAcked  = pyqtSignal(int, int) # Emis a l'acquittement d'une ligne du fichier GCode, renvoie son index et le N° d'erreur (0 = ok)
   sig_recu       = pyqtSignal(str)      # Emis a la reception des donnees sur le port serie
   sig_debug      = pyqtSignal(str)      # Emis a chaque envoi ou reception
   sig_activity   = pyqtSignal(bool)     # Emis a chaque changement de self.__okToSendGCode
@@ -67,6 +72,12 @@ class grblCom(QObject):
     self.__threads = []
     self.__refreshGcodeParameters = False
     self.timerRefreshGcode = QTimer()
+    self.__debug         = False
+    self.__batchMode     = True
+    self.__adaptivePolling = True
+    self.__stats         = grblComStats() # Conserve d'une connexion a l'autre
+    self.__recordDir     = None           # Repertoire des enregistrements de sessions (None = pas d'enregistrement)
+    self.__batchSlots    = []
 
 
   def setDecodeur(self, decodeur):
@@ -77,23 +88,54 @@ class grblCom(QObject):
     return self.__decode
 
 
-  def startCom(self, comPort: str, baudRate: int):
+  def setDebug(self, value: bool):
+    ''' Active ou desactive le formatage et l'emission des messages de debug '''
+    self.__debug = value
+    if self.__com is not None:
+      self.__com.setDebug(value)
+
+
+  def setBatchMode(self, value: bool):
+    ''' Active ou desactive le regroupement des signaux du thread de communication (sig_batch) '''
+    self.__batchMode = value
+    if self.__com is not None:
+      self.__com.setBatchMode(value)
+
+
+  def getStats(self):
+    ''' Instrumentation de la communication (latences, debits, cf. grblComStats) '''
+    return self.__stats
+
+
+  def setRecordDir(self, recordDir: str):
+    ''' Enregistreur de vol : enregistre les prochaines sessions dans recordDir (None pour arreter) '''
+    self.__recordDir = recordDir
+
+
+  def setAdaptivePolling(self, value: bool):
+    ''' Active ou desactive l'adaptation de la frequence d'interrogation de Grbl a son etat '''
+    self.__adaptivePolling = value
+    if self.__com is not None:
+      self.__com.setAdaptivePolling(value)
+
+
+  def startCom(self, comPort: str, baudRate: int, streamingMode: int = STREAMING_PING_PONG):
     '''
     Gestion des communications serie et des timers dans des threads distincts
+    streamingMode : STREAMING_PING_PONG (une ligne a la fois, attente du ok)
+                    ou STREAMING_CHAR_COUNTING (remplissage du buffer de reception de Grbl)
     '''
 
-    # TODO : Ajout possibilité de connection réseau
-    # Windows : pseudo serial over TCP driver => rien a faire
-    # Linux : use socat :
-    # sudo socat pty,link=/dev/ttyTCP0,raw tcp:127.0.0.1:1386
-    # comPort = "ttyTCP0" (si dans /dev)
-    # attention aux droits d'accès !
-    # comPort = "/tmp/ttyTCP0" (chemin absolu)
+    # comPort peut etre un port serie (COM3, /dev/ttyUSB0...) ou une adresse
+    # reseau tcp://hote:port (ESP32, grblHAL Ethernet...), cf. grblComTransport.
 
-    self.sig_debug.emit("grblCom.startCom(self, {}, {})".format(comPort, baudRate))
+    if self.__debug:
+      self.sig_debug.emit("grblCom.startCom(self, {}, {}, {})".format(comPort, baudRate, streamingMode))
 
     self.sig_log.emit(logSeverity.info.value, 'grblCom: Starting grblComSerial thread on {}.'.format(comPort))
-    newComSerial = grblComSerial(self.__decode, comPort, baudRate, self.__pooling)
+    if streamingMode == STREAMING_CHAR_COUNTING:
+      self.sig_log.emit(logSeverity.info.value, 'grblCom: Using character-counting streaming.')
+    newComSerial = grblComSerial(self.__decode, comPort, baudRate, self.__pooling, streamingMode)
     thread = QThread()
     thread.setObjectName('grblComSerial')
     self.__threads.append((thread, newComSerial))  # need to store worker too otherwise will be gc'd
@@ -115,6 +157,30 @@ class grblCom(QObject):
     newComSerial.sig_debug.connect(self.sig_debug.emit)
     newComSerial.sig_activity.connect(self.sig_activity.emit)
     newComSerial.sig_serialLock.connect(self.sig_serialLock.emit)
+    newComSerial.sig_lineSent.connect(self.sig_lineSent.emit)
+    newComSerial.sig_lineAcked.connect(self.sig_lineAcked.emit)
+
+    # Mode batch : memes traitements que les signaux ci-dessus, dans l'ordre des COM_EVT_XXX
+    self.__batchSlots = [
+      self.on_sig_connect, self.sig_log.emit, self.on_sig_init, self.sig_ok.emit, self.sig_error.emit,
+      self.sig_alarm.emit, self.on_sig_status, self.sig_config.emit, self.sig_data.emit, self.sig_probe.emit,
+      self.sig_emit.emit, self.sig_recu.emit, self.sig_debug.emit, self.sig_activity.emit, self.sig_serialLock.emit,
+      self.sig_lineSent.emit, self.sig_lineAcked.emit
+    ]
+    newComSerial.sig_batch.connect(self.on_sig_batch)
+    newComSerial.setDebug(self.__debug)
+    newComSerial.setBatchMode(self.__batchMode)
+    newComSerial.setAdaptivePolling(self.__adaptivePolling)
+    newComSerial.setStats(self.__stats)
+    if self.__recordDir is not None and not isReplayPort(comPort):
+      try:
+        os.makedirs(self.__recordDir, exist_ok=True)
+      except OSError as err:
+        self.sig_log.emit(logSeverity.error.value, self.tr("grblCom: Unable to create {}: {}").format(self.__recordDir, err))
+      else:
+        recordFile = os.path.join(self.__recordDir, time.strftime("cn5X-%Y%m%d-%H%M%S") + REC_FILE_EXT)
+        self.sig_log.emit(logSeverity.info.value, self.tr("grblCom: Recording session to {}").format(recordFile))
+        newComSerial.setRecordFile(recordFile)
 
     # Rafraichissement GCode différé
     self.timerRefreshGcode.timeout.connect(self.on_timerRefreshGcode)
@@ -127,9 +193,17 @@ class grblCom(QObject):
     self.__com = newComSerial
 
 
+  @pyqtSlot(list)
+  def on_sig_batch(self, events: list):
+    ''' Re-emet un par un les evenements regroupes par grblComSerial '''
+    for event in events:
+      self.__batchSlots[event[0]](*event[1:])
+
+
   @pyqtSlot(bool)
   def on_sig_connect(self, value: bool):
-    self.sig_debug.emit("grblCom.on_sig_connect(self, {})".format(value))
+    if self.__debug:
+      self.sig_debug.emit("grblCom.on_sig_connect(self, {})".format(value))
     ''' Maintien l'etat de connexion '''
     self.__connectStatus = value
     self.sig_connect.emit()
@@ -137,7 +211,8 @@ class grblCom(QObject):
 
   @pyqtSlot(str)
   def  on_sig_init(self, buff: str):
-    self.sig_debug.emit("grblCom.on_sig_init(self, {})".format(buff))
+    if self.__debug:
+      self.sig_debug.emit("grblCom.on_sig_init(self, {})".format(buff))
     self.__grblInit = True
     self.__grblVersion = buff.split("[")[0]
     self.sig_init.emit(buff)
@@ -150,7 +225,8 @@ class grblCom(QObject):
 
   @pyqtSlot(str)
   def on_sig_status(self, buff: str):
-    self.sig_debug.emit("grblCom.on_sig_status(self, {})".format(buff))
+    if self.__debug:
+      self.sig_debug.emit("grblCom.on_sig_status(self, {})".format(buff))
     ''' Memorise le status de Grbl a chaque fois qu'on en voi un passer '''
     self.__grblStatus = buff[1:].split('|')[0]
     self.sig_status.emit(buff)
@@ -171,7 +247,8 @@ class grblCom(QObject):
 
 
   def stopCom(self):
-    self.sig_debug.emit("grblCom.stopCom(self)")
+    if self.__debug:
+      self.sig_debug.emit("grblCom.stopCom(self)")
     ''' Stop le thread des communications serie '''
     self.clearCom() # Vide la file d'attente
     self.sig_log.emit(logSeverity.info.value, self.tr("Sending abort to serial communications thread..."))
@@ -191,10 +268,10 @@ class grblCom(QObject):
     self.timerRefreshGcode.stop()
     
 
-  def gcodeInsert(self, buff: str, flag=COM_FLAG_NO_FLAG):
+  def gcodeInsert(self, buff: str, flag=COM_FLAG_NO_FLAG, index: int = COM_NO_LINE_INDEX):
     ''' Insertion d'une commande GCode dans la pile en mode LiFo (commandes devant passer devant les autres) '''
     if self.__connectStatus and self.__grblInit:
-      self.__com.gcodeInsert(buff, flag)
+      self.__com.gcodeInsert(buff, flag, index)
       # Vérifie si la commande passée modifie les paramètres GCode (resultat de $#)
       for cmd in GCODE_PARAMETER_OUTPUT_CHANGE_CMD:
         if cmd in buff:
@@ -207,10 +284,13 @@ class grblCom(QObject):
       self.sig_log.emit(logSeverity.warning.value, self.tr("grblCom: Grbl not connected or not initialized, [{}] could not be sent.").format(buff))
 
 
-  def gcodePush(self, buff: str, flag=COM_FLAG_NO_FLAG):
-    ''' Ajout d'une commande GCode dans la pile en mode FiFo (fonctionnement normal de la pile d'un programe GCode) '''
+  def gcodePush(self, buff: str, flag=COM_FLAG_NO_FLAG, index: int = COM_NO_LINE_INDEX):
+    '''
+    Ajout d'une commande GCode dans la pile en mode FiFo (fonctionnement normal de la pile d'un programe GCode).
+    index : numero de la ligne dans le fichier GCode, renvoye par sig_lineSent et sig_lineAcked.
+    '''
     if self.__connectStatus and self.__grblInit:
-      self.__com.gcodePush(buff, flag)
+      self.__com.gcodePush(buff, flag, index)
       # Vérifie si la commande passée modifie les paramètres GCode (resultat de $#)
       for cmd in GCODE_PARAMETER_OUTPUT_CHANGE_CMD:
         if cmd in buff:
@@ -0,0 +1,161 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import sys, time
+from cn5X_config import *
+
+''' Types de lignes reconnues par grblLineFramer '''
+GRBL_LINE_OK     = 0 # "ok"
+GRBL_LINE_ERROR  = 1 # "error:X"
+GRBL_LINE_ALARM  = 2 # "ALARM:X"
+GRBL_LINE_STATUS = 3 # "<...>" Real-time Status Reports
+GRBL_LINE_INIT   = 4 # "Grbl 1.1f ['$' for help]"
+GRBL_LINE_OTHER  = 5 # Toutes les autres lignes
+GRBL_LINE_BAD    = 6 # Ligne non ASCII (le texte renvoye est alors la ligne brute en bytes)
+
+class grblLineFramer():
+  '''
+  Decoupage en lignes des octets recus de Grbl.
+  Les octets lus sur le port serie (par paquets de taille quelconque) sont accumules
+  dans un bytearray reutilise. Les lignes completes sont reperees par memoryview sans
+  copie intermediaire et classees d'apres leurs premiers octets. Seules les lignes
+  autres que "ok" sont decodees en str.
+  '''
+
+  def __init__(self):
+    self.__buffer = bytearray()
+
+  def feed(self, data):
+    ''' Ajoute des octets recus a la fin du buffer '''
+    self.__buffer += data
+
+  def pending(self):
+    ''' Nombre d'octets recus ne formant pas encore une ligne complete '''
+    return len(self.__buffer)
+
+  def clear(self):
+    ''' Oublie la ligne partielle en cours de reception '''
+    del self.__buffer[:]
+
+  def lines(self):
+    ''' Renvoie la liste des lignes completes recues sous forme de couples (GRBL_LINE_XXX, texte) '''
+    buff   = self.__buffer
+    result = []
+    debut  = 0
+    with memoryview(buff) as mv:
+      while True:
+        fin = buff.find(b'\n', debut)
+        if fin < 0:
+          break
+        suivant = fin + 1
+        # Supprime les espaces, \r et \t des deux cotes de la ligne comme str.strip()
+        while fin > debut and buff[fin - 1] <= 0x20:
+          fin -= 1
+        while debut < fin and buff[debut] <= 0x20:
+          debut += 1
+        if fin > debut:
+          result.append(self.__classify(buff, mv, debut, fin))
+        debut = suivant
+    if debut > 0:
+      del buff[:debut]
+    return result
+
+  def __classify(self, buff, mv, debut: int, fin: int):
+    ''' Identifie le type de la ligne buff[debut:fin] par ses premiers octets '''
+    first = buff[debut]
+    if first == 0x6F and fin - debut == 2 and buff[debut + 1] == 0x6B: # "ok"
+      return GRBL_LINE_OK, "ok"
+    ligne = mv[debut:fin]
+    try:
+      l = str(ligne, 'ascii')
+    except UnicodeDecodeError:
+      return GRBL_LINE_BAD, bytes(ligne)
+    if first == 0x3C and buff[fin - 1] == 0x3E:                        # "<...>"
+      return GRBL_LINE_STATUS, l
+    if first == 0x65 and ligne[:6] == b'error:':
+      return GRBL_LINE_ERROR, l
+    if first == 0x41 and ligne[:6] == b'ALARM:':
+      return GRBL_LINE_ALARM, l
+    if first == 0x47 and ligne[:5] == b'Grbl ' and ligne[-5:] == b'help]':
+      return GRBL_LINE_INIT, l
+    return GRBL_LINE_OTHER, l
+
+
+if __name__ == '__main__':
+  # Benchmark : nombre de lignes par seconde decoupees et classees a partir d'une capture
+  # brute de ce qu'envoie Grbl (fichier passe en argument), ou a defaut d'une capture
+  # synthetique representative d'un streaming (un status report pour 10 "ok").
+  # Compare avec l'ancien traitement readline() (lecture octet par octet comme pyserial)
+  # + decode() + strip() + recherches de sous-chaines.
+  import io
+  if len(sys.argv) > 1:
+    with open(sys.argv[1], 'rb') as f:
+      capture = f.read()
+  else:
+    bloc = b''.join([b'ok\r\n'] * 10) \
+         + b'<Run|MPos:12.345,-3.210,-1.000,0.000,0.000|Bf:15,98|FS:1200,12000|Ov:100,100,100>\r\n'
+    capture = bloc * 20000 + b'error:20\r\n[GC:G1 G54 G17 G21 G90 G94 M3 M9 T0 F1200 S12000]\r\n'
+  paquet = 64 # Taille des lectures simulees sur le port serie
+  paquets = [capture[i:i + paquet] for i in range(0, len(capture), paquet)]
+
+  class rawCapture(io.RawIOBase):
+    ''' Comme serial.Serial, readline() est celui de io.IOBase qui lit octet par octet '''
+    def __init__(self, data):
+      self.__data = io.BytesIO(data)
+    def readable(self):
+      return True
+    def readinto(self, b):
+      data = self.__data.read(len(b))
+      b[:len(data)] = data
+      return len(data)
+
+  t0 = time.perf_counter()
+  flux = rawCapture(capture)
+  nbOld = 0
+  while True:
+    buff = flux.readline()
+    if len(buff) == 0:
+      break
+    l = buff.decode('ascii').strip()
+    if l == 'ok':
+      pass
+    elif l.find('error:') >= 0:
+      pass
+    elif l.find('ALARM:') >= 0:
+      pass
+    elif l[:5] == "Grbl " and l[-5:] == "help]":
+      pass
+    nbOld += 1
+  tOld = time.perf_counter() - t0
+
+  t0 = time.perf_counter()
+  framer = grblLineFramer()
+  nbNew = 0
+  for p in paquets:
+    framer.feed(p)
+    nbNew += len(framer.lines())
+  tNew = time.perf_counter() - t0
+
+  print("{} bytes, {} lines".format(len(capture), nbNew))
+  print("readline/decode/strip : {:10.0f} lines/s".format(nbOld / tOld))
+  print("grblLineFramer        : {:10.0f} lines/s".format(nbNew / tNew))
@@ -0,0 +1,165 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import sys, time, threading, queue, itertools
+from cn5X_config import *
+from grblComStack import grblStack, STACK_LANE_REALTIME, STACK_LANE_URGENT, STACK_LANE_NORMAL
+
+''' Operations transmises au thread de communication '''
+COM_OP_REALTIME = 0 # Commande temps reel (realTimePush())
+COM_OP_INSERT   = 1 # Insertion devant le flux GCode (gcodeInsert())
+COM_OP_PUSH     = 2 # Ajout a la fin du flux GCode (gcodePush())
+COM_OP_CLEAR    = 3 # Vidage des files d'attente (clearCom())
+COM_OP_RESET    = 4 # Vidage des files d'attente + soft reset de Grbl (resetSerial())
+
+class grblComQueue():
+  '''
+  Passage des commandes d'un ou plusieurs threads producteurs (interface graphique,
+  timers...) vers le thread de communication serie qui est le seul a manipuler la pile
+  grblStack. Chaque operation recoit un numero de sequence croissant au moment de son
+  depot, le consommateur verifie qu'il les recoit toutes, dans l'ordre, une seule fois.
+  '''
+
+  def __init__(self, wakeUp: threading.Event = None):
+    self.__queue       = queue.SimpleQueue()
+    self.__putLock     = threading.Lock() # numero de sequence et depot dans la file atomiques
+    self.__seqCounter  = itertools.count()
+    self.__expectedSeq = 0
+    self.__seqErrors   = 0
+    self.__wakeUp      = wakeUp
+
+  def put(self, op: int, item: str = None, flag = COM_FLAG_NO_FLAG, index: int = COM_NO_LINE_INDEX):
+    '''
+    Depose une operation pour le thread de communication et renvoie son numero de sequence.
+    index est le numero de la ligne source dans le fichier GCode, renvoye a l'envoi et a l'acquittement.
+    '''
+    stamp = time.perf_counter() # Horodatage du depot (statistiques de temps d'attente)
+    with self.__putLock:
+      seq = next(self.__seqCounter)
+      self.__queue.put((seq, op, item, flag, stamp, index))
+    if self.__wakeUp is not None:
+      self.__wakeUp.set()
+    return seq
+
+  def get(self):
+    ''' Renvoie la prochaine operation (seq, op, item, flag, stamp, index) ou None si la file est vide (cote consommateur) '''
+    try:
+      operation = self.__queue.get_nowait()
+    except queue.Empty:
+      return None
+    if operation[0] != self.__expectedSeq:
+      self.__seqErrors += 1
+    self.__expectedSeq = operation[0] + 1
+    return operation
+
+  def apply(self, stack: grblStack):
+    '''
+    Applique a la pile toutes les operations en attente, dans l'ordre de depot.
+    Renvoie la liste des operations qui demandent une action du consommateur
+    en plus de la mise a jour de la pile (COM_OP_RESET).
+    '''
+    actions = []
+    while True:
+      operation = self.get()
+      if operation is None:
+        break
+      seq, op, item, flag, stamp, index = operation
+      if op == COM_OP_REALTIME:
+        stack.addFiFo(item, flag, STACK_LANE_REALTIME, stamp)
+      elif op == COM_OP_INSERT:
+        stack.addLiFo(item, flag, STACK_LANE_URGENT, stamp, index)
+      elif op == COM_OP_PUSH:
+        stack.addFiFo(item, flag, STACK_LANE_NORMAL, stamp, index)
+      elif op == COM_OP_CLEAR:
+        stack.clear()
+      elif op == COM_OP_RESET:
+        stack.clear()
+        actions.append(operation)
+    return actions
+
+  def lastSeq(self):
+    ''' Numero de sequence de la derniere operation traitee par le consommateur (-1 si aucune) '''
+    return self.__expectedSeq - 1
+
+  def seqErrors(self):
+    ''' Nombre d'operations recues hors sequence (doit toujours rester a 0) '''
+    return self.__seqErrors
+
+
+if __name__ == '__main__':
+  # Test de charge : le thread "GUI" empile des lignes numerotees et vide regulierement
+  # la pile pendant qu'un thread "worker" la depile. Chaque ligne doit sortir au plus une
+  # fois, dans l'ordre, et toute ligne non sortie doit avoir ete suivie d'un clear.
+  nbLignes = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+  wakeUp   = threading.Event()
+  comQueue = grblComQueue(wakeUp)
+  pile     = grblStack()
+  depilees = []
+  fini     = threading.Event()
+
+  def worker():
+    while True:
+      wakeUp.wait(0.01)
+      wakeUp.clear()
+      comQueue.apply(pile)
+      while not pile.isEmpty():
+        depilees.append(int(pile.pop()[0]))
+      if fini.is_set() and comQueue.get() is None:
+        break
+
+  t = threading.Thread(target=worker)
+  t.start()
+  t0 = time.perf_counter()
+  clears = [] # index de la premiere ligne empilee apres chaque clear
+  for i in range(nbLignes):
+    comQueue.put(COM_OP_PUSH, str(i))
+    if i % 997 == 0:
+      comQueue.put(COM_OP_CLEAR)
+      clears.append(i + 1)
+  fini.set()
+  t.join()
+  duree = time.perf_counter() - t0
+
+  erreurs = 0
+  if len(depilees) != len(set(depilees)):
+    print("Duplicated lines!")
+    erreurs += 1
+  if depilees != sorted(depilees):
+    print("Reordered lines!")
+    erreurs += 1
+  # Entre deux clear, les lignes sorties doivent etre un debut continu du segment :
+  # seul un clear peut faire disparaitre les lignes suivantes.
+  perdues = set(range(nbLignes)) - set(depilees)
+  bornes = [0] + clears + [nbLignes]
+  for debut, fin in zip(bornes[:-1], bornes[1:]):
+    sorties = [l for l in range(debut, fin) if l not in perdues]
+    if sorties != list(range(debut, debut + len(sorties))) or (fin == nbLignes and len(sorties) != fin - debut):
+      print("Lost lines between {} and {}!".format(debut, fin))
+      erreurs += 1
+      break
+  if comQueue.seqErrors() != 0 or comQueue.lastSeq() != nbLignes + len(clears) - 1:
+    print("Sequence errors: {}, last sequence: {}".format(comQueue.seqErrors(), comQueue.lastSeq()))
+    erreurs += 1
+  print("{} lines pushed, {} clears, {} lines popped, {} dropped by clear, {:.0f} ops/s: {}".format(
+    nbLignes, len(clears), len(depilees), len(perdues), (nbLignes + len(clears)) / duree, "OK" if erreurs == 0 else "FAILED"))
+  sys.exit(erreurs)
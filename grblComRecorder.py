@@ -0,0 +1,291 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import sys, os, time, struct, mmap, threading
+import serial
+from cn5X_config import *
+from grblComTransport import grblTransport, REPLAY_PORT_PREFIX
+
+'''
+Format des enregistrements de session (fichiers .cn5xrec), ajout seul, lisible par mmap :
+  entete  : REC_MAGIC (8 octets) + heure de debut (double, time.time())
+  records : horodatage (double, secondes depuis le debut, horloge monotone)
+            + sens (octet REC_SENT / REC_RECEIVED) + longueur (uint32) + donnees
+Tous les nombres sont en little-endian. Un dernier record tronque (arret brutal) est ignore a la lecture.
+'''
+REC_MAGIC        = b"CN5XREC\x01"
+REC_HEADER       = struct.Struct("<8sd")
+REC_RECORD       = struct.Struct("<dBI")
+REC_SENT         = 0 # Octets envoyes a Grbl
+REC_RECEIVED     = 1 # Octets recus de Grbl
+REC_FILE_EXT     = ".cn5xrec"
+REC_FLUSH_DELAY  = 1.0 # secondes, ecriture differee maxi sur le disque
+
+
+class grblSessionWriter():
+  ''' Ecriture d'un enregistrement de session, appelable depuis plusieurs threads '''
+
+  def __init__(self, fileName: str):
+    self.__lock      = threading.Lock()
+    self.__file      = open(fileName, "wb")
+    self.__t0        = time.monotonic()
+    self.__lastFlush = self.__t0
+    self.__file.write(REC_HEADER.pack(REC_MAGIC, time.time()))
+
+  def record(self, direction: int, data: bytes):
+    if len(data) == 0:
+      return
+    with self.__lock:
+      if self.__file is None:
+        return
+      now = time.monotonic()
+      self.__file.write(REC_RECORD.pack(now - self.__t0, direction, len(data)))
+      self.__file.write(data)
+      if now - self.__lastFlush >= REC_FLUSH_DELAY:
+        self.__file.flush()
+        self.__lastFlush = now
+
+  def close(self):
+    with self.__lock:
+      if self.__file is not None:
+        self.__file.close()
+        self.__file = None
+
+
+class grblSessionReader():
+  ''' Lecture d'un enregistrement de session via mmap, sans copie des donnees '''
+
+  def __init__(self, fileName: str):
+    with open(fileName, "rb") as f:
+      taille = os.fstat(f.fileno()).st_size
+      if taille < REC_HEADER.size:
+        raise ValueError("{} is not a cn5X++ session recording".format(fileName))
+      self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.startTime = REC_HEADER.unpack_from(self.__map, 0)
+    if magic != REC_MAGIC:
+      self.__map.close()
+      raise ValueError("{} is not a cn5X++ session recording".format(fileName))
+
+  def records(self):
+    ''' Generateur de (horodatage, sens, donnees (memoryview)) dans l'ordre d'enregistrement '''
+    vue = memoryview(self.__map)
+    pos = REC_HEADER.size
+    while pos + REC_RECORD.size <= len(vue):
+      t, direction, longueur = REC_RECORD.unpack_from(vue, pos)
+      pos += REC_RECORD.size
+      if pos + longueur > len(vue):
+        break # Record tronque
+      yield t, direction, vue[pos:pos + longueur]
+      pos += longueur
+
+  def close(self):
+    self.__map.close()
+
+
+class grblTransportRecorder(grblTransport):
+  ''' Enregistreur de vol : transmet tout au transport encapsule et enregistre les octets echanges '''
+
+  def __init__(self, transport: grblTransport, fileName: str):
+    super().__init__(transport.port)
+    self.__transport = transport
+    self.__fileName  = fileName
+    self.__writer    = None
+
+  def open(self):
+    self.__transport.open()
+    try:
+      self.__writer = grblSessionWriter(self.__fileName)
+    except OSError as err:
+      self.__transport.close()
+      raise serial.SerialException("could not create session recording {}: {}".format(self.__fileName, err))
+
+  def close(self):
+    self.__transport.close()
+    if self.__writer is not None:
+      self.__writer.close()
+
+  @property
+  def in_waiting(self):
+    return self.__transport.in_waiting
+
+  def readline(self):
+    self.__transport.timeout = self.timeout
+    data = self.__transport.readline()
+    self.__writer.record(REC_RECEIVED, data)
+    return data
+
+  def readChunk(self):
+    self.__transport.timeout = self.timeout
+    data = self.__transport.readChunk()
+    self.__writer.record(REC_RECEIVED, data)
+    return data
+
+  def write(self, data: bytes):
+    self.__transport.write_timeout = self.write_timeout
+    n = self.__transport.write(data)
+    self.__writer.record(REC_SENT, data)
+    return n
+
+  def cancel_read(self):
+    self.__transport.cancel_read()
+
+
+class grblTransportReplay(grblTransport):
+  '''
+  Rejeu d'une session enregistree a la place de Grbl : les octets recus lors de
+  l'enregistrement sont restitues dans le meme ordre et avec le meme decoupage,
+  a leur heure d'origine divisee par speed (replay:///chemin/session.cn5xrec?speed=2),
+  ou sans attente avec speed=0. Les octets envoyes par cn5X++ sont ignores.
+  '''
+
+  def __init__(self, portName: str):
+    super().__init__(portName)
+    chemin = portName[len(REPLAY_PORT_PREFIX):]
+    self.__speed = 1.0
+    debut, _, options = chemin.rpartition("?")
+    if options[:6] == "speed=":
+      chemin = debut
+      self.__speed = float(options[6:])
+    self.__fileName = chemin
+    self.__reader   = None
+    self.__records  = None
+    self.__next     = None # Prochain record recu a restituer (horodatage, donnees)
+    self.__buffer   = bytearray()
+    self.__t0       = 0
+    self.__cancel   = threading.Event()
+    self.bytesIgnored = 0
+
+  def open(self):
+    try:
+      self.__reader = grblSessionReader(self.__fileName)
+    except OSError as err:
+      raise serial.SerialException("could not open {}: {}".format(self.__fileName, err))
+    self.__records = self.__reader.records()
+    self.__t0 = time.monotonic()
+    self.__advance()
+
+  def close(self):
+    self.__records = None
+    self.__next = None
+    if self.__reader is not None:
+      self.__reader.close()
+      self.__reader = None
+
+  def __advance(self):
+    ''' Passe au prochain record recu de Grbl '''
+    self.__next = None
+    if self.__records is None:
+      return
+    for t, direction, data in self.__records:
+      if direction == REC_RECEIVED:
+        self.__next = (t, bytes(data))
+        return
+
+  def __due(self):
+    ''' Delai (secondes) avant le prochain record, None si la session est terminee '''
+    if self.__next is None:
+      return None
+    if self.__speed <= 0:
+      return 0
+    return max(self.__next[0] / self.__speed - (time.monotonic() - self.__t0), 0)
+
+  def __fill(self, timeout):
+    ''' Ajoute au buffer le prochain record recu des qu'il est du (au plus timeout secondes d'attente) '''
+    delai = self.__due()
+    if delai is None:
+      self.__cancel.wait(timeout) # Fin de session : Grbl ne dit plus rien
+      self.__cancel.clear()
+      return
+    if delai > 0:
+      if self.__cancel.wait(min(delai, timeout)):
+        self.__cancel.clear()
+        return
+      if delai > timeout:
+        return
+    self.__buffer += self.__next[1]
+    self.__advance()
+
+  @property
+  def in_waiting(self):
+    if len(self.__buffer) == 0 and self.__due() == 0:
+      self.__fill(0)
+    return len(self.__buffer)
+
+  def readline(self):
+    limite = time.monotonic() + self.timeout
+    while b'\n' not in self.__buffer:
+      reste = limite - time.monotonic()
+      if reste <= 0:
+        break
+      self.__fill(reste)
+    fin = self.__buffer.find(b'\n') + 1
+    if fin == 0:
+      fin = len(self.__buffer)
+    data = bytes(self.__buffer[:fin])
+    del self.__buffer[:fin]
+    return data
+
+  def readChunk(self):
+    if len(self.__buffer) == 0:
+      self.__fill(self.timeout)
+    data = bytes(self.__buffer)
+    del self.__buffer[:]
+    return data
+
+  def write(self, data: bytes):
+    self.bytesIgnored += len(data)
+    return len(data)
+
+  def cancel_read(self):
+    self.__cancel.set()
+
+
+if __name__ == '__main__':
+  # Resume d'un enregistrement et vitesse de decoupage en lignes des donnees recues
+  from grblComFramer import grblLineFramer, GRBL_LINE_OK, GRBL_LINE_STATUS
+  if len(sys.argv) < 2:
+    print("Usage: {} session{}".format(sys.argv[0], REC_FILE_EXT))
+    sys.exit(1)
+  lecteur = grblSessionReader(sys.argv[1])
+  nbRecords, octets, duree = 0, [0, 0], 0.0
+  recu = []
+  for t, direction, data in lecteur.records():
+    nbRecords += 1
+    octets[direction] += len(data)
+    duree = t
+    if direction == REC_RECEIVED:
+      recu.append(bytes(data))
+  print("Session of {}: {:.1f} s, {} records, {} bytes sent, {} bytes received".format(
+    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(lecteur.startTime)), duree, nbRecords, octets[REC_SENT], octets[REC_RECEIVED]))
+  framer = grblLineFramer()
+  compteurs = {}
+  t0 = time.perf_counter()
+  for data in recu:
+    framer.feed(data)
+    for kind, ligne in framer.lines():
+      compteurs[kind] = compteurs.get(kind, 0) + 1
+  t1 = time.perf_counter() - t0
+  nbLignes = sum(compteurs.values())
+  print("{} lines received ({} ok, {} status reports), framed in {:.3f} s ({:.0f} lines/s)".format(
+    nbLignes, compteurs.get(GRBL_LINE_OK, 0), compteurs.get(GRBL_LINE_STATUS, 0), t1, nbLignes / t1 if t1 > 0 else 0))
+  lecteur.close()
@@ -22,12 +22,38 @@
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 
 import sys, time
+import threading, queue
 import serial
+from collections import deque
 from enum import Enum
 from math import *
 from PyQt6.QtCore import QCoreApplication, QObject, QThread, QTimer, QEventLoop, pyqtSignal, pyqtSlot, QIODevice
 from cn5X_config import *
-from grblComStack import grblStack
+from grblComStack import grblStack, STACK_LANE_REALTIME, STACK_LANE_URGENT, STACK_LANE_NORMAL
+from grblComQueue import *
+from grblComFramer import *
+from grblComTransport import grblTransportFor
+from grblComStats import grblComStats
+from grblComRecorder import grblTransportRecorder
+
+''' Evenements transmis par sig_batch (premier element de chaque tuple de la liste) '''
+COM_EVT_CONNECT    = 0
+COM_EVT_LOG        = 1
+COM_EVT_INIT       = 2
+COM_EVT_OK         = 3
+COM_EVT_ERROR      = 4
+COM_EVT_ALARM      = 5
+COM_EVT_STATUS     = 6
+COM_EVT_CONFIG     = 7
+COM_EVT_DATA       = 8
+COM_EVT_PROBE      = 9
+COM_EVT_EMIT       = 10
+COM_EVT_RECU       = 11
+COM_EVT_DEBUG      = 12
+COM_EVT_ACTIVITY   = 13
+COM_EVT_SERIALLOCK = 14
+COM_EVT_LINESENT   = 15
+COM_EVT_LINEACKED  = 16
 
 
 class grblComSerial(QObject):
@@ -51,17 +77,28 @@ class grblComSerial(QObject):
   sig_debug      = pyqtSignal(str)      # Emis a chaque envoi ou reception
   sig_activity   = pyqtSignal(bool)     # Emis lors de l'émission/réception de données sur le port série
   sig_serialLock = pyqtSignal(bool)     # Emis a chaque changement de self.__okToSendGCode
+  sig_lineSent   = pyqtSignal(int)      # Emis a l'envoi d'une ligne du fichier GCode, renvoie son index (cf. gcodePush())
+  sig_lineAcked  = pyqtSignal(int, int) # Emis a l'acquittement d'une ligne du fichier GCode, renvoie son index et le N° d'erreur (0 = ok)
+  sig_batch      = pyqtSignal(list)     # Mode batch : tous les evenements d'un tour de boucle, liste de tuples (COM_EVT_XXX, arguments...)
 
-  def __init__(self, decodeur, comPort: str, baudRate: int, pooling: bool):
+  def __init__(self, decodeur, comPort: str, baudRate: int, pooling: bool, streamingMode: int = STREAMING_PING_PONG):
     super().__init__()
     self.__decode = decodeur
 
     self.__abort            = False
     self.__portName         = comPort
     self.__baudRate         = baudRate
+    self.__streamingMode    = streamingMode
 
-    self.__realTimeStack    = grblStack()
-    self.__mainStack        = grblStack()
+    # Lignes envoyees a Grbl en attente de ok ou error, dans l'ordre d'envoi,
+    # sous la forme (nombre d'octets, flag, commande synchrone, heure d'envoi, index de la ligne source)
+    self.__pendingLines     = deque()
+    self.__rxBufferCount    = 0 # Nombre d'octets occupes dans le buffer de reception de Grbl
+
+    # Pile unique a 3 files : temps reel, insertions prioritaires et GCode normal.
+    # Seul le thread de communication manipule la pile, les autres threads passent
+    # par self.__commands (operations numerotees, appliquees dans l'ordre de depot).
+    self.__stack            = grblStack()
 
     self.__initOK           = False
     self.__grblStatus       = ""
@@ -76,19 +113,121 @@ class grblComSerial(QObject):
     ]
     self.__lastQueryTime    = time.time()
     self.__pooling          = pooling
+    # Polling adaptatif : frequence selon l'etat de Grbl et $G seulement si l'etat modal a pu changer
+    self.__adaptivePolling  = True
+    self.__lastCommandTime  = 0     # Dernier envoi d'une commande autre que "?" (time.time())
+    self.__gcodeStateDirty  = True  # L'etat modal de Grbl a pu changer depuis le dernier $G
+
+    # Reveil de la boucle principale : donnees recues, commande a envoyer, arret...
+    self.__wakeUp           = threading.Event()
+    self.__commands         = grblComQueue(self.__wakeUp)
+    # Paquets d'octets recus par le thread de lecture du port serie et decoupage en lignes
+    self.__rxQueue          = queue.SimpleQueue()
+    self.__framer           = grblLineFramer()
+    self.__readerThread     = None
     self.__okToSendGCode = True
     self.sig_serialLock.emit(self.__okToSendGCode)
+
+    # Signaux dans l'ordre des COM_EVT_XXX
+    self.__signals = [
+      self.sig_connect, self.sig_log, self.sig_init, self.sig_ok, self.sig_error,
+      self.sig_alarm, self.sig_status, self.sig_config, self.sig_data, self.sig_probe,
+      self.sig_emit, self.sig_recu, self.sig_debug, self.sig_activity, self.sig_serialLock,
+      self.sig_lineSent, self.sig_lineAcked
+    ]
+    self.__debug            = False # Formatage et emission des messages de debug
+    self.__batchMode        = False # Regroupement des evenements d'un tour de boucle dans sig_batch
+    self.__batching         = False # Vrai pendant les tours de boucle principale en mode batch
+    self.__events           = []
+    self.__activity         = None  # Dernier etat d'activite du tour de boucle (mode batch)
+    self.__lastFlushTime    = time.time()
+    self.__stats            = grblComStats() # Remplace par celui de grblCom via setStats()
+    self.__recordFile       = None           # Enregistrement de la session (cf. setRecordFile())
     
     self.probeAttendu = False
 
   @pyqtSlot()
   def startPooling(self):
     self.__pooling = True
+    self.__wakeUp.set()
 
 
   @pyqtSlot()
   def stopPooling(self):
     self.__pooling = False
+    self.__wakeUp.set()
+
+
+  @pyqtSlot(bool)
+  def setDebug(self, value: bool):
+    ''' Active ou desactive la production des messages de debug (sig_debug) '''
+    self.__debug = value
+
+
+  @pyqtSlot(bool)
+  def setBatchMode(self, value: bool):
+    '''
+    Mode batch : les signaux emis pendant un tour de la boucle principale sont regroupes
+    dans un seul sig_batch en fin de tour au lieu d'etre emis un par un.
+    '''
+    self.__batchMode = value
+    self.__wakeUp.set()
+
+
+  def setStats(self, stats: grblComStats):
+    ''' Instrumentation (latences, debits) a alimenter, a appeler avant le demarrage du thread '''
+    self.__stats = stats
+
+
+  def setRecordFile(self, fileName: str):
+    ''' Enregistreur de vol : tous les octets echanges seront enregistres dans fileName (None pour ne pas enregistrer) '''
+    self.__recordFile = fileName
+
+
+  @pyqtSlot(bool)
+  def setAdaptivePolling(self, value: bool):
+    '''
+    Polling adaptatif : interrogation rapide de Grbl en mouvement (GRBL_QUERY_DELAY_RUN),
+    lente a l'arret (GRBL_QUERY_DELAY_IDLE) et $G uniquement apres l'envoi de GCode.
+    Sinon, interrogation toutes les GRBL_QUERY_DELAY ms avec un $G toutes les 5 interrogations.
+    '''
+    self.__adaptivePolling = value
+    self.__gcodeStateDirty = True
+    self.__wakeUp.set()
+
+
+  def __post(self, event: int, *args):
+    ''' Emission d'un signal du thread de communication, ou mise en attente en mode batch '''
+    if not self.__batching:
+      self.__signals[event].emit(*args)
+    elif event == COM_EVT_ACTIVITY:
+      # Seuls le debut et la fin d'activite du tour de boucle sont transmis
+      if self.__activity is None:
+        self.__events.append((COM_EVT_ACTIVITY, True))
+      self.__activity = args[0]
+    else:
+      self.__events.append((event,) + args)
+
+
+  def __flushEvents(self, force: bool = False):
+    '''
+    Mode batch : emet en un seul signal les evenements en attente, au plus
+    une fois toutes les COM_BATCH_DELAY millisecondes sauf si force est vrai.
+    '''
+    if not self.__batchMode:
+      force = True # Le mode batch vient d'etre desactive, on vide tout
+    if self.__activity is None and len(self.__events) == 0:
+      self.__lastFlushTime = time.time()
+    elif force or (time.time() - self.__lastFlushTime) * 1000 >= COM_BATCH_DELAY:
+      if self.__activity is not None:
+        if not self.__activity:
+          self.__events.append((COM_EVT_ACTIVITY, False))
+        self.__activity = None
+      if len(self.__events) > 0:
+        self.sig_batch.emit(self.__events)
+        self.__events = []
+      self.__lastFlushTime = time.time()
+    self.__batching = self.__batchMode
 
 
   @pyqtSlot()
@@ -96,60 +235,62 @@ class grblComSerial(QObject):
     ''' Traitement du signal demandant l'arret de la communication '''
     self.sig_log.emit(logSeverity.info.value, self.tr("grblComSerial.py: abort received."))
     self.__abort = True
+    self.__wakeUp.set()
 
 
   @pyqtSlot()
   def clearCom(self):
     ''' Vide les files d'attente '''
-    self.__realTimeStack.clear()
-    self.__mainStack.clear()
+    self.__commands.put(COM_OP_CLEAR)
 
 
   @pyqtSlot(str)
   @pyqtSlot(str, object)
   def realTimePush(self, buff: str, flag = COM_FLAG_NO_FLAG):
     ''' Ajout d'une commande GCode dans la pile en mode FiFo '''
-    self.__realTimeStack.addFiFo(buff, flag)
+    self.__commands.put(COM_OP_REALTIME, buff, flag)
 
 
   @pyqtSlot(str)
   @pyqtSlot(str, object)
-  def gcodePush(self, buff: str, flag = COM_FLAG_NO_FLAG):
-    ''' Ajout d'une commande GCode dans la pile en mode FiFo (fonctionnement normal de la pile d'un programe GCode) '''
-    self.__mainStack.addFiFo(buff, flag)
+  @pyqtSlot(str, object, int)
+  def gcodePush(self, buff: str, flag = COM_FLAG_NO_FLAG, index: int = COM_NO_LINE_INDEX):
+    '''
+    Ajout d'une commande GCode dans la pile en mode FiFo (fonctionnement normal de la pile d'un programe GCode).
+    index (numero de la ligne dans le fichier GCode) est renvoye par sig_lineSent et sig_lineAcked.
+    '''
+    self.__commands.put(COM_OP_PUSH, buff, flag, index)
 
 
   @pyqtSlot(str)
   def resetSerial(self):
     ''' Reinitialisation de la communication série '''
-    self.__realTimeStack.clear()
-    self.__mainStack.clear()
-    self.__sendData(REAL_TIME_SOFT_RESET)
-    self.__okToSendGCode = True
-    self.sig_serialLock.emit(self.__okToSendGCode)
+    self.__commands.put(COM_OP_RESET)
 
 
   @pyqtSlot(str)
   @pyqtSlot(str, object)
-  def gcodeInsert(self, buff: str, flag = COM_FLAG_NO_FLAG):
+  @pyqtSlot(str, object, int)
+  def gcodeInsert(self, buff: str, flag = COM_FLAG_NO_FLAG, index: int = COM_NO_LINE_INDEX):
     ''' Insertion d'une commande GCode dans la pile en mode LiFo (commandes devant passer devant les autres) '''
-    self.__mainStack.addLiFo(buff, flag)
+    self.__commands.put(COM_OP_INSERT, buff, flag, index)
 
 
   def __sendData(self, buff: str):
     ''' Envoie des donnees sur le port serie '''
     # Signal debug pour toutes les donnees envoyees
-    if buff[-2:] == "\r\n":
-      self.sig_debug.emit(">>> " + buff[:-2] + "\\r\\n")
-    elif buff[-1:] == "\n":
-      self.sig_debug.emit(">>> " + buff[:-1] + "\\n")
-    else:
-      if buff == REAL_TIME_SOFT_RESET:
-        self.sig_debug.emit(">>> REAL_TIME_SOFT_RESET")
-      elif buff == REAL_TIME_JOG_CANCEL:
-        self.sig_debug.emit(">>> REAL_TIME_JOG_CANCEL")
+    if self.__debug:
+      if buff[-2:] == "\r\n":
+        self.__post(COM_EVT_DEBUG, ">>> " + buff[:-2] + "\\r\\n")
+      elif buff[-1:] == "\n":
+        self.__post(COM_EVT_DEBUG, ">>> " + buff[:-1] + "\\n")
       else:
-        self.sig_debug.emit(">>> " + buff)
+        if buff == REAL_TIME_SOFT_RESET:
+          self.__post(COM_EVT_DEBUG, ">>> REAL_TIME_SOFT_RESET")
+        elif buff == REAL_TIME_JOG_CANCEL:
+          self.__post(COM_EVT_DEBUG, ">>> REAL_TIME_JOG_CANCEL")
+        else:
+          self.__post(COM_EVT_DEBUG, ">>> " + buff)
     # Force l'etat "Home" car grbl bloque la commande ? pendant le Homing
     if buff[0:2] == CMD_GRBL_RUN_HOME_CYCLE:
       self.__decode.set_etatMachine(GRBL_STATUS_HOME)
@@ -158,91 +299,96 @@ class grblComSerial(QObject):
     if "G38" in buff:
       self.__grblStatus = GRBL_STATUS_RUN
       self.probeAttendu = True
+    # Le soft reset vide le buffer de reception de Grbl, plus aucune reponse n'est attendue
+    if buff == REAL_TIME_SOFT_RESET:
+      self.__clearPendingLines()
+    # Toute commande autre que "?" peut faire changer l'etat de Grbl (polling adaptatif)
+    if buff != REAL_TIME_REPORT_QUERY:
+      self.__lastCommandTime = time.time()
+      if (len(buff) > 1 and buff[:1] != '$') or buff in [REAL_TIME_TOGGLE_FLOOD_COOLANT, REAL_TIME_TOGGLE_MIST_COOLANT]:
+        self.__gcodeStateDirty = True
     # Formatage du buffer a envoyer
     buffWrite = bytes(buff, sys.getdefaultencoding())
     # Temps necessaire pour la com (millisecondes), arrondi a l'entier superieur
     tempNecessaire = ceil(1000 * len(buffWrite) * 8 / self.__baudRate)
     timeout = 10 + (2 * tempNecessaire) # 2 fois le temps necessaire + 10 millisecondes
-    self.__comPort.write_timeout = timeout
+    self.__comPort.write_timeout = timeout / 1000 # Les transports attendent des secondes
     # Ecriture sur le port serie
-    self.sig_debug.emit("grblComSerial.__sendData(), T = {} : timeout = {}".format(time.time() * 1000, timeout))
-    self.sig_activity.emit(True)
+    if self.__debug:
+      self.__post(COM_EVT_DEBUG, "grblComSerial.__sendData(), T = {} : timeout = {}".format(time.time() * 1000, timeout))
+    self.__post(COM_EVT_ACTIVITY, True)
     try:
       self.__comPort.write(buffWrite)
-    except serial.SerialTimeoutException:
-      self.sig_log.emit(logSeverity.error.value, self.tr("grblComSerial: Error when sending data: timeout, err# = {}").format(self.__comPort.error()))
+      self.__stats.dataSent(time.perf_counter(), len(buffWrite))
+    except serial.SerialTimeoutException as err:
+      self.__post(COM_EVT_LOG, logSeverity.error.value, self.tr("grblComSerial: Error when sending data: timeout ({})").format(str(err)))
     except:
-      self.sig_log.emit(logSeverity.error.value, self.tr("grblComSerial: Unknown error"))
+      self.__post(COM_EVT_LOG, logSeverity.error.value, self.tr("grblComSerial: Unknown error"))
     else:
-      self.sig_debug.emit(self.tr("grblComSerial: Data sent, T = {}".format(time.time() * 1000)))
-      self.sig_activity.emit(False)
+      if self.__debug:
+        self.__post(COM_EVT_DEBUG, self.tr("grblComSerial: Data sent, T = {}".format(time.time() * 1000)))
+      self.__post(COM_EVT_ACTIVITY, False)
 
 
-  def __traileLaLigne(self, l, flag = COM_FLAG_NO_FLAG):
-    ''' Emmet les signaux ad-hoc pour toutes les lignes recues  '''
+  def __traileLaLigne(self, l, flag = COM_FLAG_NO_FLAG, kind = GRBL_LINE_OTHER, index = COM_NO_LINE_INDEX):
+    '''
+    Emmet les signaux ad-hoc pour toutes les lignes recues (kind : type GRBL_LINE_XXX donne par grblLineFramer,
+    index : ligne du fichier GCode acquittee par un ok ou une erreur)
+    '''
     # Envoi de toutes les lignes dans le debug
-    if l[-1:] == "\n":
-      self.sig_debug.emit("<<< " + l[:-1] + "\\n")
-    elif l[-2:] == "\r\n":
-      self.sig_debug.emit("<<< " + l[:-2] + "\\r\\n")
-    else:
-      self.sig_debug.emit("<<< " + l)
+    if self.__debug:
+      self.__post(COM_EVT_DEBUG, "<<< " + l)
     # Premier decodage pour envoyer le signal ah-hoc
-    if l[:5] == "Grbl " and l[-5:] == "help]": # Init string : Grbl 1.1f ['$' for help]
-      self.sig_init.emit(l)
-    elif l == "ok":                            # Reponses "ok"
+    if kind == GRBL_LINE_OK:                   # Reponses "ok"
       if not flag & COM_FLAG_NO_OK:
-        self.sig_ok.emit()
+        self.__post(COM_EVT_OK)
         self.probeAttendu = False
-    elif l[:6] == "error:":                    # "error:X" => Renvoie X
+      if index != COM_NO_LINE_INDEX:
+        self.__post(COM_EVT_LINEACKED, index, 0)
+    elif kind == GRBL_LINE_STATUS:             # Real-time Status Reports
+      self.__grblStatus = l[1:].split('|')[0]
+      self.__stats.statusReceived(time.perf_counter(), l)
+      self.__post(COM_EVT_STATUS, l)
+    elif kind == GRBL_LINE_INIT:               # Init string : Grbl 1.1f ['$' for help]
+      self.__gcodeStateDirty = True
+      self.__post(COM_EVT_INIT, l)
+    elif kind == GRBL_LINE_ERROR:              # "error:X" => Renvoie X
+      errNum = int(l.split(':')[1])
       if not flag & COM_FLAG_NO_ERROR:
-        errNum = int(l.split(':')[1])
-        self.sig_error.emit(errNum)
+        self.__post(COM_EVT_ERROR, errNum)
         self.probeAttendu = False
-    elif l[:6] == "ALARM:":                    # "ALARM:X" => Renvoie X
+      if index != COM_NO_LINE_INDEX:
+        self.__post(COM_EVT_LINEACKED, index, errNum)
+    elif kind == GRBL_LINE_ALARM:              # "ALARM:X" => Renvoie X
+      self.__gcodeStateDirty = True
       alarmNum = int(l.split(':')[1])
-      self.sig_alarm.emit(alarmNum)
+      self.__post(COM_EVT_ALARM, alarmNum)
       self.probeAttendu = False
-    elif l[:1] == "<" and l[-1:] == ">":       # Real-time Status Reports
-      self.__grblStatus = l[1:].split('|')[0]
-      self.sig_status.emit(l)
     elif l[:5] == "[PRB:": # Probe result
-      self.sig_data.emit(l)
+      self.__post(COM_EVT_DATA, l)
       if self.probeAttendu:
-        self.sig_probe.emit(l)
+        self.__post(COM_EVT_PROBE, l)
         self.probeAttendu = False
     elif l[:1] == "$" or l[:5] == "[VER:" or l[:5] == "[AXS:" or l[:5] == "[OPT:": # Setting output
-      self.sig_config.emit(l)
+      self.__post(COM_EVT_CONFIG, l)
     else:
-      self.sig_data.emit(l)
+      self.__post(COM_EVT_DATA, l)
 
 
   def __openComPort(self):
     ''' Ouverture du port serie et attente de la chaine d'initialisation en provenence de Grbl '''
 
-    self.sig_debug.emit("grblComSerial.__openComPort(self)")
+    if self.__debug:
+      self.sig_debug.emit("grblComSerial.__openComPort(self)")
 
     openReceiveTimeout = 2000 # Timeout for first Grbl serial message
     openResetTime = 2000      # Time for sending soft reset if init string is not receive from Grbl
     openMaxTime =   5000      # (ms) Timeout pour recevoir la reponse de Grbl apres ouverture du port = 5 secondes
 
-    # Configuration du port serie
-    self.__comPort = serial.Serial()
-    com_settings = {
-      'baudrate':           self.__baudRate,
-      'bytesize':           serial.EIGHTBITS,
-      'parity':             serial.PARITY_NONE,
-      'stopbits':           serial.STOPBITS_ONE,
-      'xonxoff':            False,
-      'dsrdtr':             False,
-      'rtscts':             False,
-      'timeout':            SERIAL_READ_TIMEOUT,
-      'write_timeout':      None,
-      'inter_byte_timeout': None
-      }
-    self.__comPort.apply_settings(com_settings)
-
-    self.__comPort.port = self.__portName
+    # Configuration du port : serie ou reseau (tcp://hote:port) selon le nom donne
+    self.__comPort = grblTransportFor(self.__portName, self.__baudRate)
+    if self.__recordFile is not None:
+      self.__comPort = grblTransportRecorder(self.__comPort, self.__recordFile)
 
     # Ouverture du port
     RC = False
@@ -250,28 +396,33 @@ class grblComSerial(QObject):
       self.__comPort.open()
     except serial.SerialException as err:
       self.sig_log.emit(logSeverity.error.value, self.tr("grblComSerial.__openComPort(): Error opening serial port : {0}").format(err))
-      self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): Error opening serial port : {0}").format(err))
+      if self.__debug:
+        self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): Error opening serial port : {0}").format(err))
       self.sig_connect.emit(False)
       return False
     except ValueError as err: #– Will be raised when parameter are out of range e.g. baud rate, data bits.
       self.sig_log.emit(logSeverity.error.value, self.tr("grblComSerial.__openComPort(): Parameter out of range : {0}").format(err))
-      self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): Parameter out of range : {0}").format(err))
+      if self.__debug:
+        self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): Parameter out of range : {0}").format(err))
       self.sig_connect.emit(False)
       return False
     except:
       self.sig_log.emit(logSeverity.error.value, self.tr("grblComSerial.__openComPort(): Unexpected error : {}").format(sys.exc_info()[0]))
-      self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): Unexpected error : {}").format(sys.exc_info()[0]))
+      if self.__debug:
+        self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): Unexpected error : {}").format(sys.exc_info()[0]))
       self.sig_connect.emit(False)
       return False
 
     # Ouverture du port OK
     self.sig_connect.emit(True)
     self.sig_log.emit(logSeverity.info.value, self.tr("grblComSerial.__openComPort(): comPort {} open.").format(self.__comPort.port))
-    self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): comPort {} open.").format(self.__comPort.port))
+    if self.__debug:
+      self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): comPort {} open.").format(self.__comPort.port))
 
     # Initialisation Grbl
     tDebut=time.time() * 1000
-    self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): Wait for Grbl init... T = {:0.0f} ms...").format(tDebut))
+    if self.__debug:
+      self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): Wait for Grbl init... T = {:0.0f} ms...").format(tDebut))
 
     # Reveille grbl
     self.__comPort.write(("\r\n\r\n").encode('utf-8'))
@@ -282,7 +433,8 @@ class grblComSerial(QObject):
       now = time.time() * 1000
       if now > tDebut + openReceiveTimeout:
         self.sig_log.emit(logSeverity.error.value, self.tr("grblComSerial.__openComPort(): timeout! No reply from Grbl."))
-        self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): timeout! No reply from Grbl."))
+        if self.__debug:
+          self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): timeout! No reply from Grbl."))
         self.sig_connect.emit(False)
         return False
 
@@ -295,16 +447,20 @@ class grblComSerial(QObject):
           buff = self.__comPort.readline()
         except serial.SerialException as err:
           self.sig_log.emit(logSeverity.error.value, self.tr("grblComSerial.__openComPort(): Read error: {}".format(err)))
-          self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): Read error: {}".format(err)))
+          if self.__debug:
+            self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): Read error: {}".format(err)))
           self.sig_connect.emit(False)
           return False
         try:
           l = buff.decode('ascii').strip()
-          self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): line received: \"") + l + "\"")
+          if self.__debug:
+            self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): line received: \"") + l + "\"")
           if l[:5] == "Grbl " and l[-5:] == "help]": # Init string : Grbl V.Mx ['$' for help]
-            self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): Grbl init string received in {:0.0f} ms, OK.").format(time.time()*1000 - tDebut))
+            if self.__debug:
+              self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): Grbl init string received in {:0.0f} ms, OK.").format(time.time()*1000 - tDebut))
             self.sig_init.emit(l)
             self.__initOK = True
+            break # La suite sera lue et decodee par la boucle principale
           else:
             self.sig_data.emit(l)
         except UnicodeDecodeError:
@@ -314,102 +470,282 @@ class grblComSerial(QObject):
         now = time.time() * 1000
         if now > tDebut + (openResetTime) and not tReset:
           # Try to send Reset to Grbl at half time of timeout
-          self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): No response from Grbl after {:0.0f}ms, sending soft reset...").format(openResetTime))
+          if self.__debug:
+            self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): No response from Grbl after {:0.0f}ms, sending soft reset...").format(openResetTime))
           self.__sendData(REAL_TIME_SOFT_RESET)
           self.__sendData("\r\n")
           tReset = True
         if now > tDebut + openMaxTime:
           self.sig_log.emit(logSeverity.error.value, self.tr("grblComSerial.__openComPort(): Grbl initialization: Timeout!"))
-          self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): openMaxTime ({}ms) timeout elapsed !").format(openMaxTime))
+          if self.__debug:
+            self.sig_debug.emit(self.tr("grblComSerial.__openComPort(): openMaxTime ({}ms) timeout elapsed !").format(openMaxTime))
           self.sig_log.emit(logSeverity.error.value, self.tr("grblComSerial.__openComPort(): Grbl's init string not received or unknown Grbl version."))
           self.sig_init.emit("Grbl ??? ['$' for help]")
           self.__initOK = True
           return True # On a pas recu la chaine d'initialisation de Grbl mais on essaie quand même...
       else: # self.__initOK
-        # Appel de CMD_GRBL_GET_BUILD_INFO pour que l'interface recupere le nombre d'axes et leurs noms
-        self.__sendData(CMD_GRBL_GET_BUILD_INFO + "\n")
+        # Appel de CMD_GRBL_GET_BUILD_INFO pour que l'interface recupere le nombre d'axes et leurs noms,
+        # envoye par la boucle principale comme les autres lignes pour que son ok lui soit attribue
+        self.__stack.addLiFo(CMD_GRBL_GET_BUILD_INFO + "\n")
         return True # On a bien recu la chaine d'initialisation de Grbl
 
-  def __mainLoop(self):
-    ''' Boucle principale du composant : lectures / ecritures sur le port serie '''
-    flag = COM_FLAG_NO_FLAG
+  def __isSyncCommand(self, buff: str):
+    '''
+    Renvoie True si la commande doit etre envoyee seule (buffer Grbl vide) et acquittee avant la suivante.
+    Les commandes $ (sauf $G et jog) et les GCodes ecrivant en EEPROM bloquent les interruptions
+    de Grbl et peuvent faire perdre des caracteres en mode character-counting.
+    '''
+    if buff[:1] == "$":
+      return buff[:2] != CMD_GRBL_GET_GCODE_STATE and buff[:3] != CMD_GRBL_JOG
+    for cmd in GCODE_EEPROM_WRITE_CMD:
+      if cmd in buff:
+        return True
+    return False
+
+
+  def __canSendLine(self, nbOctets: int, sync: bool):
+    ''' Determine si une ligne de nbOctets peut etre envoyee maintenant selon le mode de streaming '''
+    if len(self.__pendingLines) == 0:
+      # Rien en attente chez Grbl, on peut toujours envoyer
+      return True
+    if self.__streamingMode != STREAMING_CHAR_COUNTING:
+      # Mode ping-pong : une seule ligne a la fois
+      return False
+    if sync or self.__pendingLines[0][2]:
+      # Commande synchrone a envoyer ou en cours de traitement
+      return False
+    # Character-counting : la ligne doit tenir dans la place restante du buffer de Grbl
+    return self.__rxBufferCount + nbOctets < GRBL_RX_BUFFER_SIZE
+
+
+  def __gcodeLane(self):
+    ''' Renvoie la file GCode a servir en premier (insertions prioritaires d'abord), None si rien a envoyer '''
+    if not self.__stack.isEmpty(STACK_LANE_URGENT):
+      return STACK_LANE_URGENT
+    if not self.__stack.isEmpty(STACK_LANE_NORMAL):
+      return STACK_LANE_NORMAL
+    return None
+
+
+  def __updateSerialLock(self):
+    ''' Met a jour self.__okToSendGCode et emet sig_serialLock s'il change '''
+    nextLine = self.__stack.next(self.__gcodeLane())
+    if nextLine is None:
+      okToSend = self.__canSendLine(1, False)
+    else:
+      toSend = nextLine[0] if nextLine[0][-1:] == '\n' else nextLine[0] + '\n'
+      okToSend = self.__canSendLine(len(bytes(toSend, sys.getdefaultencoding())), self.__isSyncCommand(toSend))
+    if okToSend != self.__okToSendGCode:
+      self.__okToSendGCode = okToSend
+      self.__post(COM_EVT_SERIALLOCK, self.__okToSendGCode)
+
+
+  def __clearPendingLines(self):
+    ''' Oublie toutes les lignes en attente d'acquittement (reset ou alarme de Grbl) '''
+    self.__pendingLines.clear()
+    self.__rxBufferCount = 0
+
+
+  def __sendGCode(self):
+    ''' Envoi des lignes GCode en attente dans la pile tant que le mode de streaming le permet '''
     while True:
-      # On commence par vider la file d'attente des commandes temps reel
-      while not self.__realTimeStack.isEmpty():
-        toSend, flag = self.__realTimeStack.pop()
-        self.__sendData(toSend)
-      if self.__okToSendGCode == True:
-        # Envoi d'une ligne gcode si en attente
-        if not self.__mainStack.isEmpty():
-          # La pile n'est pas vide, on envoi la prochaine commande recuperee dans la pile GCode
-          toSend, flag = self.__mainStack.pop()
-          if toSend[-1:] != '\n':
-            toSend += '\n'
-          if not flag & COM_FLAG_NO_OK:
-            if toSend[-2:] == '\r\n':
-              self.sig_emit.emit(toSend[:-2])
-            else:
-              self.sig_emit.emit(toSend[:-1])
-          self.__sendData(toSend)
-          self.__okToSendGCode = False # On enverra plus de commande tant que l'on aura pas recu l'accuse de reception.
-          self.sig_serialLock.emit(self.__okToSendGCode)
-      else: # self.__okToSendGCode is False
-        # Process events to receive signals;
-        QCoreApplication.processEvents()
-      #-----------------------------------------------------------------
-      # Lecture du port serie
-      #-----------------------------------------------------------------
-      while self.__comPort.in_waiting:
-        # Début d'activité de lecture
-        self.sig_activity.emit(True)
-        try:
-          # Lecture d'une ligne envoyée par Grbl
-          buff = self.__comPort.readline()
-          l = buff.decode('ascii').strip()
-          # Fin de lecture
-          self.sig_activity.emit(False)
-          if l.find('ok') >= 0 or l.find('error') >= 0 or l.find('ALARM') >= 0:
-            self.__okToSendGCode = True # Accuse de reception, erreur ou ALARME de la derniere commande GCode envoyee
-            self.sig_serialLock.emit(self.__okToSendGCode)
-          if l.find('ok') >= 0:
-            self.sig_debug.emit(self.tr("grblComSerial: __mainLoop(): ok received"))
-          if l.find('error') >= 0:
-            self.sig_debug.emit(self.tr("grblComSerial: __mainLoop(): error Grbl received [{}].").format(l))
-          if l.find('ALARM') >= 0:
-            self.sig_debug.emit(self.tr("grblComSerial: __mainLoop(): ALARM Grbl received [{}].").format(l))
-          if l !='':
-            self.__traileLaLigne(l, flag)
-        except serial.SerialTimeoutException:
-          self.sig_log.emit(logSeverity.error.value, self.tr("grblComSerial.__mainLoop: Timeout when reading serial port!"))
-        except serial.SerialException:
-          self.sig_log.emit(logSeverity.error.value, self.tr("grblComSerial.__mainLoop(): Unexpected exception when reading serial port!"))
-        except UnicodeDecodeError:
-          # Trace l'erreur et ignore...
-          self.sig_log.emit(logSeverity.warning.value, self.tr("grblComSerial.__mainLoop(): utf-8 decode error, buff={}".format(buff)))
+      lane = self.__gcodeLane()
+      if lane is None:
+        break
+      toSend, flag, tEnqueue, index = self.__stack.next(lane)
+      if toSend[-1:] != '\n':
+        toSend += '\n'
+      nbOctets = len(bytes(toSend, sys.getdefaultencoding()))
+      sync = self.__isSyncCommand(toSend)
+      if not self.__canSendLine(nbOctets, sync):
+        break # On attendra les accuses de reception de Grbl
+      self.__stack.pop(lane)
+      if not flag & COM_FLAG_NO_OK:
+        if toSend[-2:] == '\r\n':
+          self.__post(COM_EVT_EMIT, toSend[:-2])
+        else:
+          self.__post(COM_EVT_EMIT, toSend[:-1])
+      if index != COM_NO_LINE_INDEX:
+        self.__post(COM_EVT_LINESENT, index)
+      self.__sendData(toSend)
+      tWrite = time.perf_counter()
+      if tEnqueue is not None:
+        self.__stats.lineSent(tEnqueue, tWrite)
+      # Memorise la ligne pour lui associer la prochaine reponse ok ou error de Grbl
+      self.__pendingLines.append((nbOctets, flag, sync, tWrite, index))
+      self.__rxBufferCount += nbOctets
+    self.__updateSerialLock()
+
+
+  def __ackPendingLine(self):
+    ''' Reception d'un ok ou error : libere la plus ancienne ligne envoyee et renvoie son flag et son index '''
+    if len(self.__pendingLines) == 0:
+      # Reponse a une commande non suivie (initialisation...)
+      return COM_FLAG_NO_FLAG, COM_NO_LINE_INDEX
+    nbOctets, flag, sync, tWrite, index = self.__pendingLines.popleft()
+    self.__rxBufferCount -= nbOctets
+    self.__stats.lineAcked(tWrite, time.perf_counter())
+    return flag, index
+
+
+  def __readLoop(self):
+    '''
+    Thread de lecture du port serie : bloque jusqu'a l'arrivee de donnees de Grbl,
+    lit en une fois tout ce qui est disponible, le transmet a la boucle principale
+    et la reveille.
+    '''
+    while not self.__abort:
+      try:
+        buff = self.__comPort.readChunk()
+      except serial.SerialException as err:
+        if self.__abort:
+          break
+        self.sig_log.emit(logSeverity.error.value, self.tr("grblComSerial.__readLoop(): Unexpected exception when reading serial port: {}").format(err))
+        time.sleep(SERIAL_READ_TIMEOUT / 1000) # Evite de boucler sur un port en erreur
+        continue
+      except (TypeError, AttributeError, OSError):
+        # Port ferme pendant la lecture
+        break
+      if len(buff) > 0:
+        self.__rxQueue.put(buff)
+        self.__wakeUp.set()
+
+
+  def __waitTimeout(self):
+    ''' Temps d'attente maxi (secondes) de la boucle principale avant la prochaine interrogation de Grbl '''
+    timeout = None # Attente sans limite, on sera reveille par une commande ou une reception
+    if self.__pooling and self.__initOK:
+      reste = self.__queryDelay() / 1000 - (time.time() - self.__lastQueryTime)
+      timeout = max(reste, 0)
+    if self.__activity is not None or len(self.__events) > 0:
+      # Des evenements attendent d'etre emis (mode batch)
+      reste = max(COM_BATCH_DELAY / 1000 - (time.time() - self.__lastFlushTime), 0)
+      if timeout is None or reste < timeout:
+        timeout = reste
+    return timeout
+
+
+  def __queryDelay(self):
+    ''' Delai (ms) entre 2 interrogations de Grbl '''
+    if not self.__adaptivePolling:
+      return GRBL_QUERY_DELAY
+    if self.__grblStatus in [GRBL_STATUS_IDLE, GRBL_STATUS_ALARM, GRBL_STATUS_SLEEP, GRBL_STATUS_HOLD0, GRBL_STATUS_DOOR0] \
+    and len(self.__pendingLines) == 0 and self.__stack.isEmpty() \
+    and (time.time() - self.__lastCommandTime) * 1000 >= GRBL_QUERY_DELAY_IDLE:
+      # Rien ne bouge et rien n'a ete envoye recemment
+      return GRBL_QUERY_DELAY_IDLE
+    return GRBL_QUERY_DELAY_RUN
+
+
+  def __pollGrbl(self):
+    ''' Pooling : Interrogations de Grbl a interval regulier selon la sequence definie par self.__querySequence '''
+    if self.__pooling and self.__adaptivePolling:
+      if not self.__initOK:
+        return
+      # $G des que Grbl est revenu au repos si du GCode a ete envoye depuis le dernier $G
+      if self.__gcodeStateDirty and self.__grblStatus == GRBL_STATUS_IDLE \
+      and len(self.__pendingLines) == 0 and self.__stack.isEmpty():
+        self.__gcodeStateDirty = False
+        self.gcodeInsert(CMD_GRBL_GET_GCODE_STATE + '\n', COM_FLAG_NO_OK | COM_FLAG_NO_ERROR)
+      if (time.time() - self.__lastQueryTime) * 1000 >= self.__queryDelay():
+        self.realTimePush(REAL_TIME_REPORT_QUERY)
+        self.__lastQueryTime = time.time()
+    elif self.__pooling:
+      if (time.time() - self.__lastQueryTime) * 1000 >= GRBL_QUERY_DELAY and self.__initOK:
+        if len(self.__querySequence[self.__queryCounter]) == 1:
+          self.realTimePush(self.__querySequence[self.__queryCounter])
+        else:
+          if self.__grblStatus == GRBL_STATUS_IDLE:
+            self.gcodeInsert(self.__querySequence[self.__queryCounter], COM_FLAG_NO_OK | COM_FLAG_NO_ERROR)
+        self.__lastQueryTime    = time.time()
+        self.__queryCounter += 1
+        if self.__queryCounter >= len(self.__querySequence):
+          self.__queryCounter = 0
+
+
+  def __readLines(self):
+    ''' Traitement des lignes recues par le thread de lecture '''
+    while True:
+      try:
+        buff = self.__rxQueue.get_nowait()
+      except queue.Empty:
+        break
+      self.__stats.dataReceived(time.perf_counter(), len(buff))
+      self.__framer.feed(buff)
+    for kind, l in self.__framer.lines():
+      # Début d'activité de lecture
+      self.__post(COM_EVT_ACTIVITY, True)
+      if kind == GRBL_LINE_BAD:
+        # Trace l'erreur et ignore...
+        self.__post(COM_EVT_LOG, logSeverity.warning.value, self.tr("grblComSerial.__readLines(): ascii decode error, buff={}".format(l)))
+        continue
+      # Fin de lecture
+      self.__post(COM_EVT_ACTIVITY, False)
+      flag = COM_FLAG_NO_FLAG
+      index = COM_NO_LINE_INDEX
+      if kind == GRBL_LINE_OK:
+        flag, index = self.__ackPendingLine() # Accuse de reception de la plus ancienne ligne envoyee
+        if self.__debug:
+          self.__post(COM_EVT_DEBUG, self.tr("grblComSerial: __mainLoop(): ok received"))
+      elif kind == GRBL_LINE_ERROR:
+        flag, index = self.__ackPendingLine() # Erreur sur la plus ancienne ligne envoyee
+        if self.__debug:
+          self.__post(COM_EVT_DEBUG, self.tr("grblComSerial: __mainLoop(): error Grbl received [{}].").format(l))
+      elif kind == GRBL_LINE_ALARM:
+        # Pas de remise a zero des lignes en attente : hors reset (ALARM:4/5 de palpage...), Grbl
+        # garde son buffer de reception et repond encore ok/error aux lignes qu'il a deja recues
+        if self.__debug:
+          self.__post(COM_EVT_DEBUG, self.tr("grblComSerial: __mainLoop(): ALARM Grbl received [{}].").format(l))
+      elif kind == GRBL_LINE_INIT:
+        self.__clearPendingLines() # Grbl a redemarre
+      self.__traileLaLigne(l, flag, kind, index)
+    self.__updateSerialLock()
 
-        # Process events to receive signals;
-        QCoreApplication.processEvents()
+
+  def __mainLoop(self):
+    '''
+    Boucle principale du composant : lectures / ecritures sur le port serie.
+    La boucle dort jusqu'a la reception de donnees, l'ajout d'une commande
+    dans les piles ou l'echeance de la prochaine interrogation de Grbl.
+    '''
+    self.__readerThread = threading.Thread(target=self.__readLoop, name="grblComSerialReader", daemon=True)
+    self.__readerThread.start()
+    self.__batching = self.__batchMode
+    while True:
+      self.__wakeUp.wait(self.__waitTimeout())
+      self.__wakeUp.clear()
 
       if self.__abort:
+        self.__flushEvents(True)
+        self.__batching = False
         self.sig_log.emit(logSeverity.info.value, self.tr("grblComSerial.__mainLoop(): Abort received, closing the thread..."))
         break # Sortie de la boucle principale
 
-      # Pooling : Interrogations de Grbl a interval regulier selon la sequence definie par self.__querySequence
-      if self.__pooling:
-        if (time.time() - self.__lastQueryTime) * 1000 > GRBL_QUERY_DELAY and self.__initOK:
-          if len(self.__querySequence[self.__queryCounter]) == 1:
-            self.realTimePush(self.__querySequence[self.__queryCounter])
-          else:
-            if self.__grblStatus == GRBL_STATUS_IDLE:
-              self.gcodeInsert(self.__querySequence[self.__queryCounter], COM_FLAG_NO_OK | COM_FLAG_NO_ERROR)
-          self.__lastQueryTime    = time.time()
-          self.__queryCounter += 1
-          if self.__queryCounter >= len(self.__querySequence):
-            self.__queryCounter = 0
+      # Interrogation de Grbl si c'est le moment
+      self.__pollGrbl()
+      # Prise en compte des commandes deposees par les autres threads
+      for seq, op, item, flag, stamp, index in self.__commands.apply(self.__stack):
+        if op == COM_OP_RESET:
+          self.__sendData(REAL_TIME_SOFT_RESET)
+      # On commence par vider la file d'attente des commandes temps reel
+      while not self.__stack.isEmpty(STACK_LANE_REALTIME):
+        toSend, flag, tEnqueue, index = self.__stack.pop(STACK_LANE_REALTIME)
+        self.__sendData(toSend)
+      # Lecture des reponses de Grbl
+      self.__readLines()
+      # Envoi des lignes gcode en attente selon la place disponible chez Grbl
+      self.__sendGCode()
+      # Mode batch : envoi groupe des signaux du tour de boucle
+      self.__flushEvents()
 
     # On est sorti de la boucle principale : fermeture du port.
     self.sig_log.emit(logSeverity.info.value, self.tr("grblComSerial.__mainLoop(): Closing serial port."))
     self.sig_connect.emit(False)
+    try:
+      self.__comPort.cancel_read() # Debloque le thread de lecture
+    except (AttributeError, serial.SerialException):
+      pass
+    self.__readerThread.join(SERIAL_READ_TIMEOUT / 1000)
     self.__comPort.close()
     self.__initOK = False
     # Emission du signal de fin
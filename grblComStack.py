@@ -21,52 +21,115 @@
 '                                                                         '
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 
+
+import time
+from collections import deque
 from PyQt6.QtCore import QObject, QThread, QEventLoop, pyqtSignal, pyqtSlot
 from cn5X_config import *
 
+''' Voies de priorite de la pile, de la plus prioritaire a la moins prioritaire '''
+STACK_LANE_REALTIME = 0 # Commandes temps reel (?, !, ~, overrides...)
+STACK_LANE_URGENT   = 1 # Commandes inserees devant le flux GCode (gcodeInsert())
+STACK_LANE_NORMAL   = 2 # Flux GCode normal (programme)
+
 class grblStack():
   '''
   Gestionnaire de file d'attente du port serie.
-  Stocke des couples (CommandeGrbl, flag), soit en mode FiFo (addFiFo()), soit en mode LiFo (addLiFo())
-  et les renvoie dans l'ordre choisi avec la fonction pop().
+  Stocke des quadruplets (CommandeGrbl, flag, horodatage du depot, index de la ligne source) dans 3 voies de priorite (temps reel, insertions
+  urgentes et flux normal), soit en mode FiFo (addFiFo()), soit en mode LiFo (addLiFo())
+  et les renvoie avec la fonction pop() en commencant par la voie la plus prioritaire.
+  Chaque voie est une deque : ajout, retrait et comptage en temps constant.
   '''
 
   def __init__(self):
-    self.__data = []
+    self.__lanes = [deque(), deque(), deque()]
 
-  def isEmpty(self):
-    return len(self.__data) == 0
+  def __lane(self, lane):
+    ''' Renvoie la voie demandee ou, si lane est None, la voie non vide la plus prioritaire '''
+    if lane is not None:
+      return self.__lanes[lane]
+    for data in self.__lanes:
+      if data:
+        return data
+    return self.__lanes[STACK_LANE_NORMAL]
 
-  def count(self):
-    return len(self.__data)
+  def isEmpty(self, lane = None):
+    return self.count(lane) == 0
+
+  def count(self, lane = None):
+    if lane is None:
+      return len(self.__lanes[0]) + len(self.__lanes[1]) + len(self.__lanes[2])
+    else:
+      return len(self.__lanes[lane])
 
-  def addFiFo(self, item, flag = COM_FLAG_NO_FLAG):
-    ''' Ajoute un element en mode FiFO, l'element ajoute sera le dernier a sortir
+  def addFiFo(self, item, flag = COM_FLAG_NO_FLAG, lane = STACK_LANE_NORMAL, stamp = None, index = COM_NO_LINE_INDEX):
+    ''' Ajoute un element en mode FiFO, l'element ajoute sera le dernier a sortir de sa voie
     '''
-    self.__data.append((item, flag))
+    self.__lanes[lane].append((item, flag, stamp, index))
 
-  def addLiFo(self, item, flag = COM_FLAG_NO_FLAG):
-    ''' Ajoute un element en mode LiFO, l'element ajoute sera le premier a sortir
+  def addLiFo(self, item, flag = COM_FLAG_NO_FLAG, lane = STACK_LANE_URGENT, stamp = None, index = COM_NO_LINE_INDEX):
+    ''' Ajoute un element en mode LiFO, l'element ajoute sera le premier a sortir de sa voie
+        (par defaut, la voie des insertions urgentes qui passe devant le flux normal)
     '''
-    self.__data.insert(0, (item, flag))
+    self.__lanes[lane].appendleft((item, flag, stamp, index))
 
-  def next(self):
-    ''' Renvoie le prochain element de la Queue sans depiler (le supprimer) ou None si la liste est vide.
+  def next(self, lane = None):
+    ''' Renvoie le prochain element de la voie (par defaut, de la voie la plus prioritaire)
+        sans depiler (le supprimer) ou None si la voie est vide.
     '''
-    if len(self.__data) > 0:
-      return self.__data[0]
+    data = self.__lane(lane)
+    if len(data) > 0:
+      return data[0]
     else:
       return None
 
-  def pop(self):
-    ''' Depile et renvoie le premier element de la liste ou None si la liste est vide.
+  def pop(self, lane = None):
+    ''' Depile et renvoie le premier element de la voie (par defaut, de la voie la plus
+        prioritaire) ou None si la voie est vide.
     '''
-    if len(self.__data) > 0:
-      return self.__data.pop(0)
+    data = self.__lane(lane)
+    if len(data) > 0:
+      return data.popleft()
     else:
       return None
 
-  def clear(self):
-    ''' Vide toute la pile
+  def clear(self, lane = None):
+    ''' Vide toute la pile ou une seule voie
     '''
-    self.__data.clear()
+    if lane is None:
+      for data in self.__lanes:
+        data.clear()
+    else:
+      self.__lanes[lane].clear()
+
+
+if __name__ == '__main__':
+  # Micro-benchmark : le cout unitaire des operations doit rester le meme
+  # quel que soit le nombre de lignes en file d'attente.
+  for n in [10000, 100000, 1000000]:
+    lignes = ["G1 X{} Y{}".format(i, i) for i in range(n)]
+    pile = grblStack()
+    t0 = time.perf_counter()
+    for l in lignes:
+      pile.addFiFo(l)
+    tFifo = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for i in range(1000):
+      pile.addLiFo(CMD_GRBL_GET_GCODE_STATE, COM_FLAG_NO_OK)
+      pile.addFiFo(REAL_TIME_REPORT_QUERY, COM_FLAG_NO_OK, STACK_LANE_REALTIME)
+    tInsert = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for i in range(1000):
+      pile.count()
+    tCount = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    while not pile.isEmpty():
+      pile.pop()
+    tPop = time.perf_counter() - t0
+    for l in lignes:
+      pile.addFiFo(l)
+    t0 = time.perf_counter()
+    pile.clear()
+    tClear = time.perf_counter() - t0
+    print("{:>8} lines: addFiFo {:4.0f} ns, addLiFo/realtime {:4.0f} ns, count {:4.0f} ns, pop {:4.0f} ns, clear {:8.1f} us".format(
+      n, 1e9 * tFifo / n, 1e9 * tInsert / 2000, 1e9 * tCount / 1000, 1e9 * tPop / (n + 2000), 1e6 * tClear))
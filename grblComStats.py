@@ -0,0 +1,230 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import time, threading, bisect, csv
+from collections import deque
+from cn5X_config import *
+
+''' Bornes superieures (ms) des classes des histogrammes, la derniere classe est ouverte '''
+STATS_BUCKETS_MS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+STATS_WINDOW     = 2000 # Nombre d'echantillons conserves par histogramme glissant
+STATS_RATE_WINDOW = 5   # secondes, fenetre de calcul des debits
+
+''' Mesures suivies '''
+STATS_QUEUE_WAIT  = "queue_wait"      # Depot dans la file (gcodePush()...) -> ecriture sur le port
+STATS_ACK_LATENCY = "ack_latency"     # Ecriture sur le port -> ok ou error de Grbl
+STATS_STATUS      = "status_interval" # Intervalle entre 2 status reports
+STATS_PLANNER     = "planner_free"    # Blocs libres dans le planner de Grbl (champ Bf: des status)
+STATS_HISTOGRAMS  = [STATS_QUEUE_WAIT, STATS_ACK_LATENCY, STATS_STATUS, STATS_PLANNER]
+
+STATS_BYTES_OUT = "bytes_out"  # Octets envoyes par seconde
+STATS_BYTES_IN  = "bytes_in"   # Octets recus par seconde
+STATS_LINES     = "lines"      # Lignes acquittees (ok ou error) par seconde
+STATS_RATES     = [STATS_BYTES_OUT, STATS_BYTES_IN, STATS_LINES]
+
+
+class grblComHistogram():
+  '''
+  Histogramme glissant : conserve les STATS_WINDOW derniers echantillons et tient a jour
+  le nombre d'echantillons de chaque classe de STATS_BUCKETS_MS au fil des ajouts.
+  '''
+
+  def __init__(self, window: int = STATS_WINDOW):
+    self.__samples = deque()
+    self.__window  = window
+    self.__counts  = [0] * (len(STATS_BUCKETS_MS) + 1)
+    self.__total   = 0 # Nombre d'echantillons depuis la creation ou la remise a zero
+
+  def add(self, value: float):
+    if len(self.__samples) >= self.__window:
+      ancien = self.__samples.popleft()
+      self.__counts[bisect.bisect_left(STATS_BUCKETS_MS, ancien)] -= 1
+    self.__samples.append(value)
+    self.__counts[bisect.bisect_left(STATS_BUCKETS_MS, value)] += 1
+    self.__total += 1
+
+  def clear(self):
+    self.__samples.clear()
+    self.__counts = [0] * (len(STATS_BUCKETS_MS) + 1)
+    self.__total  = 0
+
+  def counts(self):
+    ''' Nombre d'echantillons de la fenetre dans chaque classe '''
+    return list(self.__counts)
+
+  def summary(self):
+    ''' Renvoie (total, nombre dans la fenetre, moyenne, mediane, 95e percentile, maxi) de la fenetre glissante '''
+    n = len(self.__samples)
+    if n == 0:
+      return (self.__total, 0, 0.0, 0.0, 0.0, 0.0)
+    tri = sorted(self.__samples)
+    return (self.__total, n, sum(tri) / n, tri[n // 2], tri[min(n - 1, (95 * n) // 100)], tri[-1])
+
+
+class grblComRate():
+  ''' Debit glissant : cumul par seconde sur les STATS_RATE_WINDOW dernieres secondes '''
+
+  def __init__(self, window: int = STATS_RATE_WINDOW):
+    self.__window = window
+    self.__bins   = deque() # [seconde, cumul]
+    self.__total  = 0
+
+  def add(self, value: int, t: float):
+    seconde = int(t)
+    if len(self.__bins) > 0 and self.__bins[-1][0] == seconde:
+      self.__bins[-1][1] += value
+    else:
+      self.__bins.append([seconde, value])
+      while self.__bins[0][0] <= seconde - self.__window:
+        self.__bins.popleft()
+    self.__total += value
+
+  def clear(self):
+    self.__bins.clear()
+    self.__total = 0
+
+  def rate(self, t: float):
+    ''' Moyenne par seconde sur les secondes completes de la fenetre '''
+    seconde = int(t)
+    if len(self.__bins) == 0:
+      return 0.0
+    duree = min(self.__window, seconde - self.__bins[0][0]) # Debut de la mesure plus recent que la fenetre
+    if duree <= 0:
+      return 0.0
+    cumul = sum(v for s, v in self.__bins if seconde - duree <= s < seconde)
+    return cumul / duree
+
+  def total(self):
+    return self.__total
+
+
+class grblComStats():
+  '''
+  Instrumentation de la communication avec Grbl : histogrammes glissants du temps
+  d'attente des lignes dans la file, de la latence ecriture -> acquittement, de
+  l'intervalle entre status reports et du remplissage du planner, et debits en
+  octets/s et lignes/s. Alimentee par le thread de communication (grblComSerial),
+  lue par l'interface (onglet Diagnostics) : tous les acces passent par un verrou.
+  Les horodatages sont ceux de time.perf_counter() (secondes).
+  '''
+
+  def __init__(self):
+    self.__lock       = threading.Lock()
+    self.__histograms = {nom: grblComHistogram() for nom in STATS_HISTOGRAMS}
+    self.__rates      = {nom: grblComRate() for nom in STATS_RATES}
+    self.__lastStatus = None
+    self.__startTime  = time.perf_counter()
+
+  def clear(self):
+    with self.__lock:
+      for h in self.__histograms.values():
+        h.clear()
+      for r in self.__rates.values():
+        r.clear()
+      self.__lastStatus = None
+      self.__startTime  = time.perf_counter()
+
+  def lineSent(self, tEnqueue: float, tWrite: float):
+    ''' Une ligne deposee a tEnqueue vient d'etre ecrite sur le port a tWrite '''
+    with self.__lock:
+      self.__histograms[STATS_QUEUE_WAIT].add((tWrite - tEnqueue) * 1000)
+
+  def dataSent(self, t: float, nbOctets: int):
+    with self.__lock:
+      self.__rates[STATS_BYTES_OUT].add(nbOctets, t)
+
+  def lineAcked(self, tWrite: float, tAck: float):
+    ''' Reception du ok ou error de la ligne ecrite a tWrite '''
+    with self.__lock:
+      self.__histograms[STATS_ACK_LATENCY].add((tAck - tWrite) * 1000)
+      self.__rates[STATS_LINES].add(1, tAck)
+
+  def dataReceived(self, t: float, nbOctets: int):
+    with self.__lock:
+      self.__rates[STATS_BYTES_IN].add(nbOctets, t)
+
+  def statusReceived(self, t: float, status: str):
+    ''' Reception d'un status report : intervalle depuis le precedent et blocs libres du planner (Bf:) '''
+    with self.__lock:
+      if self.__lastStatus is not None:
+        self.__histograms[STATS_STATUS].add((t - self.__lastStatus) * 1000)
+      self.__lastStatus = t
+      debut = status.find("|Bf:")
+      if debut >= 0:
+        fin = status.find(",", debut)
+        try:
+          self.__histograms[STATS_PLANNER].add(int(status[debut + 4:fin]))
+        except ValueError:
+          pass
+
+  def snapshot(self):
+    '''
+    Renvoie l'etat courant : {"histograms": {nom: (resume, classes)}, "rates": {nom: (par seconde, total)}, "uptime": secondes}
+    '''
+    t = time.perf_counter()
+    with self.__lock:
+      return {
+        "histograms": {nom: (h.summary(), h.counts()) for nom, h in self.__histograms.items()},
+        "rates": {nom: (r.rate(t), r.total()) for nom, r in self.__rates.items()},
+        "uptime": t - self.__startTime
+      }
+
+  def report(self):
+    ''' Rapport texte de l'etat courant (onglet Diagnostics) '''
+    etat = self.snapshot()
+    lignes = ["{:<16} {:>8} {:>10} {:>10} {:>10} {:>10}".format("", "samples", "mean", "p50", "p95", "max")]
+    for nom in STATS_HISTOGRAMS:
+      (total, n, moyenne, p50, p95, maxi), classes = etat["histograms"][nom]
+      unite = "" if nom == STATS_PLANNER else " ms"
+      lignes.append("{:<16} {:>8} {:>10} {:>10} {:>10} {:>10}".format(nom, total,
+        "{:.2f}{}".format(moyenne, unite), "{:.2f}{}".format(p50, unite), "{:.2f}{}".format(p95, unite), "{:.2f}{}".format(maxi, unite)))
+    lignes.append("")
+    for nom in STATS_RATES:
+      parSeconde, total = etat["rates"][nom]
+      lignes.append("{:<16} {:>10.1f} /s {:>12} total".format(nom, parSeconde, total))
+    lignes.append("")
+    lignes.append("{:<16} {}".format("ms <=", " ".join(["{:>6g}".format(b) for b in STATS_BUCKETS_MS] + ["   inf"])))
+    for nom in [STATS_QUEUE_WAIT, STATS_ACK_LATENCY, STATS_STATUS]:
+      classes = etat["histograms"][nom][1]
+      lignes.append("{:<16} {}".format(nom, " ".join(["{:>6}".format(c) for c in classes])))
+    return "\n".join(lignes)
+
+  def toCsv(self, fileName: str):
+    ''' Export CSV : resume des histogrammes, debits puis detail des classes '''
+    etat = self.snapshot()
+    with open(fileName, "w", newline="") as f:
+      ecrivain = csv.writer(f)
+      ecrivain.writerow(["metric", "samples", "window", "mean", "p50", "p95", "max"])
+      for nom in STATS_HISTOGRAMS:
+        resume = etat["histograms"][nom][0]
+        ecrivain.writerow([nom] + [resume[0], resume[1]] + ["{:.4f}".format(v) for v in resume[2:]])
+      ecrivain.writerow([])
+      ecrivain.writerow(["metric", "per_second", "total"])
+      for nom in STATS_RATES:
+        parSeconde, total = etat["rates"][nom]
+        ecrivain.writerow([nom, "{:.2f}".format(parSeconde), total])
+      ecrivain.writerow([])
+      ecrivain.writerow(["metric", "upper_bound", "count"])
+      for nom in STATS_HISTOGRAMS:
+        for borne, nombre in zip(STATS_BUCKETS_MS + ["inf"], etat["histograms"][nom][1]):
+          ecrivain.writerow([nom, borne, nombre])
@@ -0,0 +1,326 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import time, socket, select
+import serial
+from cn5X_config import *
+
+''' Prefixes des adresses reseau acceptees a la place d'un nom de port serie (TCP brut uniquement, pas de protocole telnet) '''
+NETWORK_PORT_PREFIXES = ["tcp://", "socket://"]
+''' Prefixe du simulateur de Grbl integre (cf. grblSimulator.py) '''
+SIMULATOR_PORT_PREFIX = "sim://"
+''' Prefixe du rejeu d'une session enregistree (cf. grblComRecorder.py) '''
+REPLAY_PORT_PREFIX    = "replay://"
+
+
+def isNetworkPort(portName: str):
+  ''' Renvoie True si portName designe une adresse reseau (tcp://hote:port) et non un port serie '''
+  for prefix in NETWORK_PORT_PREFIXES:
+    if portName[:len(prefix)].lower() == prefix:
+      return True
+  return False
+
+
+def isSimulatorPort(portName: str):
+  ''' Renvoie True si portName designe le simulateur de Grbl integre (sim://grbl ou sim://mega5x) '''
+  return portName[:len(SIMULATOR_PORT_PREFIX)].lower() == SIMULATOR_PORT_PREFIX
+
+
+def isReplayPort(portName: str):
+  ''' Renvoie True si portName designe le rejeu d'une session enregistree (replay:///chemin/session.cn5xrec) '''
+  return portName[:len(REPLAY_PORT_PREFIX)].lower() == REPLAY_PORT_PREFIX
+
+
+def grblTransportFor(portName: str, baudRate: int):
+  ''' Renvoie le transport adapte au nom de port : simulateur (sim://), rejeu (replay://), reseau (tcp://hote:port) ou serie '''
+  if isSimulatorPort(portName):
+    from grblSimulator import grblTransportSimulator # Import local, grblSimulator depend de ce module
+    return grblTransportSimulator(portName)
+  elif isReplayPort(portName):
+    from grblComRecorder import grblTransportReplay # Import local, grblComRecorder depend de ce module
+    return grblTransportReplay(portName)
+  elif isNetworkPort(portName):
+    return grblTransportTCP(portName)
+  else:
+    return grblTransportSerial(portName, baudRate)
+
+
+class grblTransport():
+  '''
+  Interface commune des moyens de communication avec Grbl utilises par grblComSerial.
+  Reprend le sous-ensemble de l'API de pyserial utilise par cn5X++ ; les erreurs
+  d'entree/sortie sont remontees sous forme de serial.SerialException quel que soit
+  le transport, comme le fait pyserial pour ses propres URL reseau.
+  Comme pour pyserial, timeout et write_timeout sont en secondes (None = sans limite).
+  '''
+
+  def __init__(self, portName: str):
+    self.port          = portName
+    self.timeout       = SERIAL_READ_TIMEOUT / 1000 # secondes
+    self.write_timeout = None                      # secondes
+
+  def open(self):
+    ''' Ouvre la communication, leve serial.SerialException ou ValueError en cas d'echec '''
+    raise NotImplementedError
+
+  def close(self):
+    raise NotImplementedError
+
+  @property
+  def in_waiting(self):
+    ''' Nombre d'octets recus non encore lus (0 si rien n'est disponible) '''
+    raise NotImplementedError
+
+  def readline(self):
+    ''' Lit une ligne complete (ou ce qui a ete recu avant l'expiration de self.timeout) '''
+    raise NotImplementedError
+
+  def readChunk(self):
+    '''
+    Attend que des donnees soient disponibles (au plus self.timeout secondes) et renvoie
+    en une fois tout ce qui a ete recu, b'' sur timeout ou apres cancel_read().
+    '''
+    raise NotImplementedError
+
+  def write(self, data: bytes):
+    raise NotImplementedError
+
+  def cancel_read(self):
+    ''' Debloque un readChunk() en cours dans un autre thread '''
+    raise NotImplementedError
+
+
+class grblTransportSerial(grblTransport):
+  ''' Port serie local (USB, UART) via pyserial '''
+
+  def __init__(self, portName: str, baudRate: int):
+    super().__init__(portName)
+    self.__comPort = serial.Serial()
+    com_settings = {
+      'baudrate':           baudRate,
+      'bytesize':           serial.EIGHTBITS,
+      'parity':             serial.PARITY_NONE,
+      'stopbits':           serial.STOPBITS_ONE,
+      'xonxoff':            False,
+      'dsrdtr':             False,
+      'rtscts':             False,
+      'timeout':            self.timeout,
+      'write_timeout':      None,
+      'inter_byte_timeout': None
+      }
+    self.__comPort.apply_settings(com_settings)
+    self.__comPort.port = portName
+
+  def open(self):
+    self.__comPort.open()
+
+  def close(self):
+    self.__comPort.close()
+
+  @property
+  def in_waiting(self):
+    return self.__comPort.in_waiting
+
+  def readline(self):
+    return self.__comPort.readline()
+
+  def readChunk(self):
+    return self.__comPort.read(self.__comPort.in_waiting or 1)
+
+  def write(self, data: bytes):
+    self.__comPort.write_timeout = self.write_timeout
+    return self.__comPort.write(data)
+
+  def cancel_read(self):
+    self.__comPort.cancel_read()
+
+
+class grblTransportTCP(grblTransport):
+  '''
+  Connexion TCP directe (ponts ESP32 Grbl, grblHAL Ethernet...), adresse de la forme
+  tcp://hote:port, sans passer par un pty et socat. Les octets passent tels quels : pas de
+  negociation telnet (IAC), le pont doit etre en mode TCP brut (raw).
+  '''
+
+  def __init__(self, portName: str):
+    super().__init__(portName)
+    adresse = portName.split("://", 1)[1].strip("/")
+    if adresse[:1] == "[": # IPv6 : [::1]:23
+      host, _, port = adresse[1:].partition("]:")
+    else:
+      host, _, port = adresse.rpartition(":")
+    self.__host    = host
+    self.__port    = port
+    self.__socket  = None
+    self.__buffer  = bytearray() # Octets recus mais pas encore lus (readline())
+    self.__cancelR, self.__cancelW = None, None
+
+  def open(self):
+    if self.__host == "" or not self.__port.isdigit():
+      raise ValueError("invalid network address, expected tcp://host:port: {}".format(self.port))
+    try:
+      self.__socket = socket.create_connection((self.__host, int(self.__port)), timeout=CONNECT_TIMEOUT / 1000)
+    except OSError as err:
+      raise serial.SerialException("could not open {}: {}".format(self.port, err))
+    self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Pas d'attente pour les petites trames
+    self.__socket.setblocking(False)
+    self.__cancelR, self.__cancelW = socket.socketpair()
+
+  def close(self):
+    for s in [self.__socket, self.__cancelR, self.__cancelW]:
+      if s is not None:
+        s.close()
+    self.__socket = None
+    self.__cancelR, self.__cancelW = None, None
+
+  def __wait(self, timeout):
+    ''' Attend des donnees sur la socket, renvoie False sur timeout ou cancel_read() '''
+    if self.__socket is None:
+      raise serial.SerialException("{} is not open".format(self.port))
+    ready, _, _ = select.select([self.__socket, self.__cancelR], [], [], timeout)
+    if self.__cancelR in ready:
+      self.__cancelR.recv(64)
+      return False
+    return self.__socket in ready
+
+  def __recv(self):
+    ''' Ajoute au buffer tout ce que la socket a recu '''
+    try:
+      data = self.__socket.recv(65536)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError as err:
+      raise serial.SerialException("read failed on {}: {}".format(self.port, err))
+    if len(data) == 0:
+      raise serial.SerialException("connection closed by {}".format(self.port))
+    self.__buffer += data
+
+  @property
+  def in_waiting(self):
+    if len(self.__buffer) == 0 and self.__wait(0):
+      self.__recv()
+    return len(self.__buffer)
+
+  def readline(self):
+    limite = time.time() + self.timeout
+    while b'\n' not in self.__buffer:
+      reste = limite - time.time()
+      if reste <= 0 or not self.__wait(reste):
+        break
+      self.__recv()
+    fin = self.__buffer.find(b'\n') + 1
+    if fin == 0:
+      fin = len(self.__buffer)
+    data = bytes(self.__buffer[:fin])
+    del self.__buffer[:fin]
+    return data
+
+  def readChunk(self):
+    if len(self.__buffer) == 0:
+      if not self.__wait(self.timeout):
+        return b''
+      self.__recv()
+    data = bytes(self.__buffer)
+    del self.__buffer[:]
+    return data
+
+  def write(self, data: bytes):
+    if self.__socket is None:
+      raise serial.SerialException("{} is not open".format(self.port))
+    vue = memoryview(data)
+    limite = None if self.write_timeout is None else time.time() + self.write_timeout
+    while len(vue) > 0:
+      reste = None if limite is None else max(limite - time.time(), 0)
+      _, ready, _ = select.select([], [self.__socket], [], reste)
+      if not ready:
+        raise serial.SerialTimeoutException("write timeout on {}".format(self.port))
+      try:
+        envoye = self.__socket.send(vue)
+      except (BlockingIOError, InterruptedError):
+        continue
+      except OSError as err:
+        raise serial.SerialException("write failed on {}: {}".format(self.port, err))
+      vue = vue[envoye:]
+    return len(data)
+
+  def cancel_read(self):
+    if self.__cancelW is not None:
+      self.__cancelW.send(b'x')
+
+
+if __name__ == '__main__':
+  # Test de bout en bout sur la boucle locale : un serveur TCP repond "ok" a chaque
+  # ligne et un status report a chaque '?', le client mesure le debit et la latence.
+  import threading
+  serveur = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  serveur.bind(("127.0.0.1", 0))
+  serveur.listen(1)
+  adresse = "tcp://127.0.0.1:{}".format(serveur.getsockname()[1])
+
+  def grblEcho():
+    conn, _ = serveur.accept()
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    conn.sendall(b"\r\nGrbl 1.1h ['$' for help]\r\n")
+    recu = b''
+    while True:
+      data = conn.recv(4096)
+      if len(data) == 0:
+        break
+      recu += data
+      while len(recu) > 0:
+        if recu[:1] == b'?':
+          conn.sendall(b"<Idle|MPos:0.000,0.000,0.000|FS:0,0>\r\n")
+          recu = recu[1:]
+        elif b'\n' in recu:
+          ligne, _, recu = recu.partition(b'\n')
+          conn.sendall(b"ok\r\n")
+        else:
+          break
+    conn.close()
+
+  threading.Thread(target=grblEcho, daemon=True).start()
+  t = grblTransportFor(adresse, COM_DEFAULT_BAUD_RATE)
+  t.open()
+  print("Connected to {} ({})".format(adresse, type(t).__name__))
+  print("Init: {}".format(t.readline().strip() or t.readline().strip()))
+  nbLignes = 2000
+  t0 = time.perf_counter()
+  for i in range(nbLignes):
+    t.write("G1 X{} Y{}\n".format(i, i).encode('ascii'))
+    reponse = t.readline()
+    assert reponse == b"ok\r\n", reponse
+  duree = time.perf_counter() - t0
+  print("Ping-pong: {} lines in {:.3f} s, {:.0f} us round trip".format(nbLignes, duree, 1e6 * duree / nbLignes))
+  t.write(b'?')
+  print("Status: {}".format(t.readline().strip()))
+  # cancel_read() doit debloquer un readChunk() en attente
+  lecture = []
+  lecteur = threading.Thread(target=lambda: lecture.append(t.readChunk()))
+  t.timeout = 10
+  lecteur.start()
+  time.sleep(0.1)
+  t0 = time.perf_counter()
+  t.cancel_read()
+  lecteur.join()
+  print("cancel_read() released readChunk() in {:.1f} ms, returned {}".format(1000 * (time.perf_counter() - t0), lecture[0]))
+  t.close()
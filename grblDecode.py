@@ -863,6 +863,18 @@ class grblDecode(QObject):
       return self.__G5x[30]
 
 
+  def getG5x(self, num: int, axis=None):
+    ''' Offsets du repere G54 a G59 (num = 54...59) lus par $# '''
+    if axis is not None:
+      if axis in self.__axisNames:
+        return self.__G5x[num][self.__axisNames.index(axis)]
+      elif isinstance(axis, int):
+        if axis >= 0 and axis < self.__nbAxis:
+          return self.__G5x[num][axis]
+    else:
+      return self.__G5x[num]
+
+
   def getDistanceMode(self):
     return self.__distanceMode
 
@@ -0,0 +1,1109 @@
+# -*- coding: UTF-8 -*-
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+'                                                                         '
+' Copyright 2018-2024 Gauthier Brière (gauthier.briere "at" gmail.com)    '
+'                                                                         '
+' This file is part of cn5X++                                             '
+'                                                                         '
+' cn5X++ is free software: you can redistribute it and/or modify it       '
+'  under the terms of the GNU General Public License as published by      '
+' the Free Software Foundation, either version 3 of the License, or       '
+' (at your option) any later version.                                     '
+'                                                                         '
+' cn5X++ is distributed in the hope that it will be useful, but           '
+' WITHOUT ANY WARRANTY; without even the implied warranty of              '
+' MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the           '
+' GNU General Public License for more details.                            '
+'                                                                         '
+' You should have received a copy of the GNU General Public License       '
+' along with this program.  If not, see <http://www.gnu.org/licenses/>.   '
+'                                                                         '
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import sys, os, time, threading, math, re
+from collections import deque
+from cn5X_config import *
+from grblComTransport import grblTransport
+
+''' Firmwares simules '''
+SIM_GRBL_1_1    = "grbl"   # Grbl 1.1h original, 3 axes (Arduino Uno)
+SIM_GRBL_MEGA5X = "mega5x" # grbl-Mega-5X, 5 axes (Arduino Mega 2560)
+
+SIM_FLAVOURS = {
+  # axes, taille du planner (blocs), du buffer de reception et d'une ligne, options de compilation
+  SIM_GRBL_1_1:    {"axes": "XYZ",   "planner": 15, "rx": 128, "line": 80,  "options": "V",  "axs": False},
+  SIM_GRBL_MEGA5X: {"axes": "XYZAB", "planner": 35, "rx": 255, "line": 256, "options": "VL", "axs": True},
+}
+SIM_VERSION    = "1.1h"
+SIM_BUILD_DATE = "20190825"
+SIM_HOMING_TIME = 1.0 # secondes (simulees) pour un cycle de homing
+
+''' Reglages par defaut ($$, avec $10=3 pour avoir le champ Bf: des status), les autres reglages sont generes par axe ($100+i...) '''
+SIM_DEFAULT_SETTINGS = {
+  0: 10, 1: 25, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0, 10: 3, 11: 0.010, 12: 0.002, 13: 0,
+  20: 0, 21: 0, 22: 0, 23: 0, 24: 25.0, 25: 500.0, 26: 250, 27: 1.0, 30: 1000, 31: 0, 32: 0
+}
+SIM_FLOAT_SETTINGS = [11, 12, 24, 25, 27]
+
+''' Groupes modaux G (valeurs multipliees par 10 : G38.2 => 382) et M '''
+SIM_G_MOTION   = [0, 10, 20, 30, 382, 383, 384, 385, 800]
+SIM_G_NONMODAL = [40, 100, 280, 281, 300, 301, 530, 920, 921]
+SIM_G_GROUPS   = [SIM_G_MOTION, SIM_G_NONMODAL, [170, 180, 190], [900, 910], [911], [930, 940], [200, 210], [400], [431, 490], [540, 550, 560, 570, 580, 590], [610]]
+SIM_M_GROUPS   = [[0, 1, 2, 30], [3, 4, 5], [7, 8, 9]]
+
+''' Caracteres realtime de Grbl 1.1 '''
+SIM_REALTIME = [0x18, ord('?'), ord('~'), ord('!')] + list(range(0x80, 0x100))
+
+SIM_WORD_RE = re.compile(r'([^0-9.+-])([+-]?[0-9]*\.?[0-9]*)')
+
+
+class grblSimulator():
+  '''
+  Simulateur de Grbl 1.1 / grbl-Mega-5X : protocole serie (ok, error:X, ALARM:X, status reports,
+  commandes $, commandes temps reel et overrides), etat modal GCode, parametres ($#) et
+  modele simplifie du buffer de reception et du planner (les mouvements durent distance / vitesse,
+  sans acceleration, multiplie par timeScale ; timeScale = 0 => execution instantanee).
+  Les octets recus par write() sont traites par un thread interne, les reponses sont lues
+  par read() / readline().
+  '''
+
+  def __init__(self, flavour: str = SIM_GRBL_MEGA5X, timeScale: float = 1.0):
+    conf = SIM_FLAVOURS[flavour]
+    self.__flavour     = flavour
+    self.__axisNames   = conf["axes"]
+    self.__nbAxis      = len(self.__axisNames)
+    self.__plannerSize = conf["planner"]
+    self.__rxSize      = conf["rx"]
+    self.__lineMax     = conf["line"]
+    self.__options     = conf["options"]
+    self.__reportAxs   = conf["axs"]
+    self.timeScale     = timeScale
+    self.pins          = "" # Etat des entrees pour le champ Pn: du status (ex : "P" pour la sonde)
+    self.rxOverflow    = 0  # Nombre d'octets perdus faute de place dans le buffer de reception
+
+    self.__lock     = threading.Lock()
+    self.__inCond   = threading.Condition(self.__lock) # Reveil du thread de simulation
+    self.__outCond  = threading.Condition(self.__lock) # Reveil des lecteurs
+    self.__rx       = bytearray() # Buffer de reception serie
+    self.__out      = bytearray() # Octets a renvoyer a l'hote
+    self.__cancel   = False
+    self.__running  = False
+    self.__thread   = None
+
+    self.__settings = {}
+    self.__restoreSettings()
+    self.__startup  = ["", ""]                                  # $N0, $N1
+    self.__coord    = {n: [0.0] * self.__nbAxis for n in [28, 30, 54, 55, 56, 57, 58, 59]}
+    self.__prb      = ([0.0] * self.__nbAxis, 0)
+    self.__mpos     = [0.0] * self.__nbAxis
+    self.__checkMode = False
+    self.__reset(boot = True)
+
+
+  ''' Interface cote hote '''
+
+  def start(self):
+    ''' Demarre le thread de simulation (mise sous tension de la carte) '''
+    with self.__lock:
+      self.__running = True
+      self.__bootMessages()
+    self.__thread = threading.Thread(target=self.__run, name="grblSimulator", daemon=True)
+    self.__thread.start()
+
+
+  def stop(self):
+    with self.__lock:
+      self.__running = False
+      self.__inCond.notify_all()
+      self.__outCond.notify_all()
+    if self.__thread is not None:
+      self.__thread.join()
+
+
+  def write(self, data: bytes):
+    ''' Octets envoyes par l'hote : commandes temps reel traitees immediatement, le reste va dans le buffer de reception '''
+    with self.__lock:
+      for c in data:
+        if c in SIM_REALTIME:
+          self.__realtime(c)
+        elif len(self.__rx) < self.__rxSize:
+          self.__rx.append(c)
+        else:
+          self.rxOverflow += 1
+      self.__inCond.notify()
+    return len(data)
+
+
+  def outWaiting(self):
+    ''' Nombre d'octets prets a etre lus '''
+    return len(self.__out)
+
+
+  def read(self, timeout = None):
+    ''' Attend (au plus timeout secondes) et renvoie toutes les donnees emises par Grbl, b'' sur timeout ou cancelRead() '''
+    with self.__lock:
+      if len(self.__out) == 0 and not self.__cancel:
+        self.__outCond.wait(timeout)
+      self.__cancel = False
+      data = bytes(self.__out)
+      del self.__out[:]
+      return data
+
+
+  def readline(self, timeout = None):
+    ''' Renvoie la prochaine ligne complete emise par Grbl (ou ce qui est arrive avant le timeout) '''
+    limite = None if timeout is None else time.monotonic() + timeout
+    with self.__lock:
+      while b'\n' not in self.__out and self.__running:
+        reste = None if limite is None else limite - time.monotonic()
+        if reste is not None and reste <= 0:
+          break
+        self.__outCond.wait(reste)
+      fin = self.__out.find(b'\n') + 1
+      if fin == 0:
+        fin = len(self.__out)
+      data = bytes(self.__out[:fin])
+      del self.__out[:fin]
+      return data
+
+
+  def cancelRead(self):
+    ''' Debloque un read() en attente dans un autre thread '''
+    with self.__lock:
+      self.__cancel = True
+      self.__outCond.notify_all()
+
+
+  ''' Fonctionnement interne (toujours appele avec self.__lock pris) '''
+
+  def __send(self, ligne: str):
+    self.__out += (ligne + "\r\n").encode('ascii')
+    self.__outCond.notify_all()
+
+
+  def __bootMessages(self):
+    self.__send("")
+    self.__send("Grbl {} ['$' for help]".format(SIM_VERSION))
+    if self.__state == GRBL_STATUS_ALARM:
+      self.__send("[MSG:'$H'|'$X' to unlock]")
+    else:
+      self.__runStartupLines()
+
+
+  def __reset(self, boot = False):
+    ''' Remise a zero de Grbl : a la mise sous tension ou sur soft reset (Ctrl+X) '''
+    perdu = not boot and (len(self.__planner) > 0 or self.__state in [GRBL_STATUS_RUN, GRBL_STATUS_JOG, GRBL_STATUS_HOME])
+    if not boot and self.__state == GRBL_STATUS_ALARM:
+      perdu = True # Une alarme reste active apres un reset
+    if perdu and not boot:
+      self.__mpos = self.__currentPosition()
+    if not boot:
+      del self.__rx[:]
+    self.__planner     = deque() # Blocs (cible, duree simulee (s), vitesse, type, action de fin)
+    self.__blockStart  = list(self.__mpos)
+    self.__blockDone   = 0.0     # Duree simulee deja executee du bloc en cours
+    self.__lastTime    = time.monotonic()
+    self.__waitingLine = None    # Ligne synchrone lue, en attente de planner vide
+    self.__deferredOk  = False   # "ok" a envoyer quand le planner sera vide
+    self.__line        = bytearray()
+    self.__comment     = 0       # 0 : hors commentaire, 1 : entre (), 2 : apres ;
+    self.__overflow    = False
+    self.__hold        = False
+    self.__feedOv, self.__rapidOv, self.__spindleOv = 100, 100, 100
+    self.__wcoCounter, self.__ovCounter = 0, 1
+    self.__modal = {
+      "motion": 0, "plane": 170, "units": 210, "distance": 900, "feedMode": 940,
+      "wcs": 540, "spindle": 5, "coolant": set(), "program": None
+    }
+    self.__tool, self.__feed, self.__speed = 0, 0.0, 0.0
+    self.__g92, self.__tlo = [0.0] * self.__nbAxis, 0.0
+    if perdu:
+      if not boot:
+        self.__send("ALARM:3")
+      self.__state = GRBL_STATUS_ALARM
+    elif boot and self.__settings[22] == 1:
+      self.__state = GRBL_STATUS_ALARM # Homing demande a la mise sous tension
+    else:
+      self.__state = GRBL_STATUS_CHECK if self.__checkMode else GRBL_STATUS_IDLE
+
+
+  def __restoreSettings(self):
+    self.__settings = dict(SIM_DEFAULT_SETTINGS)
+    for i in range(self.__nbAxis):
+      self.__settings[100 + i] = 250.0  # steps/mm
+      self.__settings[110 + i] = 500.0  # vitesse maxi mm/min
+      self.__settings[120 + i] = 10.0   # acceleration mm/s2
+      self.__settings[130 + i] = 200.0  # course maxi mm
+
+
+  def __runStartupLines(self):
+    for ligne in self.__startup:
+      if ligne != "":
+        rc = self.__gcode(ligne)
+        self.__send(">{}:{}".format(ligne, "ok" if rc == 0 else "error:{}".format(rc)))
+
+
+  def __run(self):
+    ''' Thread de simulation : lecture des lignes du buffer de reception et execution du planner '''
+    with self.__lock:
+      while self.__running:
+        self.__advance()
+        self.__processInput()
+        self.__inCond.wait(self.__nextEvent())
+
+
+  def __nextEvent(self):
+    ''' Delai (secondes reelles) avant la fin du bloc en cours, None si rien ne bouge '''
+    if len(self.__planner) == 0 or self.__hold:
+      return None
+    reste = self.__planner[0][1] - self.__blockDone
+    vitesse = self.__speedFactor(self.__planner[0])
+    if vitesse <= 0:
+      return 0
+    return max(reste / vitesse, 0)
+
+
+  def __speedFactor(self, bloc):
+    ''' Secondes simulees ecoulees par seconde reelle pour le bloc (timeScale et overrides) '''
+    if self.timeScale <= 0:
+      return float("inf")
+    if bloc[3] == 'rapid':
+      return self.__rapidOv / 100 / self.timeScale
+    if bloc[3] in ['feed', 'probe']:
+      return self.__feedOv / 100 / self.timeScale
+    return 1 / self.timeScale
+
+
+  def __advance(self):
+    ''' Fait avancer l'execution du planner jusqu'a l'instant present '''
+    now = time.monotonic()
+    dt = now - self.__lastTime
+    self.__lastTime = now
+    if self.__hold:
+      return
+    while len(self.__planner) > 0:
+      bloc = self.__planner[0]
+      vitesse = self.__speedFactor(bloc)
+      reste = bloc[1] - self.__blockDone
+      if vitesse != float("inf") and dt * vitesse < reste:
+        self.__blockDone += dt * vitesse
+        break
+      if vitesse != float("inf"):
+        dt -= reste / vitesse
+      self.__planner.popleft()
+      self.__mpos = list(bloc[0])
+      self.__blockStart = list(self.__mpos)
+      self.__blockDone = 0.0
+      if bloc[4] is not None:
+        bloc[4]()
+    if len(self.__planner) == 0:
+      if self.__state in [GRBL_STATUS_RUN, GRBL_STATUS_JOG, GRBL_STATUS_HOME]:
+        self.__state = GRBL_STATUS_IDLE
+      if self.__deferredOk:
+        self.__deferredOk = False
+        self.__send("ok")
+
+
+  def __currentPosition(self):
+    ''' Position machine courante, interpolee dans le bloc en cours d'execution '''
+    if len(self.__planner) == 0 or self.__planner[0][1] <= 0:
+      return list(self.__mpos)
+    bloc = self.__planner[0]
+    f = min(self.__blockDone / bloc[1], 1.0)
+    return [a + (b - a) * f for a, b in zip(self.__blockStart, bloc[0])]
+
+
+  def __plan(self, cible, duree, vitesse, genre, action = None):
+    ''' Ajoute un bloc au planner et demarre le cycle '''
+    if len(self.__planner) == 0:
+      self.__blockStart = list(self.__mpos)
+      self.__blockDone = 0.0
+      self.__lastTime = time.monotonic()
+    self.__planner.append((list(cible), duree, vitesse, genre, action))
+    if genre == 'jog':
+      self.__state = GRBL_STATUS_JOG
+    elif genre == 'home':
+      self.__state = GRBL_STATUS_HOME
+    elif self.__state == GRBL_STATUS_IDLE:
+      self.__state = GRBL_STATUS_RUN
+
+
+  def __processInput(self):
+    ''' Lecture des caracteres du buffer de reception tant que le planner a de la place '''
+    while self.__state != GRBL_STATUS_SLEEP:
+      if self.__deferredOk:
+        return # Commande synchrone en cours d'execution
+      if self.__waitingLine is not None:
+        if len(self.__planner) > 0:
+          return
+        ligne, self.__waitingLine = self.__waitingLine, None
+        self.__reply(self.__execute(ligne, sync = True))
+        continue
+      if len(self.__planner) >= self.__plannerSize:
+        return # Planner plein : Grbl ne lit plus, le buffer de reception se remplit
+      if len(self.__rx) == 0:
+        return
+      c = self.__rx.pop(0)
+      if c in b'\r\n':
+        ligne = self.__line.decode('ascii', 'replace')
+        self.__line = bytearray()
+        self.__comment = 0
+        if self.__overflow:
+          self.__overflow = False
+          self.__reply(11)
+        elif ligne == "":
+          self.__reply(0)
+        else:
+          self.__reply(self.__execute(ligne))
+      elif self.__comment == 1:
+        if c == ord(')'):
+          self.__comment = 0
+      elif self.__comment == 2 or c <= 0x20:
+        pass
+      elif c == ord('('):
+        self.__comment = 1
+      elif c == ord(';'):
+        self.__comment = 2
+      elif len(self.__line) >= self.__lineMax - 1:
+        self.__overflow = True
+      else:
+        if ord('a') <= c <= ord('z'):
+          c -= 0x20
+        self.__line.append(c)
+
+
+  def __reply(self, rc):
+    ''' Reponse a une ligne : ok, error:X ou rien si la ligne attend le planner '''
+    if rc is None:
+      return
+    if rc == 0:
+      if self.__deferredOk:
+        return # ok envoye a la fin de l'execution
+      self.__send("ok")
+    else:
+      self.__send("error:{}".format(rc))
+
+
+  def __execute(self, ligne: str, sync: bool = False):
+    ''' Execute une ligne complete, renvoie le code d'erreur (0 = ok) ou None si elle attend le planner '''
+    if ligne[0] == '$':
+      return self.__system(ligne)
+    if self.__state == GRBL_STATUS_ALARM:
+      return 9
+    if self.__state == GRBL_STATUS_JOG:
+      return 8
+    if not sync and len(self.__planner) > 0 and self.__needSync(ligne):
+      self.__waitingLine = ligne
+      return None
+    return self.__gcode(ligne)
+
+
+  def __needSync(self, ligne: str):
+    ''' Commandes pour lesquelles Grbl attend la fin des mouvements (protocol_buffer_synchronize()) '''
+    for mot in ["G4", "G10", "G28.1", "G30.1", "G38", "M0", "M1", "M2", "M30", "M3", "M4", "M5", "M7", "M8", "M9"]:
+      i = ligne.find(mot)
+      while i >= 0:
+        fin = i + len(mot)
+        if fin >= len(ligne) or not (ligne[fin].isdigit() or ligne[fin] == '.'):
+          return True
+        i = ligne.find(mot, fin)
+    return False
+
+
+  ''' Commandes realtime '''
+
+  def __realtime(self, c: int):
+    if c == 0x18:
+      self.__reset()
+      self.__bootMessages()
+      self.__inCond.notify()
+    elif c == ord('?'):
+      self.__advance()
+      self.__send(self.__statusReport())
+    elif c == ord('!'):
+      if self.__state == GRBL_STATUS_JOG:
+        self.__jogCancel()
+      elif self.__state in [GRBL_STATUS_RUN, GRBL_STATUS_IDLE] and len(self.__planner) > 0:
+        self.__advance()
+        self.__hold = True
+        self.__state = GRBL_STATUS_HOLD0
+    elif c == ord('~'):
+      if self.__state in [GRBL_STATUS_HOLD0, GRBL_STATUS_HOLD1]:
+        self.__hold = False
+        self.__lastTime = time.monotonic()
+        self.__state = GRBL_STATUS_RUN if len(self.__planner) > 0 else GRBL_STATUS_IDLE
+    elif c == ord(REAL_TIME_JOG_CANCEL):
+      if self.__state == GRBL_STATUS_JOG:
+        self.__jogCancel()
+    elif 0x90 <= c <= 0x9D:
+      self.__advance()
+      self.__override(c)
+      self.__ovCounter = 0
+    elif c == ord(REAL_TIME_TOGGLE_FLOOD_COOLANT):
+      self.__modal["coolant"] ^= {8}
+      self.__ovCounter = 0
+    elif c == ord(REAL_TIME_TOGGLE_MIST_COOLANT):
+      self.__modal["coolant"] ^= {7}
+      self.__ovCounter = 0
+
+
+  def __jogCancel(self):
+    self.__mpos = self.__currentPosition()
+    self.__planner.clear()
+    self.__blockDone = 0.0
+    self.__state = GRBL_STATUS_IDLE
+
+
+  def __override(self, c: int):
+    borne = lambda v: max(10, min(200, v))
+    if c == ord(REAL_TIME_FEED_100_POURCENT):       self.__feedOv = 100
+    elif c == ord(REAL_TIME_FEED_PLUS_10):          self.__feedOv = borne(self.__feedOv + 10)
+    elif c == ord(REAL_TIME_FEED_MOINS_10):         self.__feedOv = borne(self.__feedOv - 10)
+    elif c == ord(REAL_TIME_FEED_PLUS_1):           self.__feedOv = borne(self.__feedOv + 1)
+    elif c == ord(REAL_TIME_FEED_MOINS_1):          self.__feedOv = borne(self.__feedOv - 1)
+    elif c == ord(REAL_TIME_RAPID_100_POURCENT):    self.__rapidOv = 100
+    elif c == ord(REAL_TIME_RAPID_50_POURCENT):     self.__rapidOv = 50
+    elif c == ord(REAL_TIME_RAPID_25_POURCENT):     self.__rapidOv = 25
+    elif c == ord(REAL_TIME_SPINDLE_100_POURCENT):  self.__spindleOv = 100
+    elif c == ord(REAL_TIME_SPINDLE_PLUS_10):       self.__spindleOv = borne(self.__spindleOv + 10)
+    elif c == ord(REAL_TIME_SPINDLE_MOINS_10):      self.__spindleOv = borne(self.__spindleOv - 10)
+    elif c == ord(REAL_TIME_SPINDLE_PLUS_1):        self.__spindleOv = borne(self.__spindleOv + 1)
+    elif c == ord(REAL_TIME_SPINDLE_MOINS_1):       self.__spindleOv = borne(self.__spindleOv - 1)
+
+
+  ''' Rapports '''
+
+  def __fmt(self, valeurs):
+    ''' Formatage des coordonnees (mm ou pouces selon $13) '''
+    if self.__settings[13] == 1:
+      return ",".join(["{:.4f}".format(v / 25.4) for v in valeurs])
+    return ",".join(["{:.3f}".format(v) for v in valeurs])
+
+
+  def __wco(self):
+    ''' Work Coordinate Offset : G5x + G92 + TLO (sur Z) '''
+    wco = [a + b for a, b in zip(self.__coord[self.__modal["wcs"] // 10], self.__g92)]
+    wco[2] += self.__tlo
+    return wco
+
+
+  def __statusReport(self):
+    ''' Real-time status report : <Etat|MPos ou WPos|Bf|FS|Pn|WCO ou Ov|A> '''
+    pos = self.__currentPosition()
+    if self.__settings[10] & 1:
+      champs = [self.__state, "MPos:" + self.__fmt(pos)]
+    else:
+      champs = [self.__state, "WPos:" + self.__fmt([p - w for p, w in zip(pos, self.__wco())])]
+    if self.__settings[10] & 2:
+      champs.append("Bf:{},{}".format(self.__plannerSize - len(self.__planner), self.__rxSize - len(self.__rx)))
+    feed = 0
+    if len(self.__planner) > 0 and not self.__hold:
+      feed = self.__planner[0][2] * (self.__rapidOv if self.__planner[0][3] == 'rapid' else self.__feedOv) / 100
+    speed = self.__speed * self.__spindleOv / 100 if self.__modal["spindle"] in [3, 4] else 0
+    champs.append("FS:{:.0f},{:.0f}".format(feed, speed))
+    if self.pins != "":
+      champs.append("Pn:" + self.pins)
+    occupe = self.__state not in [GRBL_STATUS_IDLE, GRBL_STATUS_ALARM, GRBL_STATUS_SLEEP]
+    if self.__wcoCounter > 0:
+      self.__wcoCounter -= 1
+    else:
+      champs.append("WCO:" + self.__fmt(self.__wco()))
+      self.__wcoCounter = 29 if occupe else 9
+      if self.__ovCounter == 0:
+        self.__ovCounter = 1 # Ov au prochain rapport
+    if self.__ovCounter > 0:
+      self.__ovCounter -= 1
+    else:
+      champs.append("Ov:{},{},{}".format(self.__feedOv, self.__rapidOv, self.__spindleOv))
+      accessoires = {3: "S", 4: "C"}.get(self.__modal["spindle"], "")
+      accessoires += "F" if 8 in self.__modal["coolant"] else ""
+      accessoires += "M" if 7 in self.__modal["coolant"] else ""
+      if accessoires != "":
+        champs.append("A:" + accessoires)
+      self.__ovCounter = 19 if occupe else 9
+    return "<" + "|".join(champs) + ">"
+
+
+  def __gcodeState(self):
+    ''' Reponse a $G '''
+    m = self.__modal
+    motion = "G{:g}".format(m["motion"] / 10)
+    mots = [motion, "G{:g}".format(m["wcs"] / 10), "G{:g}".format(m["plane"] / 10), "G{:g}".format(m["units"] / 10),
+            "G{:g}".format(m["distance"] / 10), "G{:g}".format(m["feedMode"] / 10)]
+    if m["program"] is not None:
+      mots.append("M{}".format(m["program"]))
+    mots.append("M{}".format(m["spindle"]))
+    if len(m["coolant"]) == 0:
+      mots.append("M9")
+    else:
+      mots += ["M{}".format(c) for c in sorted(m["coolant"])]
+    mots += ["T{}".format(self.__tool), "F{:g}".format(round(self.__feed / (25.4 if m["units"] == 200 else 1), 3)), "S{:g}".format(self.__speed)]
+    return "[GC:" + " ".join(mots) + "]"
+
+
+  def __parameters(self):
+    ''' Reponse a $# '''
+    for n in [54, 55, 56, 57, 58, 59, 28, 30]:
+      self.__send("[G{}:{}]".format(n, self.__fmt(self.__coord[n])))
+    self.__send("[G92:{}]".format(self.__fmt(self.__g92)))
+    self.__send("[TLO:{:.3f}]".format(self.__tlo))
+    self.__send("[PRB:{}:{}]".format(self.__fmt(self.__prb[0]), self.__prb[1]))
+
+
+  ''' Commandes $ '''
+
+  def __system(self, ligne: str):
+    if ligne == "$":
+      self.__send("[HLP:$$ $# $G $I $N $x=val $Nx=line $J=line $SLP $C $X $H ~ ! ? ctrl-x]")
+      return 0
+    if ligne[:3] == "$J=":
+      if self.__state not in [GRBL_STATUS_IDLE, GRBL_STATUS_JOG]:
+        return 8
+      return self.__gcode(ligne[3:], jog = True)
+    if ligne[1] in "$GCX" and len(ligne) > 2:
+      return 3
+    if ligne == "$$":
+      if self.__state in [GRBL_STATUS_RUN, GRBL_STATUS_HOLD0, GRBL_STATUS_HOLD1]:
+        return 8
+      for num in sorted(self.__settings):
+        valeur = self.__settings[num]
+        if num in SIM_FLOAT_SETTINGS or num >= 100:
+          self.__send("${}={:.3f}".format(num, valeur))
+        else:
+          self.__send("${}={}".format(num, int(valeur)))
+      return 0
+    if ligne == "$G":
+      self.__send(self.__gcodeState())
+      return 0
+    if ligne == "$C":
+      if self.__state not in [GRBL_STATUS_IDLE, GRBL_STATUS_CHECK, GRBL_STATUS_ALARM]:
+        return 8
+      if self.__checkMode:
+        self.__checkMode = False
+        self.__send("[MSG:Disabled]")
+        self.__reset()
+        self.__bootMessages()
+        return None # Le reset remplace la reponse
+      self.__checkMode = True
+      self.__state = GRBL_STATUS_CHECK
+      self.__send("[MSG:Enabled]")
+      return 0
+    if ligne == "$X":
+      if self.__state == GRBL_STATUS_ALARM:
+        self.__state = GRBL_STATUS_IDLE
+        self.__send("[MSG:Caution: Unlocked]")
+      return 0
+    # Les autres commandes ne sont acceptees qu'a l'arret
+    if self.__state not in [GRBL_STATUS_IDLE, GRBL_STATUS_ALARM, GRBL_STATUS_CHECK]:
+      return 8
+    if ligne == "$#":
+      self.__parameters()
+      return 0
+    if ligne == "$I":
+      self.__send("[VER:{}.{}:]".format(SIM_VERSION, SIM_BUILD_DATE))
+      if self.__reportAxs:
+        self.__send("[AXS:{}:{}]".format(self.__nbAxis, self.__axisNames))
+      self.__send("[OPT:{},{},{}]".format(self.__options, self.__plannerSize, self.__rxSize))
+      return 0
+    if ligne == "$N":
+      for i, l in enumerate(self.__startup):
+        self.__send("$N{}={}".format(i, l))
+      return 0
+    if ligne[:3] in ["$N0", "$N1"] and ligne[3:4] == "=":
+      self.__startup[int(ligne[2])] = ligne[4:]
+      return 0
+    if ligne == "$H":
+      if self.__settings[22] != 1:
+        return 5
+      # Homing en direction positive : position finale = -pulloff ($27)
+      cible = [-self.__settings[27]] * self.__nbAxis
+      self.__plan(cible, SIM_HOMING_TIME, 0, 'home')
+      self.__deferredOk = True
+      return 0
+    if ligne == "$SLP":
+      self.__planner.clear()
+      self.__state = GRBL_STATUS_SLEEP
+      self.__send("[MSG:Sleeping]")
+      return 0
+    if ligne in ["$RST=$", "$RST=#", "$RST=*"]:
+      if ligne[-1] in "$*":
+        self.__restoreSettings()
+      if ligne[-1] in "#*":
+        self.__coord = {n: [0.0] * self.__nbAxis for n in self.__coord}
+      self.__send("[MSG:Restoring defaults]")
+      return 0
+    if "=" in ligne:
+      num, _, valeur = ligne[1:].partition("=")
+      if not num.isdigit():
+        return 3
+      try:
+        valeur = float(valeur)
+      except ValueError:
+        return 2
+      if int(num) not in self.__settings:
+        return 3
+      if valeur < 0:
+        return 4
+      self.__settings[int(num)] = valeur
+      return 0
+    return 3
+
+
+  ''' Interpreteur GCode '''
+
+  def __gcode(self, ligne: str, jog: bool = False):
+    ''' Execute un bloc GCode (ou les mots d'un $J=), renvoie le code d'erreur Grbl (0 = ok) '''
+    mots = SIM_WORD_RE.findall(ligne)
+    if "".join(a + b for a, b in mots) != ligne:
+      return 1 # Caractere en tete de bloc qui n'est pas une lettre
+    gcodes, mcodes, valeurs = [], [], {}
+    for lettre, nombre in mots:
+      if not ('A' <= lettre <= 'Z'):
+        return 1
+      try:
+        valeur = float(nombre)
+      except ValueError:
+        return 2
+      if lettre == 'G':
+        g = round(valeur * 10)
+        groupe = [grp for grp in SIM_G_GROUPS if g in grp]
+        if len(groupe) == 0 or (jog and g not in [200, 210, 530, 900, 910]):
+          return 20
+        for autre in gcodes:
+          if autre in groupe[0] and (groupe[0] is not SIM_G_NONMODAL or autre == g):
+            return 21
+        if groupe[0] is SIM_G_NONMODAL:
+          for autre in gcodes:
+            if autre in SIM_G_NONMODAL:
+              return 21
+        gcodes.append(g)
+      elif lettre == 'M':
+        if jog or valeur != int(valeur):
+          return 20
+        m = int(valeur)
+        groupe = [grp for grp in SIM_M_GROUPS if m in grp]
+        if len(groupe) == 0:
+          return 20
+        for autre in mcodes:
+          if autre in groupe[0] and not (m in [7, 8] and autre in [7, 8] and autre != m):
+            return 21
+        mcodes.append(m)
+      elif lettre in self.__axisNames or lettre in "FIJKLNPRST":
+        if lettre in valeurs:
+          return 25
+        valeurs[lettre] = valeur
+      else:
+        return 20
+    if jog:
+      return self.__jog(gcodes, valeurs)
+    if self.__state == GRBL_STATUS_SLEEP:
+      return 9
+    return self.__executeBlock(gcodes, mcodes, valeurs)
+
+
+  def __axisWords(self, valeurs: dict, pouces: bool):
+    ''' Mots d'axes du bloc, en mm : {indice de l'axe: valeur} '''
+    mots = {}
+    for i, nom in enumerate(self.__axisNames):
+      if nom in valeurs:
+        v = valeurs[nom]
+        if pouces and i < 3:
+          v *= 25.4
+        mots[i] = v
+    return mots
+
+
+  def __target(self, axes: dict, absolu: bool, g53: bool):
+    ''' Calcule la position machine cible a partir des mots d'axes '''
+    cible = list(self.__mpos if len(self.__planner) == 0 else self.__planner[-1][0])
+    wco = self.__wco()
+    for i, v in axes.items():
+      if g53:
+        cible[i] = v
+      elif absolu:
+        cible[i] = v + wco[i]
+      else:
+        cible[i] += v
+    return cible
+
+
+  def __rapidDuration(self, depart, cible):
+    ''' Duree d'un G0 : l'axe le plus lent a sa vitesse maxi ($110...) '''
+    duree = 0
+    for i in range(self.__nbAxis):
+      duree = max(duree, abs(cible[i] - depart[i]) / self.__settings[110 + i] * 60)
+    return duree
+
+
+  def __jog(self, gcodes, valeurs):
+    pouces = 200 in gcodes or (210 not in gcodes and self.__modal["units"] == 200)
+    absolu = 900 in gcodes or (910 not in gcodes and self.__modal["distance"] == 900)
+    axes = self.__axisWords(valeurs, pouces)
+    for lettre in valeurs:
+      if lettre not in self.__axisNames and lettre not in "FN":
+        return 36
+    if 'F' not in valeurs or valeurs['F'] <= 0:
+      return 22
+    if len(axes) == 0:
+      return 26
+    depart = list(self.__mpos if len(self.__planner) == 0 else self.__planner[-1][0])
+    cible = self.__target(axes, absolu, 530 in gcodes)
+    if self.__settings[20] == 1:
+      for i in range(min(3, self.__nbAxis)):
+        if not -self.__settings[130 + i] <= cible[i] <= 0:
+          return 15
+    feed = valeurs['F'] * (25.4 if pouces else 1)
+    distance = math.sqrt(sum((b - a) ** 2 for a, b in zip(depart, cible)))
+    if len(self.__planner) >= self.__plannerSize:
+      return None
+    self.__plan(cible, distance / feed * 60, feed, 'jog')
+    return 0
+
+
+  def __executeBlock(self, gcodes, mcodes, valeurs):
+    ''' Execution d'un bloc GCode dans l'ordre de Grbl (gc_execute_line()) '''
+    modal = self.__modal
+    utilises = set(['N'])
+    motion = [g for g in gcodes if g in SIM_G_MOTION]
+    nonModal = [g for g in gcodes if g in SIM_G_NONMODAL]
+    nonModal = nonModal[0] if len(nonModal) > 0 else None
+    pouces = 200 in gcodes or (210 not in gcodes and modal["units"] == 200)
+    axes = self.__axisWords(valeurs, pouces)
+
+    # Verifications avant de modifier l'etat
+    if 'T' in valeurs:
+      if valeurs['T'] != int(valeurs['T']):
+        return 23
+      if valeurs['T'] > 255:
+        return 38
+    if nonModal in [100] and ('L' not in valeurs or 'P' not in valeurs):
+      return 28
+    if nonModal == 40 and 'P' not in valeurs:
+      return 28
+    if len(motion) > 0 and nonModal in [100, 280, 300, 920] and len(axes) > 0:
+      return 24 # Deux commandes utilisent les mots d'axes
+    feedMode = 930 if 930 in gcodes else 940 if 940 in gcodes else modal["feedMode"]
+    motionMode = motion[0] if len(motion) > 0 else modal["motion"]
+    if nonModal == 530 and motionMode not in [0, 10]:
+      return 30
+    if len(axes) > 0 and nonModal not in [100, 280, 300, 920] and motionMode == 800:
+      return 31
+    if len(axes) > 0 and nonModal not in [100, 280, 300, 920] and motionMode in [10, 20, 30, 382, 383, 384, 385]:
+      feed = valeurs.get('F', None)
+      if feedMode == 930:
+        if feed is None:
+          return 22
+      elif (feed if feed is not None else self.__feed) <= 0:
+        return 22
+    if len(motion) > 0 and motion[0] in [20, 30] and len(axes) == 0:
+      return 26
+
+    # 1-4 : mode d'avance, F, S, T
+    modal["feedMode"] = feedMode
+    if 'F' in valeurs:
+      self.__feed = valeurs['F'] * (25.4 if pouces else 1)
+      utilises.add('F')
+    if 'S' in valeurs:
+      self.__speed = valeurs['S']
+      utilises.add('S')
+    if 'T' in valeurs:
+      self.__tool = int(valeurs['T'])
+      utilises.add('T')
+    # 5-6 : broche et arrosage
+    for m in mcodes:
+      if m in [3, 4, 5, 7, 8, 9]:
+        self.__ovCounter = 0 # Champ A: mis a jour au prochain status
+      if m in [3, 4, 5]:
+        modal["spindle"] = m
+      elif m == 9:
+        modal["coolant"] = set()
+      elif m in [7, 8]:
+        modal["coolant"].add(m)
+    # 8 : temporisation
+    if nonModal == 40:
+      utilises.add('P')
+      if not self.__checkMode:
+        self.__plan(self.__mpos, valeurs['P'], 0, 'dwell')
+        self.__deferredOk = True
+    # 9-16 : plan, unites, TLO, repere, distance
+    for g in gcodes:
+      if g in [170, 180, 190]: modal["plane"] = g
+      elif g in [200, 210]:    modal["units"] = g
+      elif g in [900, 910]:    modal["distance"] = g
+      elif g in [540, 550, 560, 570, 580, 590]: modal["wcs"] = g
+      elif g == 490:           self.__tlo = 0.0
+      elif g == 431:
+        if 'Z' not in valeurs:
+          return 28
+        self.__tlo = axes.get(2, 0.0)
+        utilises.add('Z')
+    # 17 : commandes non modales
+    position = list(self.__mpos if len(self.__planner) == 0 else self.__planner[-1][0])
+    if nonModal == 100:
+      utilises.update(['L', 'P'])
+      p = int(valeurs['P'])
+      if p < 0 or p > 6:
+        return 29
+      n = modal["wcs"] // 10 if p == 0 else 53 + p
+      for i, v in axes.items():
+        if valeurs['L'] == 2:
+          self.__coord[n][i] = v
+        elif valeurs['L'] == 20:
+          self.__coord[n][i] = position[i] - v - self.__g92[i] - (self.__tlo if i == 2 else 0)
+        else:
+          return 20
+        utilises.add(self.__axisNames[i])
+    elif nonModal in [280, 300]:
+      n = nonModal // 10
+      intermediaire = self.__target(axes, modal["distance"] == 900, False)
+      utilises.update(self.__axisNames)
+      if not self.__checkMode:
+        self.__plan(intermediaire, self.__rapidDuration(position, intermediaire), self.__rapidFeed(), 'rapid')
+        cible = list(intermediaire)
+        for i in (axes.keys() if len(axes) > 0 else range(self.__nbAxis)):
+          cible[i] = self.__coord[n][i]
+        self.__plan(cible, self.__rapidDuration(intermediaire, cible), self.__rapidFeed(), 'rapid')
+      modal["motion"] = 0 if len(motion) == 0 else motion[0]
+    elif nonModal in [281, 301]:
+      self.__coord[nonModal // 10] = list(position)
+    elif nonModal == 920:
+      wcs = self.__coord[modal["wcs"] // 10]
+      for i, v in axes.items():
+        self.__g92[i] = position[i] - wcs[i] - v - (self.__tlo if i == 2 else 0)
+        utilises.add(self.__axisNames[i])
+    elif nonModal == 921:
+      self.__g92 = [0.0] * self.__nbAxis
+    # 18 : mouvement
+    if len(motion) > 0:
+      modal["motion"] = motion[0]
+    if len(axes) > 0 and nonModal not in [100, 280, 300, 920]:
+      rc = self.__motion(motionMode, axes, valeurs, nonModal == 530, feedMode, pouces, utilises)
+      if rc != 0:
+        return rc
+    # 19 : deroulement du programme
+    for m in mcodes:
+      if m in [0, 1]:
+        modal["program"] = m
+        if m == 0 and not self.__checkMode:
+          self.__hold = True
+          self.__state = GRBL_STATUS_HOLD0
+      elif m in [2, 30]:
+        modal.update({"motion": 10, "plane": 170, "distance": 900, "feedMode": 940, "wcs": 540, "spindle": 5, "coolant": set(), "program": None})
+        self.__g92 = [0.0] * self.__nbAxis
+    # Mots non utilises
+    for lettre in valeurs:
+      if lettre not in utilises:
+        return 36
+    return 0
+
+
+  def __rapidFeed(self):
+    return min(self.__settings[110 + i] for i in range(self.__nbAxis))
+
+
+  def __motion(self, motionMode, axes, valeurs, g53, feedMode, pouces, utilises):
+    ''' Planification du mouvement G0, G1, G2, G3 ou G38.x du bloc '''
+    depart = list(self.__mpos if len(self.__planner) == 0 else self.__planner[-1][0])
+    cible = self.__target(axes, self.__modal["distance"] == 900, g53)
+    utilises.update([self.__axisNames[i] for i in axes])
+    if motionMode == 0:
+      if not self.__checkMode:
+        self.__plan(cible, self.__rapidDuration(depart, cible), self.__rapidFeed(), 'rapid')
+      return 0
+    distance = math.sqrt(sum((b - a) ** 2 for a, b in zip(depart, cible)))
+    if motionMode in [20, 30]:
+      distance, rc = self.__arcLength(motionMode, depart, cible, valeurs, pouces, utilises)
+      if rc != 0:
+        return rc
+    if feedMode == 930:
+      duree = 60 / valeurs['F']
+      feed = distance / duree * 60 if duree > 0 else 0
+    else:
+      feed = self.__feed
+      duree = distance / feed * 60
+    if self.__checkMode:
+      return 0
+    if motionMode in [382, 383, 384, 385]:
+      # Sonde : contact simule a mi-course, compte rendu [PRB:] a la fin du mouvement
+      contact = [a + (b - a) / 2 for a, b in zip(depart, cible)]
+      def probeDone():
+        self.__prb = (contact, 1)
+        self.__send("[PRB:{}:1]".format(self.__fmt(contact)))
+      self.__plan(contact, duree / 2, feed, 'probe', probeDone)
+      self.__deferredOk = True
+      return 0
+    self.__plan(cible, duree, feed, 'feed')
+    return 0
+
+
+  def __arcLength(self, motionMode, depart, cible, valeurs, pouces, utilises):
+    ''' Longueur d'un arc G2/G3 dans le plan courant (centre I J K ou rayon R), helice comprise '''
+    plan = {170: (0, 1, 2), 180: (2, 0, 1), 190: (1, 2, 0)}[self.__modal["plane"]]
+    a0, a1, lin = plan
+    mots = "IJK"
+    dx, dy = cible[a0] - depart[a0], cible[a1] - depart[a1]
+    facteur = 25.4 if pouces else 1
+    if 'R' in valeurs:
+      utilises.add('R')
+      r = valeurs['R'] * facteur
+      d = math.hypot(dx, dy)
+      if d == 0 or d > 2 * abs(r) + 0.0005:
+        return 0, 33
+      angle = 2 * math.asin(min(d / (2 * abs(r)), 1.0))
+      if r < 0:
+        angle = 2 * math.pi - angle
+      rayon = abs(r)
+    else:
+      i0, i1 = mots[a0], mots[a1]
+      if i0 not in valeurs and i1 not in valeurs:
+        return 0, 35
+      utilises.update([i0, i1])
+      cx, cy = valeurs.get(i0, 0) * facteur, valeurs.get(i1, 0) * facteur
+      rayon = math.hypot(cx, cy)
+      r2 = math.hypot(cx - dx, cy - dy)
+      if abs(rayon - r2) > 0.005 and abs(rayon - r2) > 0.001 * rayon:
+        return 0, 33
+      a = math.atan2(-cy, -cx)
+      b = math.atan2(dy - cy, dx - cx)
+      angle = b - a
+      if motionMode == 20 and angle >= 0:
+        angle -= 2 * math.pi
+      elif motionMode == 30 and angle <= 0:
+        angle += 2 * math.pi
+      angle = abs(angle)
+    longueur = math.hypot(angle * rayon, cible[lin] - depart[lin])
+    return longueur, 0
+
+
+class grblTransportSimulator(grblTransport):
+  '''
+  Transport vers un grblSimulator dans le meme processus, adresse de la forme
+  sim://[grbl|mega5x][?timescale=x] (timescale=0 : mouvements instantanes).
+  '''
+
+  def __init__(self, portName: str):
+    super().__init__(portName)
+    adresse = portName.split("://", 1)[1]
+    flavour, _, options = adresse.partition("?")
+    self.__flavour = flavour.strip("/") or SIM_GRBL_MEGA5X
+    self.__timeScale = 1.0
+    for option in options.split("&"):
+      nom, _, valeur = option.partition("=")
+      if nom == "timescale":
+        self.__timeScale = float(valeur)
+    self.simulator = None
+
+  def open(self):
+    if self.__flavour not in SIM_FLAVOURS:
+      raise ValueError("unknown simulator: {} (expected one of {})".format(self.__flavour, ", ".join(SIM_FLAVOURS)))
+    self.simulator = grblSimulator(self.__flavour, self.__timeScale)
+    self.simulator.start()
+
+  def close(self):
+    if self.simulator is not None:
+      self.simulator.stop()
+
+  @property
+  def in_waiting(self):
+    return self.simulator.outWaiting()
+
+  def readline(self):
+    return self.simulator.readline(self.timeout)
+
+  def readChunk(self):
+    return self.simulator.read(self.timeout)
+
+  def write(self, data: bytes):
+    return self.simulator.write(data)
+
+  def cancel_read(self):
+    self.simulator.cancelRead()
+
+
+def servePty(simulator: grblSimulator):
+  ''' Expose le simulateur sur un pseudo-terminal (POSIX), renvoie le nom du port a ouvrir '''
+  import pty, tty
+  maitre, esclave = pty.openpty()
+  tty.setraw(maitre)
+  tty.setraw(esclave)
+  def versSimulateur():
+    while True:
+      simulator.write(os.read(maitre, 1024))
+  def depuisSimulateur():
+    while True:
+      data = simulator.read()
+      if len(data) > 0:
+        os.write(maitre, data)
+  threading.Thread(target=versSimulateur, daemon=True).start()
+  threading.Thread(target=depuisSimulateur, daemon=True).start()
+  simulator.start()
+  return os.ttyname(esclave)
+
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description="Grbl 1.1 / grbl-Mega-5X simulator")
+  parser.add_argument("-f", "--flavour", default=SIM_GRBL_MEGA5X, choices=list(SIM_FLAVOURS))
+  parser.add_argument("-t", "--timescale", type=float, default=1.0, help="motion duration factor, 0 for instant moves")
+  parser.add_argument("--pty", action="store_true", help="serve the simulator on a pseudo-terminal until Ctrl+C")
+  parser.add_argument("--bench", type=int, default=0, metavar="N", help="stream N lines through grblComSerial + grblDecode")
+  args = parser.parse_args()
+
+  if args.pty:
+    nom = servePty(grblSimulator(args.flavour, args.timescale))
+    print("Grbl simulator ({}) listening on {}".format(args.flavour, nom))
+    try:
+      while True:
+        time.sleep(1)
+    except KeyboardInterrupt:
+      pass
+    sys.exit(0)
+
+  from PyQt6 import uic
+  from PyQt6.QtCore import QThread
+  from PyQt6.QtWidgets import QApplication, QMainWindow
+  from grblCom import grblCom
+  from grblDecode import grblDecode
+  nbLignes = args.bench if args.bench > 0 else 5000
+  app = QApplication(sys.argv)
+  fenetre = QMainWindow()
+  ui = uic.loadUi(os.path.join(os.path.dirname(os.path.abspath(__file__)), "mainWindow.ui"), fenetre)
+  com = grblCom()
+  decode = grblDecode(ui, lambda severite, message: None, com, None, lambda: False)
+  com.setDecodeur(decode)
+  compteurs = {"ok": 0, "error": 0, "status": 0, "init": False}
+  def onOk():
+    compteurs["ok"] += 1
+  def onError(num):
+    compteurs["error"] += 1
+  def onStatus(data):
+    compteurs["status"] += 1
+    decode.decodeGrblStatus(data)
+  def onInit(data):
+    compteurs["init"] = True
+  com.sig_ok.connect(onOk)
+  com.sig_error.connect(onError)
+  com.sig_status.connect(onStatus)
+  com.sig_data.connect(decode.decodeGrblData)
+  com.sig_init.connect(onInit)
+  com.startCom("sim://{}?timescale={}".format(args.flavour, args.timescale), COM_DEFAULT_BAUD_RATE, STREAMING_CHAR_COUNTING)
+  t0 = time.perf_counter()
+  while not compteurs["init"] and time.perf_counter() - t0 < 5:
+    app.processEvents()
+    time.sleep(0.001)
+  time.sleep(0.2)
+  app.processEvents()
+  base = compteurs["ok"]
+  t0 = time.perf_counter()
+  com.gcodePush("G21 G90 G94 F3000")
+  for i in range(nbLignes):
+    com.gcodePush("G1 X{:.3f} Y{:.3f} Z{:.3f}".format(50 + 40 * math.cos(i / 50), 50 + 40 * math.sin(i / 50), -1 - (i % 10) / 10))
+  while compteurs["ok"] + compteurs["error"] - base < nbLignes + 1 and time.perf_counter() - t0 < 120:
+    app.processEvents()
+    time.sleep(0.0005)
+  duree = time.perf_counter() - t0
+  print("{}: {} lines streamed in {:.2f} s ({:.0f} lines/s), {} ok, {} errors, {} status reports decoded".format(
+    args.flavour, nbLignes + 1, duree, (nbLignes + 1) / duree, compteurs["ok"] - base, compteurs["error"], compteurs["status"]))
+  print(com.getStats().report())
+  com.stopCom()
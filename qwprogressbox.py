@@ -29,6 +29,7 @@ from PyQt6 import QtCore, QtWidgets
 from PyQt6.QtCore import Qt, QCoreApplication, QObject, pyqtSignal, pyqtSlot, QSettings, QSize
 from cn5X_config import *
 from grblDecode import grblDecode
+from cn5X_gcodeEstimator import formatDuration
 
 
 class qwProgressBox(QtWidgets.QWidget):
@@ -112,6 +113,12 @@ class qwProgressBox(QtWidgets.QWidget):
 
     self.pBoxBtnClose.clicked.connect(self.stop)
 
+    self.pBoxLblRemaining = QtWidgets.QLabel(self.pBox)
+    self.pBoxLblRemaining.setObjectName("pBoxLblRemaining")
+    self.pBoxLblRemaining.setText("")
+    self.gridLayout.addWidget(self.pBoxLblRemaining, 4, 0, 1, 1)
+    self.__estimate = None # Estimation de la duree du programme (gcodeEstimate)
+
     self.pBoxChkAutoClose = QtWidgets.QCheckBox(self.pBox)
     self.pBoxChkAutoClose.setText(self.tr("Auto close"))
     self.pBoxChkAutoClose.setChecked(self.__autoClose)
@@ -163,6 +170,28 @@ class qwProgressBox(QtWidgets.QWidget):
     self.__elapseThread.stop()
 
 
+  def setEstimate(self, estimate, startFrom: int = 0):
+    '''
+    Estimation de la duree du programme (gcodeEstimate) pour l'affichage du temps restant
+    depuis la ligne startFrom, None si inconnue
+    '''
+    self.__estimate = estimate
+    if estimate is None:
+      self.pBoxLblRemaining.setText("")
+      self.pBoxLblRemaining.setToolTip("")
+    else:
+      self.__showRemaining(startFrom)
+      details = [self.tr("Estimated cycle time: {}").format(formatDuration(estimate.total()))]
+      for tool, duree in estimate.tools():
+        details.append(self.tr("Tool {}: {}").format(tool, formatDuration(duree)))
+      self.pBoxLblRemaining.setToolTip("\n".join(details))
+
+
+  def __showRemaining(self, line: int):
+    if self.__estimate is not None:
+      self.pBoxLblRemaining.setText(self.tr("Remaining time: {}").format(formatDuration(self.__estimate.remaining(line))))
+
+
   def setRange(self, mini: int, maxi: int):
     self.pBoxProgress.setRange(mini, maxi)
 
@@ -170,8 +199,8 @@ class qwProgressBox(QtWidgets.QWidget):
   def setValue(self, val:int):
     self.pBoxProgress.setValue(val)
     self.pBoxProgress.setToolTip(self.tr("Line {} of {}").format(val, self.pBoxProgress.maximum()))
+    self.__showRemaining(val)
     self.pBoxProgress.update()
-    QCoreApplication.processEvents()
 
 
   def setComment(self, comment: str):
@@ -47,6 +47,7 @@ setup(name='cn5X++',
   install_requires = [
     'pyqt6',
     'pyserial',
+    'numpy',
     ],
   options = dict(build_exe = buildOptions),
   executables = executables